@@ -3,11 +3,14 @@
 Discord Bot for HardwareFlare and others
 @author: Tisboyo
 """
+import datetime
 import logging
 
 import discord
 from discord.ext import commands
 
+from util.database import Database
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,15 +21,46 @@ class BanHammer(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        naughty_list = [
-            486042866901188628,
-        ]
-        if member.id in naughty_list:
+        # The naughty list is kept in the global database's bans table
+        query = "SELECT reason FROM bans WHERE user_id = ?"
+        result = await Database.dbGlobalExecuteAsync(self, query, (member.id,))
+
+        if result is not None:
             # Ban
-            await member.guild.ban(member, reason="Auto-Ban for being on Naughty-List")
+            await member.guild.ban(member, reason=f"Auto-Ban for being on {result[0] or 'Naughty-List'}")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def naughty(self, ctx, user_id: int, *, reason: str = "Naughty-List"):
+        """
+        Adds a user to the naughty list, they are banned when they join any server the bot is in
+        """
+        query = "INSERT OR REPLACE INTO bans(user_id, reason, added_by, added_at) VALUES (?, ?, ?, ?)"
+        values = (user_id, reason, ctx.author.id, str(datetime.datetime.utcnow()))
+        await Database.dbGlobalExecuteAsync(self, query, values)
+
+        # How many of our servers have already banned them
+        query = "SELECT COUNT(*) FROM guild_bans WHERE user_id = ?"
+        banned = await Database.dbGlobalExecuteAsync(self, query, (user_id,))
+        await ctx.send(f"{user_id} added to the naughty list, already banned in {banned[0]} servers.")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def nice(self, ctx, user_id: int):
+        """
+        Removes a user from the naughty list
+        """
+        await Database.dbGlobalExecuteAsync(self, "DELETE FROM bans WHERE user_id = ?", (user_id,))
+        await ctx.send(f"{user_id} removed from the naughty list.")
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, member):
+        query = "INSERT OR REPLACE INTO guild_bans(guild_id, user_id, banned_at) VALUES (?, ?, ?)"
+        values = (guild.id, member.id, str(datetime.datetime.utcnow()))
+        await Database.dbGlobalExecuteAsync(self, query, values)
+
         channels = dict()
         channels[369243434080272385] = 466048561994268682  # Addohms/mods
         channels[378302095633154050] = 378302095633154052  # Myserver/general
@@ -34,6 +68,11 @@ class BanHammer(commands.Cog):
             channel: discord.TextChannel = self.client.get_channel(channels[guild.id])
             await channel.send(f"{member.name} banned.")
 
+    @commands.Cog.listener()
+    async def on_member_unban(self, guild, user):
+        query = "DELETE FROM guild_bans WHERE guild_id = ? AND user_id = ?"
+        await Database.dbGlobalExecuteAsync(self, query, (guild.id, user.id))
+
     def cog_unload(self):
         logger.info(f"{__name__} unloaded...")
 
@@ -43,10 +43,9 @@ class Prefix(commands.Cog):
         Database.Main[ctx.guild.id]["prefix"] = prefix
 
         # database query
-        cursor = Database.cursor[ctx.guild.id]
         query = "UPDATE main SET setting_data = ? WHERE setting_id = ? "
         values = (prefix, "prefix")
-        Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+        await Database.dbExecuteAsync(self, ctx.guild.id, query, values)
 
         await ctx.send(f"Command prefix has been updated to `{prefix}`")
         await ctx.message.add_reaction(Dictionary.check_box)
@@ -27,19 +27,20 @@ class Highlight(commands.Cog):
         Database.readSettings(self)
 
         for guild_id in Database.Main:
-            # Create a dictionary for tracking cooldowns
-            Database.Cogs[self.name][guild_id]["cooldown"] = dict()
+            self.setup_guild(guild_id)
 
-            if "highlight_channel" not in Database.Cogs[self.name][guild_id]["settings"].keys():
-                Database.Cogs[self.name][guild_id]["settings"]["highlight_channel"] = None
+    def setup_guild(self, guild_id):
+        # Create a dictionary for tracking cooldowns
+        Database.Cogs[self.name][guild_id]["cooldown"] = dict()
+
+        if "highlight_channel" not in Database.Cogs[self.name][guild_id]["settings"].keys():
+            Database.Cogs[self.name][guild_id]["settings"]["highlight_channel"] = None
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         # Have to reload Database.Cogs when joining a new guild to prevent errors.
-        Database.readSettings(self)
-
-        if "highlight_channel" not in Database.Main[guild.id]["settings"].keys():
-            Database.Main[guild.id]["settings"]["highlight_channel"] = None
+        Database.readSettingsGuild(self, guild.id)
+        self.setup_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
@@ -4,7 +4,6 @@ Discord Bot for HardwareFlare and others
 @author: Tisboyo
 """
 import datetime
-import json
 import logging
 
 import discord.utils
@@ -12,6 +11,7 @@ from discord.ext import commands
 
 from util.database import Database
 from util.permissions import Permissions
+from util.repositories import Users
 from util.utils import Utils
 
 # import sqlite3
@@ -472,24 +472,14 @@ class JoinLeave(commands.Cog):
         embed.add_field(name="Account Age", value=f"{self.build_account_age(member)}")
         embed.add_field(name="Member for", value=f"{self.build_server_member_for(member)}")
         if Database.Cogs.get("levels", False) and Database.Cogs["levels"][member.guild.id]["settings"]["enabled"]:
-            # database query
-            cursor = Database.cursor[member.guild.id]
-            query = "SELECT nickname_history FROM users WHERE user_id = ?"
-            values = (member.id,)
-            query_result = Database.dbExecute(self, cursor, member.guild.id, query, values)
-
-            if query_result is not None:
-                if query_result[0] is not None:
-                    # Use a space between names as it is not a valid trailing character
-                    # Split the query into a list of names previously used
-                    nickname_history = json.loads(query_result[0])
-
-                    # Fix a bug that D3Jake created somehow mysteriously inserting a blank list
-                    if len(nickname_history) > 0:
-                        # Build the list
-                        nickname_history = ", ".join(nickname_history)
-
-                        embed.add_field(name="Previous Nicknames", value=f"{nickname_history}")
+            nickname_history = Users.get_nickname_history(self, member.guild.id, member.id)
+
+            # Fix a bug that D3Jake created somehow mysteriously inserting a blank list
+            if nickname_history:
+                # Build the list
+                nickname_history = ", ".join(nickname_history)
+
+                embed.add_field(name="Previous Nicknames", value=f"{nickname_history}")
 
         return embed
 
@@ -10,6 +10,8 @@ from discord.ext import commands
 
 from util.database import Database
 from util.permissions import Permissions
+from util.repositories import UserKarma
+from util.repositories import Users
 from util.utils import Utils
 
 logger = logging.getLogger(__name__)
@@ -22,8 +24,23 @@ class Karma(commands.Cog):
 
         self.Karma = dict()
 
+        # Copy the karma already in the guild databases into the global database,
+        # once Levels has created the users table
+        Database.migrations.register(self.name, 1, Karma.copy_to_global, requires=("levels", 2))
+        Database.dbMigrate(self)
+
         Database.readSettings(self)
 
+    def copy_to_global(self, cursor, guild_id: int):
+        """Migration step, copies the guilds upvotes and downvotes to the global karma table"""
+        cursor.execute("SELECT user_id, upvotes, downvotes FROM users WHERE upvotes != '0' OR downvotes != '0'")
+
+        values = [
+            (guild_id, int(user_id), int(upvotes), int(downvotes)) for user_id, upvotes, downvotes in cursor.fetchall()
+        ]
+        query = "INSERT OR REPLACE INTO karma(guild_id, user_id, upvotes, downvotes) VALUES (?, ?, ?, ?)"
+        Database.dbGlobalExecute(self, query, values, many=True)
+
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         # Have to reload Database.Cogs when joining a new guild to prevent errors.
@@ -35,6 +52,11 @@ class Karma(commands.Cog):
         if Database.Cogs[self.name].get(guild.id, False):
             del Database.Cogs[self.name][guild.id]
 
+    def reset_guild(self, guild_id: int):
+        """Forgets the karma held in memory for the guild, it is read from the database again"""
+        for guilds in self.Karma.values():
+            guilds.pop(guild_id, None)
+
     @commands.Cog.listener()
     async def on_message(self, message):
         # Guard Clause
@@ -71,15 +93,15 @@ class Karma(commands.Cog):
 
         if str(payload.emoji) == settings.get("upvote", False):
             logger.info(f"{channel.guild}-#{channel.name} - {voter.name} upvoted {message.author.name}")
-            current_karma = self.get_current_karma(payload.guild_id, message.author.id)
+            current_karma = await self.get_current_karma(payload.guild_id, message.author.id)
             new_karma = [current_karma[0] + 1, current_karma[1]]
-            self.set_new_karma(payload.guild_id, message.author.id, new_karma)
+            await self.set_new_karma(payload.guild_id, message.author.id, new_karma)
 
         elif str(payload.emoji) == settings.get("downvote", False):
             logger.info(f"{channel.guild}-#{channel.name} - {voter.name} downvoted {message.author.name}")
-            current_karma = self.get_current_karma(payload.guild_id, message.author.id)
+            current_karma = await self.get_current_karma(payload.guild_id, message.author.id)
             new_karma = [current_karma[0], current_karma[1] + 1]
-            self.set_new_karma(payload.guild_id, message.author.id, new_karma)
+            await self.set_new_karma(payload.guild_id, message.author.id, new_karma)
 
         else:
             # Any other emoji was added, so we don't really care.
@@ -115,20 +137,20 @@ class Karma(commands.Cog):
 
         if str(payload.emoji) == settings.get("upvote", False):
             logger.info(f"{channel.guild}-#{channel.name} - {voter.name} removed their upvote for {message.author.name}")
-            current_karma = self.get_current_karma(payload.guild_id, message.author.id)
+            current_karma = await self.get_current_karma(payload.guild_id, message.author.id)
             new_karma = [current_karma[0] - 1, current_karma[1]]
-            self.set_new_karma(payload.guild_id, message.author.id, new_karma)
+            await self.set_new_karma(payload.guild_id, message.author.id, new_karma)
 
         elif str(payload.emoji) == settings.get("downvote", False):
             logger.info(f"{channel.guild}-#{channel.name} - {voter.name} removed their downvote for {message.author.name}")
-            current_karma = self.get_current_karma(payload.guild_id, message.author.id)
+            current_karma = await self.get_current_karma(payload.guild_id, message.author.id)
             new_karma = [current_karma[0], current_karma[1] - 1]
-            self.set_new_karma(payload.guild_id, message.author.id, new_karma)
+            await self.set_new_karma(payload.guild_id, message.author.id, new_karma)
 
         else:
             pass
 
-    def get_current_karma(self, guild_id: int, user_id: int):
+    async def get_current_karma(self, guild_id: int, user_id: int):
         """
         Returns the message owners current upvotes and downvotes
         """
@@ -143,17 +165,16 @@ class Karma(commands.Cog):
         if not self.Karma[user_id].get(guild_id, False):
             # Karma for user is not currently in memory, do a db query
 
-            # database query
-            cursor = Database.cursor[guild_id]
-            query = "SELECT upvotes, downvotes FROM users WHERE user_id = ?"
-            values = (user_id,)
-            result = Database.dbExecute(self, cursor, guild_id, query, values)
+            result = await Users.get_karma_async(self, guild_id, user_id)
+            if result is None:
+                # Not in the database yet, set_new_karma inserts them
+                result = UserKarma(0, 0)
 
-            self.Karma[user_id][guild_id] = [int(result[0]), int(result[1])]
+            self.Karma[user_id][guild_id] = list(result)
 
         return self.Karma[user_id][guild_id]
 
-    def set_new_karma(self, guild_id: int, user_id: int, karma: list):
+    async def set_new_karma(self, guild_id: int, user_id: int, karma: list):
         """
         Sets the new Karma for a user
 
@@ -170,20 +191,15 @@ class Karma(commands.Cog):
         self.Karma[user_id][guild_id] = karma
         logger.debug(f"New karma set for {guild_id}-{user_id} of {karma}")
 
-        # Database handle
-        cursor = Database.cursor[guild_id]
-
-        query = "UPDATE users SET upvotes = ?, downvotes = ? WHERE user_id = ?"
-        values = (karma[0], karma[1], user_id)
-        _, rows = Database.dbExecute(self, cursor, guild_id, query, values, False, True)
+        # Keep the global totals in step
+        query = """INSERT INTO karma(guild_id, user_id, upvotes, downvotes) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(guild_id, user_id) DO UPDATE SET upvotes = excluded.upvotes, downvotes = excluded.downvotes"""
+        await Database.dbGlobalExecuteAsync(self, query, (guild_id, user_id, karma[0], karma[1]))
 
         # User was not in Database yet, insert them.
         # This should theoretically never happen since they are normally inserted on Levels.on_message, but just in case.
-        if rows == 0:
-            query = "INSERT INTO users(user_id, exp, level, words, messages, lastseen, lastseenurl, upvotes, downvotes) VALUES(?,?,?,?,?,?,?,?,?)"
-            values = (user_id, 0, 0, 0, 0, 0, None, karma[0], karma[1])
-            # We don't need to save the result of this
-            Database.dbExecute(self, cursor, guild_id, query, values)
+        if not await Users.set_karma_async(self, guild_id, user_id, UserKarma(*karma)):
+            await Users.add_karma_async(self, guild_id, user_id, UserKarma(*karma))
             logger.warning("User was inserted into database from Karma.set_new_karma.")
             logger.warning(f"Guild: {guild_id} User: {user_id}, Karma: {karma}")
 
@@ -207,6 +223,24 @@ class Karma(commands.Cog):
         message = f"Current Upvote: {upvote} \nCurrent Downvote: {downvote}"
         await ctx.send(message)
 
+    @karma.command(name="global")
+    @commands.guild_only()
+    @Permissions.check(role="everyone")
+    async def karma_global(self, ctx, member: discord.Member = None):
+        """
+        Show a users karma across every server the bot is in
+
+        Default Permissions: Everyone role
+        """
+        member = member or ctx.author
+
+        query = "SELECT COUNT(*), TOTAL(upvotes), TOTAL(downvotes) FROM karma WHERE user_id = ?"
+        guilds, upvotes, downvotes = await Database.dbGlobalExecuteAsync(self, query, (member.id,))
+
+        await ctx.send(
+            f"{member.display_name} has {int(upvotes)} upvotes and {int(downvotes)} downvotes in {guilds} servers."
+        )
+
     @karma.command()
     @commands.guild_only()
     @Permissions.check(permission=["manage_guild"])
@@ -366,6 +400,7 @@ class Karma(commands.Cog):
 
         return emoji
 
+    @karma_global.error
     @upvote.error
     @downvote.error
     @disable.error
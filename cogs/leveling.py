@@ -3,114 +3,181 @@
 Discord Bot for HardwareFlare and others
 @author: Tisboyo
 """
+import asyncio
+import atexit
 import datetime
-import json
 import logging
 import sqlite3
+import time
 
 import discord
 from discord.ext import commands
+from discord.ext import tasks
 
+from keys import levels as levels_settings
+from util import activity_store
+from util import level_import
+from util.activity_store import ActivityStore
 from util.database import Database
+from util.migrations import Migrations
 from util.permissions import Permissions
+from util.rank_index import RankIndex
+from util.repositories import ActivityHistory
+from util.repositories import UserActivity
+from util.repositories import UserLevel
+from util.repositories import Users
 from util.utils import dotdict
 from util.utils import Utils
 
 logger = logging.getLogger(__name__)
 
 
+class Activity:
+    """
+    A member's levels, kept in memory by Levels and written to the users table by flush_guild.
+    lastexp and lastseen are unix timestamps, like in the users table.
+    """
+
+    __slots__ = ("exp", "level", "words", "messages", "lastexp", "lastseen", "lastseenurl", "touched")
+
+    def __init__(self, row: UserLevel):
+        self.exp = row.exp
+        self.level = row.level
+        self.words = row.words
+        self.messages = row.messages
+        # Only blank for a new user, who doesn't get experience for their first message
+        self.lastexp = row.lastexp if row.lastexp is not None else int(time.time())
+        self.lastseen = None
+        self.lastseenurl = None
+        self.touched = time.monotonic()
+
+    def row(self, user_id: int):
+        return UserActivity(
+            self.exp, self.level, self.words, self.messages, self.lastseen, self.lastseenurl, self.lastexp, user_id
+        )
+
+
 class Levels(commands.Cog):
     def __init__(self, client):
         self.client = client
         self.name = "levels"
-        self.db_users_ver = 2
         Database.Cogs[self.name] = dict()
 
-        Database.readSettings(self)
-
-        for guild_id in Database.Main:
-            if Database.Cogs[self.name][guild_id]["settings"].get("dbVer", 0) < self.db_users_ver:
-                self.db_setup(guild_id)
-
-    def db_setup(self, guild_id):
+        # {guild_id: {user_id: Activity}} for the members seen recently, and
+        # {guild_id: set of user_id} for the ones that changed since they were written
+        self.activity = dict()
+        self.dirty = dict()
+        # {guild_id: RankIndex}, built the first time a guild's ranks are asked for and
+        # then kept up to date as experience is gained
+        self.ranks = dict()
+        # Messages per hour for the stats command
+        self.history = ActivityStore()
+
+        Database.migrations.register(
+            self.name,
+            1,
+            # Create the initial table
+            """CREATE TABLE IF NOT EXISTS levels(
+               user_id TEXT,
+               exp TEXT DEFAULT '0',
+               level TEXT DEFAULT '0',
+               messages TEXT DEFAULT '0',
+               words TEXT DEFAULT '0',
+               lastseen TEXT DEFAULT '0',
+               lastseenurl TEXT DEFAULT NULL,
+               lastexp TEXT DEFAULT NULL,
+               nickname_history TEXT DEFAULT NULL,
+               upvotes TEXT DEFAULT '0',
+               downvotes TEXT DEFAULT '0',
+               PRIMARY KEY("user_id")
+               )""",
+            # Older versions kept the version in the dbVer setting
+            legacy=Migrations.setting_version("levels_settings", "dbVer"),
+        )
+        # Change the name of the table to more accurately reflect it's use
+        Database.migrations.register(self.name, 2, "ALTER TABLE levels RENAME TO users")
+        # Store the numbers as integers and the times as unix timestamps, lastexp was local time.
+        # Consolidated shards share the users table between guilds, so theirs keeps its column types.
+        Database.migrations.register(
+            self.name,
+            3,
+            """CREATE TABLE IF NOT EXISTS users_v3(
+               user_id INTEGER NOT NULL,
+               exp INTEGER NOT NULL DEFAULT 0,
+               level INTEGER NOT NULL DEFAULT 0,
+               messages INTEGER NOT NULL DEFAULT 0,
+               words INTEGER NOT NULL DEFAULT 0,
+               lastseen INTEGER NOT NULL DEFAULT 0,
+               lastseenurl TEXT DEFAULT NULL,
+               lastexp INTEGER DEFAULT NULL,
+               nickname_history TEXT DEFAULT NULL,
+               upvotes INTEGER NOT NULL DEFAULT 0,
+               downvotes INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY(user_id)
+               ) WITHOUT ROWID""",
+            """INSERT OR REPLACE INTO users_v3(
+               user_id, exp, level, messages, words, lastseen, lastseenurl, lastexp, nickname_history, upvotes, downvotes)
+               SELECT CAST(user_id AS INTEGER), CAST(IFNULL(exp, 0) AS INTEGER), CAST(IFNULL(level, 0) AS INTEGER),
+               CAST(IFNULL(messages, 0) AS INTEGER), CAST(IFNULL(words, 0) AS INTEGER),
+               CASE WHEN lastseen LIKE '____-__-__%' THEN IFNULL(CAST(strftime('%s', lastseen) AS INTEGER), 0) ELSE 0 END,
+               lastseenurl,
+               CASE WHEN lastexp LIKE '____-__-__%' THEN CAST(strftime('%s', lastexp, 'utc') AS INTEGER) END,
+               nickname_history, CAST(IFNULL(upvotes, 0) AS INTEGER), CAST(IFNULL(downvotes, 0) AS INTEGER)
+               FROM users""",
+            "DROP TABLE users",
+            "ALTER TABLE users_v3 RENAME TO users",
+            "CREATE INDEX IF NOT EXISTS users_level_exp ON users(level, exp)",
+            "CREATE INDEX IF NOT EXISTS users_lastseen ON users(lastseen)",
+        )
+        Database.migrations.register(
+            self.name,
+            4,
+            # Messages per hour and words per day, see util.activity_store
+            """CREATE TABLE IF NOT EXISTS activity(
+               user_id INTEGER NOT NULL,
+               day INTEGER NOT NULL,
+               messages INTEGER NOT NULL DEFAULT 0,
+               words INTEGER NOT NULL DEFAULT 0,
+               hours BLOB DEFAULT NULL,
+               PRIMARY KEY(user_id, day)
+               ) WITHOUT ROWID""",
+            "CREATE INDEX IF NOT EXISTS activity_day ON activity(day)",
+        )
+        Database.dbMigrate(self)
 
-        current_ver = Database.Cogs[self.name][guild_id]["settings"].get("dbVer", 0)
-        query = list()
+        Database.readSettings(self)
 
-        # Add queries to a list that need to be run
-        if current_ver < 1:
-            # Create the initial table
-            query.append(
-                """
-                   CREATE TABLE IF NOT EXISTS levels(
-                   user_id TEXT,
-                   exp TEXT DEFAULT '0',
-                   level TEXT DEFAULT '0',
-                   messages TEXT DEFAULT '0',
-                   words TEXT DEFAULT '0',
-                   lastseen TEXT DEFAULT '0',
-                   lastseenurl TEXT DEFAULT NULL,
-                   lastexp TEXT DEFAULT NULL,
-                   nickname_history TEXT DEFAULT NULL,
-                   upvotes TEXT DEFAULT '0',
-                   downvotes TEXT DEFAULT '0',
-                   PRIMARY KEY("user_id")
-                   )
-                   """
-            )
-            current_ver = 1
-
-        if current_ver < 2:
-            # Change the name of the table to more accurately reflect it's use
-            query.append("ALTER TABLE levels RENAME TO users")
-            current_ver = 2
-
-        # If there are any queries, execute them.
-        if len(query) > 0:
-            cursor = Database.cursor[guild_id]
-            for each in query:
-                try:
-                    Database.dbExecute(self, cursor, guild_id, each, list(), True)
-                    logger.info(f"Executed: {query}")
-
-                except sqlite3.OperationalError as e:
-                    logger.critical(e)
-
-        # Store the new dbVer and write that back to the cog settings
-        Database.Cogs[self.name][guild_id]["settings"]["dbVer"] = current_ver
-        Database.writeSettings(self, guild_id)
+        # Experience is gained in memory and written every flush_interval seconds
+        self.flush_loop.start()  # pylint: disable=no-member
+        atexit.register(self.flush)
 
     @commands.Cog.listener()
     async def on_ready(self):
         for guild in self.client.guilds:
+            # Guilds deferred by lazy loading are set up when they are loaded
+            if guild.id not in Database.Cogs[self.name]:
+                continue
+
             if not Database.Cogs[self.name][guild.id]["settings"].get("firstRunSetup", 0):
                 await self.first_run_setup(guild)
 
-    def first_run_setup(self, guild):
+    def setup_guild(self, guild_id: int):
+        """Adds the members of a guild loaded after on_ready, if it was never set up"""
+        guild = self.client.get_guild(guild_id)
+        if guild is not None and not Database.Cogs[self.name][guild_id]["settings"].get("firstRunSetup", 0):
+            asyncio.ensure_future(self.first_run_setup(guild))
+
+    async def first_run_setup(self, guild):
         logger.info(f"[levels] Loading existing guild members into database for {guild.id}")
 
-        cursor = Database.cursor[guild.id]
-
-        # Load the members currently in the database
-        query = "SELECT user_id FROM users"
-        db_members = Database.dbExecute(self, cursor, guild.id, query, list(), True)
-
-        # Create a list of members currently in the database
-        db_member_list = list()
-        for member in db_members:
-            db_member_list.append(int(member[0]))
-
-        # Loop through the existing members
-        for member in guild.members:
-            # Check if the guild member is already in the database
-            if member.id not in db_member_list:
-                # Insert the member into the database
-                query = """INSERT OR IGNORE INTO
-                users(user_id, exp, level, words, messages, lastseen, lastseenurl)
-                VALUES(?,?,?,?,?,?,?)"""
-                values = (member.id, 0, 0, 0, 0, 0, None)
-                # We don't need to save the result of this
-                Database.dbExecute(self, cursor, member.guild.id, query, values)
+        # The guild members that aren't in the database yet, in key order so the inserts stay together
+        missing = sorted({member.id for member in guild.members} - await Users.ids_async(self, guild.id))
+
+        # Inserted in chunks in one transaction on the guild's worker, so the event loop isn't held up,
+        # and nothing is kept if it fails
+        added = await Users.add_many_async(self, guild.id, missing, levels_settings["setup_chunk"])
+
+        logger.info(f"[levels] Added {added} members for {guild.id}")
 
         Database.Cogs[self.name][guild.id]["settings"]["firstRunSetup"] = 1
         Database.writeSettings(self, guild.id)
@@ -119,8 +186,7 @@ class Levels(commands.Cog):
     async def on_guild_join(self, guild):
         """Create all of the users after joining the guild"""
         Database.readSettingsGuild(self, guild.id)
-        self.db_setup(guild.id)
-        self.first_run_setup(guild)
+        await self.first_run_setup(guild)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
@@ -128,15 +194,16 @@ class Levels(commands.Cog):
         Insert the newly joined member into the levels table
         """
 
-        cursor = Database.cursor[member.guild.id]
-
         # Insert the member into the database
-        query = """INSERT OR IGNORE INTO
-        users(user_id, exp, level, words, messages, lastseen, lastseenurl)
-        VALUES(?,?,?,?,?,?,?)"""
-        values = (member.id, 0, 0, 0, 0, 0, None)
-        # We don't need to save the result of this
-        Database.dbExecute(self, cursor, member.guild.id, query, values)
+        await Users.add_async(self, member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        """Write what is in memory before Database archives the guild"""
+        self.flush_guild(guild.id)
+        self.activity.pop(guild.id, None)
+        self.ranks.pop(guild.id, None)
+        self.history.remove_guild(guild.id)
 
     def buildUserTable(self, guild_id):
         pass
@@ -155,6 +222,7 @@ class Levels(commands.Cog):
         If name#discriminator has a space, wrap it in quotes.
 
         This is useful when migrating from another bot such as MEE6.
+        To migrate every member at once, use importlevels.
 
         Default Permissions: Guild Administrator only
         """
@@ -172,21 +240,35 @@ class Levels(commands.Cog):
 
         if len(mentions) > 0:
             # Database handle
-            cursor = Database.cursor[ctx.guild.id]
 
             for each in mentions:
-                # Get the users current level
-                query = "SELECT exp, level FROM users where user_id = ?"
-                vals = (each.id,)
-                result = Database.dbExecute(self, cursor, ctx.guild.id, query, vals)
+                activity = self.activity.get(ctx.guild.id, dict()).get(each.id)
+                if activity is not None:
+                    # Set it in memory, it is written with the next flush
+                    previousLevel = activity.level
+                    activity.level = level
+                    self.dirty.setdefault(ctx.guild.id, set()).add(each.id)
 
-                exp = int(result[0])
-                previousLevel = int(result[1])
+                else:
+                    # Get the users current level
+                    result = await Users.get_level_async(self, ctx.guild.id, each.id)
+
+                    exp = result.exp
+                    previousLevel = result.level
+
+                    # Set the new level in the Database
+                    await Users.set_level_async(self, ctx.guild.id, each.id, exp, level)
+
+                    # A message could have read them into memory while this was waiting, the next flush
+                    # would write the old level back
+                    activity = self.activity.get(ctx.guild.id, dict()).get(each.id)
+                    if activity is not None:
+                        activity.level = level
+                        self.dirty.setdefault(ctx.guild.id, set()).add(each.id)
 
-                # Set the new level in the Database
-                query = "UPDATE users SET exp = ?, level = ? WHERE user_id = ?"
-                values = (exp, level, each.id)
-                result = Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+                if ctx.guild.id in self.ranks:
+                    exp = activity.exp if activity is not None else exp
+                    self.ranks[ctx.guild.id].update(each.id, level, exp)
 
                 # Output to the calling user
                 if previousLevel <= level:
@@ -199,6 +281,69 @@ class Levels(commands.Cog):
 
                 await ctx.send(output)
 
+    @commands.command()
+    @commands.guild_only()
+    @Permissions.check()
+    async def importlevels(self, ctx):
+        """
+        Imports levels exported from another bot.
+
+        Attach the exported file to the command, either a CSV file
+        with user_id and xp columns, or a JSON file of
+        [{"id": ..., "xp": ...}] or MEE6's {"players": [...]}.
+        xp is the member's total experience, their level is worked
+        out from it. Members in the file replace their current level.
+
+        Default Permissions: Guild Administrator only
+        """
+
+        # If the bot is sleeping, don't do anything.
+        if Database.Bot["sleeping"]:
+            return
+
+        if len(ctx.message.attachments) == 0:
+            await ctx.send("Attach the exported file to the command.")
+            return
+
+        attachment = ctx.message.attachments[0]
+        data = await attachment.read()
+
+        # Large exports take a moment to read, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            members, skipped = await loop.run_in_executor(None, level_import.read, data, attachment.filename)
+        except ValueError as e:
+            await ctx.send(f"Unable to read {attachment.filename}: {e}")
+            return
+
+        if not members:
+            await ctx.send(f"There are no members in {attachment.filename}.")
+            return
+
+        user_ids = list(members)
+        levels = await loop.run_in_executor(None, level_import.levels, list(members.values()))
+
+        await Users.set_levels_async(
+            self, ctx.guild.id, [(exp, level, user_id) for user_id, (level, exp) in zip(user_ids, levels)]
+        )
+
+        # The members in memory take the imported levels, so the next flush doesn't write over them
+        activity = self.activity.get(ctx.guild.id, dict())
+        for user_id, (level, exp) in zip(user_ids, levels):
+            if user_id in activity:
+                activity[user_id].level = level
+                activity[user_id].exp = exp
+                self.dirty.setdefault(ctx.guild.id, set()).add(user_id)
+
+        # Built again the next time it is needed
+        self.ranks.pop(ctx.guild.id, None)
+
+        output = f"Imported {len(members)} members from {attachment.filename}, the highest is level {max(levels)[0]}."
+        if skipped:
+            output += f" {skipped} rows couldn't be read and were skipped."
+
+        await ctx.send(output)
+
     @commands.command()
     @commands.guild_only()
     @Permissions.check(role="everyone")
@@ -237,17 +382,23 @@ class Levels(commands.Cog):
                 mentions.append(await commands.MemberConverter().convert(ctx, member))
 
         if len(mentions) > 0:
-            # Database handle
-            cursor = Database.cursor[ctx.author.guild.id]
+            ranks = await self.rank_index(ctx.guild.id)
 
             for each in mentions:
 
-                query = (
-                    "SELECT exp, level, words, messages, lastseen, lastseenurl, upvotes, downvotes "
-                    "FROM users where user_id = ?"
-                )
-                vals = (each.id,)
-                result = Database.dbExecute(self, cursor, ctx.guild.id, query, vals)
+                result = await Users.get_stats_async(self, ctx.guild.id, each.id)
+
+                # What hasn't been written yet
+                activity = self.activity.get(ctx.guild.id, dict()).get(each.id)
+                if result is not None and activity is not None and activity.lastseen is not None:
+                    result = result._replace(
+                        exp=activity.exp,
+                        level=activity.level,
+                        words=activity.words,
+                        messages=activity.messages,
+                        lastseen=activity.lastseen,
+                        lastseenurl=activity.lastseenurl,
+                    )
 
                 # Set the display name if they have one set, otherwise use the account name.
                 displayName = each.display_name
@@ -259,19 +410,124 @@ class Levels(commands.Cog):
                     embed.add_field(name="Lurker?", value=f"{displayName} hasn't been seen.")
 
                 else:
-                    embed.add_field(name="Level", value=f"{result[1]}")
-                    embed.add_field(name="Experience", value=f"{result[0]}")
-                    embed.add_field(name="Words spoken", value=f"{result[2]}")
-                    embed.add_field(name="Messages sent", value=f"{result[3]}")
-                    embed.add_field(name="Last seen", value=f"[{result[4]}]({result[5]})")
+                    embed.add_field(name="Level", value=f"{result.level}")
+                    embed.add_field(name="Experience", value=f"{result.exp}")
+                    rank = ranks.rank(each.id)
+                    if rank is not None:
+                        embed.add_field(name="Rank", value=f"{rank} of {len(ranks)}")
+                    embed.add_field(name="Words spoken", value=f"{result.words}")
+                    embed.add_field(name="Messages sent", value=f"{result.messages}")
+                    lastseen = datetime.datetime.utcfromtimestamp(result.lastseen) if result.lastseen else "Never"
+                    embed.add_field(name="Last seen", value=f"[{lastseen}]({result.lastseenurl})")
                     if Database.Cogs["karma"][ctx.guild.id]["settings"]["enabled"]:
                         embed.add_field(
                             name="Karma",
-                            value=f"Upvotes: {result[6]} \r\nDownvotes: {result[7]}",
+                            value=f"Upvotes: {result.upvotes} \r\nDownvotes: {result.downvotes}",
                         )
 
             await ctx.send(content=None, embed=embed)
 
+    @commands.command()
+    @commands.guild_only()
+    @Permissions.check(role="everyone")
+    async def leaderboard(self, ctx, page: int = 1):
+        """
+        Display the highest levels in the guild.
+
+        Shows 10 members per page, highest level first.
+        Members with the same level are ranked by their experience.
+
+        Default Permissions: Everyone role
+        """
+        per_page = 10
+
+        ranks = await self.rank_index(ctx.guild.id)
+        pages = max(1, -(-len(ranks) // per_page))
+        page = min(max(page, 1), pages)
+
+        lines = list()
+        for rank, user_id, level, exp in ranks.page((page - 1) * per_page, per_page):
+            member = ctx.guild.get_member(user_id)
+            name = member.display_name if member is not None else f"<@{user_id}>"
+            lines.append(f"**{rank}.** {name} - Level {level}, {exp} exp")
+
+        embed = discord.Embed(title=f"Leaderboard for {ctx.guild.name}")
+        embed.description = "\n".join(lines) if lines else "Nobody has any experience yet."
+        embed.set_footer(text=f"Page {page} of {pages}")
+
+        await ctx.send(content=None, embed=embed)
+
+    async def rank_index(self, guild_id: int):
+        """Returns the guild's RankIndex, reading it from the database the first time"""
+        ranks = self.ranks.get(guild_id)
+        if ranks is not None:
+            return ranks
+
+        scores = await Users.scores_async(self, guild_id)
+
+        # Sorting a large guild takes a moment, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        ranks = await loop.run_in_executor(None, RankIndex, scores)
+
+        # The members in memory are ahead of the database
+        for user_id, activity in self.activity.get(guild_id, dict()).items():
+            ranks.update(user_id, activity.level, activity.exp)
+
+        # Another command could have built it while this one was waiting
+        return self.ranks.setdefault(guild_id, ranks)
+
+    @commands.command()
+    @commands.guild_only()
+    @Permissions.check(role="everyone")
+    async def stats(self, ctx, member: discord.Member = None):
+        """
+        Display how active the guild or a member has been.
+
+        Shows the messages sent each day for the last 30 days,
+        and the hours of the day, in UTC, they were sent in.
+        Leave out the member to see the whole guild.
+
+        Default Permissions: Everyone role
+        """
+        days = 30
+        first_day = activity_store.day_of(int(time.time())) - days + 1
+
+        # Write what is in memory so today is counted
+        await self.write_history(ctx.guild.id)
+
+        if member is None:
+            day_rows, hours = await ActivityHistory.guild_async(self, ctx.guild.id, first_day)
+            title = f"Activity in {ctx.guild.name}"
+
+        else:
+            rows = await ActivityHistory.user_async(self, ctx.guild.id, member.id, first_day)
+            day_rows = [(day, messages, words) for day, messages, words, _ in rows]
+            hours = [row[3] for row in rows]
+            title = f"Activity of {member.display_name}"
+
+        daily = activity_store.daily([(int(day), int(messages)) for day, messages, _ in day_rows], first_day, days)
+        hourly = activity_store.sum_hours(hours)
+
+        embed = discord.Embed(title=title)
+        embed.add_field(name=f"Messages, last {days} days", value=f"{sum(daily)}")
+        embed.add_field(name="Words", value=f"{sum(int(row[2]) for row in day_rows)}")
+
+        busiest = max(range(days), key=lambda day: daily[day])
+        if daily[busiest]:
+            date = datetime.date(1970, 1, 1) + datetime.timedelta(days=first_day + busiest)
+            embed.add_field(name="Busiest day", value=f"{date} with {daily[busiest]} messages")
+
+        top_hours = [hour for hour in sorted(range(24), key=lambda hour: hourly[hour], reverse=True)[:3] if hourly[hour]]
+        embed.add_field(
+            name="Most active hours (UTC)",
+            value=", ".join(f"{hour:02}:00" for hour in top_hours) or "None yet",
+            inline=False,
+        )
+        embed.add_field(name="Messages per day", value=f"`{activity_store.sparkline(daily)}`", inline=False)
+        embed.add_field(name="Messages per hour (UTC)", value=f"`{activity_store.sparkline(hourly)}`", inline=False)
+
+        await ctx.send(content=None, embed=embed)
+
     @commands.Cog.listener()
     async def on_message(self, message):
         # Guard Clause
@@ -287,60 +543,142 @@ class Levels(commands.Cog):
         # How many words are in the message
         wordCount = self.countWords(message)
 
-        # Database handle
-        cursor = Database.cursor[message.author.guild.id]
+        guild_id = message.guild.id
+        user_id = message.author.id
+
+        # What is the current experience, read from the database once and then kept in memory
+        activity = self.activity.get(guild_id, dict()).get(user_id)
+        if activity is None:
+            activity = await self.load_activity(guild_id, user_id)
+
+        activity.words += wordCount
+        activity.messages += 1
+
+        # Check if it has been at least 60 seconds since last message
+        now = int(time.time())
+        if now - activity.lastexp > 60:
+            # Add experience and increase level if needed
+            activity.exp, activity.level = self.gainExperience(activity.exp, activity.level, wordCount)
+            activity.lastexp = now
+
+            if guild_id in self.ranks:
+                self.ranks[guild_id].update(user_id, activity.level, activity.exp)
+
+        # created_at is in UTC
+        activity.lastseen = int(message.created_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+        activity.lastseenurl = message.jump_url
+        activity.touched = time.monotonic()
+
+        # Written by flush_loop
+        self.dirty.setdefault(guild_id, set()).add(user_id)
 
-        # What is the current experience.
-        query = "SELECT exp, level, words, messages, lastexp FROM users WHERE user_id = ?"
-        values = (message.author.id,)
-        result = Database.dbExecute(self, cursor, message.guild.id, query, values)
+        # Counted in the hour it was read in, so a late message can't take the day backwards
+        day = activity_store.day_of(now)
+        if not self.history.is_loaded(guild_id, day):
+            await self.load_history(guild_id, day)
+
+        self.history.record(guild_id, user_id, now, wordCount)
+
+    async def load_activity(self, guild_id: int, user_id: int):
+        """Reads the member's levels into memory, inserting them if they aren't in the database"""
+        result = await Users.get_level_async(self, guild_id, user_id)
 
         # If they aren't in the database result = None, Insert the user
         if result is None:
+            await Users.add_async(self, guild_id, user_id)
+            result = UserLevel(0, 0, 0, 0, None)
 
-            query = "INSERT INTO users(user_id, exp, level, words, messages, lastseen, lastseenurl) VALUES(?,?,?,?,?,?,?)"
-            values = (message.author.id, 0, 0, 0, 0, 0, None)
-            # We don't need to save the result of this
-            Database.dbExecute(self, cursor, message.guild.id, query, values)
-            # Lets set some default values
-            # using str(datetime.datetime.now()) because that is how it's read from the database
-            result = [0, 0, wordCount, 1, str(datetime.datetime.now())]
-
-        # The if statements take care of blank fields in the database by giving a default value
-        # Blank responses shouldn't happen unless they are a new user
-        exp = int(result[0]) if result[0] is not None else 0
-        level = int(result[1]) if result[1] is not None else 0
-        words = int(result[2]) + wordCount if result[2] is not None else wordCount
-        messages = int(result[3]) + 1 if result[3] is not None else 1
-        lastexp = result[4] if result[4] is not None else str(datetime.datetime.now())
-
-        # Convert time from database to a datetime object
-        t_format = "%Y-%m-%d %H:%M:%S.%f"
-        lastexp = datetime.datetime.strptime(lastexp, t_format)
+        # Another message from them could have been read in while this one was waiting
+        activity = self.activity.setdefault(guild_id, dict()).setdefault(user_id, Activity(result))
 
-        # Check if it has been at least 60 seconds since last message
-        timeSince = datetime.datetime.now() - lastexp
-        if timeSince.seconds > 60:
-            # Add experience and increase level if needed
-            exp, level = self.gainExperience(exp, level, wordCount)
-            lastexp = datetime.datetime.now()
+        if guild_id in self.ranks:
+            self.ranks[guild_id].update(user_id, activity.level, activity.exp)
 
-        # Update to their new values
-        query = (
-            "UPDATE users SET exp = ?, level = ?, words = ?, messages = ?, "
-            "lastseen = ?, lastseenurl = ?, lastexp = ? WHERE user_id = ?"
-        )
-        values = (
-            exp,
-            level,
-            words,
-            messages,
-            message.created_at,
-            message.jump_url,
-            lastexp,
-            message.author.id,
-        )
-        result = Database.dbExecute(self, cursor, message.guild.id, query, values)
+        return activity
+
+    async def load_history(self, guild_id: int, day: int):
+        """Starts the guild's activity for the day, with what was already written for it"""
+        rows = await ActivityHistory.day_async(self, guild_id, day)
+
+        # Another message could have started the day while this one was waiting
+        if not self.history.start_day(guild_id, day, rows):
+            return
+
+        # Once a day, write what is left of the previous day and drop the hours and then
+        # the days that are too old to keep, in one transaction
+        rows = self.history.dirty_rows(guild_id)
+        hourly_from = day - levels_settings["history_hourly_days"]
+        keep_from = day - levels_settings["history_days"]
+
+        try:
+            await ActivityHistory.downsample_async(self, guild_id, rows, hourly_from, keep_from)
+
+        except sqlite3.Error:
+            # Written with the next flush, and downsampled tomorrow
+            self.history.mark_dirty(guild_id, rows)
+
+    async def write_history(self, guild_id: int):
+        rows = self.history.dirty_rows(guild_id)
+        if not rows:
+            return
+
+        try:
+            await ActivityHistory.write_async(self, guild_id, rows)
+
+        except sqlite3.Error:
+            # Try again with the next flush, dbExecute has logged the error
+            self.history.mark_dirty(guild_id, rows)
+
+    def dirty_rows(self, guild_id: int):
+        """Returns [UserActivity] for the guild's members that changed, and marks them clean"""
+        user_ids = self.dirty.pop(guild_id, set())
+        activity = self.activity.get(guild_id, dict())
+        return [activity[user_id].row(user_id) for user_id in user_ids if user_id in activity]
+
+    @tasks.loop(seconds=levels_settings["flush_interval"])
+    async def flush_loop(self):
+        for guild_id in list(self.dirty):
+            rows = self.dirty_rows(guild_id)
+            if not rows:
+                continue
+
+            try:
+                await Users.set_activity_many_async(self, guild_id, rows)
+
+            except sqlite3.Error:
+                # Try again with the next flush, dbExecute has logged the error
+                self.dirty.setdefault(guild_id, set()).update(row.user_id for row in rows)
+
+        for guild_id in self.history.guilds():
+            await self.write_history(guild_id)
+
+        # Forget the members that haven't been seen for a while, they are read again on their next message
+        idle = time.monotonic() - levels_settings["idle"]
+        for guild_id, activity in list(self.activity.items()):
+            dirty = self.dirty.get(guild_id, set())
+            for user_id in [user_id for user_id, each in activity.items() if each.touched < idle and user_id not in dirty]:
+                del activity[user_id]
+
+    def flush_guild(self, guild_id: int):
+        """Writes the guild's changed members now, on the calling thread"""
+        rows = self.dirty_rows(guild_id)
+        if rows:
+            Users.set_activity_many(self, guild_id, rows)
+
+        rows = self.history.dirty_rows(guild_id)
+        if rows:
+            ActivityHistory.write(self, guild_id, rows)
+
+    def reset_guild(self, guild_id: int):
+        """Forgets the guild without writing it, called by Database before the guild's database is replaced"""
+        self.activity.pop(guild_id, None)
+        self.dirty.pop(guild_id, None)
+        self.ranks.pop(guild_id, None)
+        self.history.remove_guild(guild_id)
+
+    def flush(self):
+        for guild_id in set(self.dirty) | set(self.history.guilds()):
+            self.flush_guild(guild_id)
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
@@ -352,18 +690,9 @@ class Levels(commands.Cog):
         if before.nick == after.nick:  # nickname wasn't changed
             return
 
-        # database query
-        cursor = Database.cursor[before.guild.id]
-        query = "SELECT nickname_history FROM users WHERE user_id = ?"
-        values = (before.id,)
-        query_result = Database.dbExecute(self, cursor, before.guild.id, query, values)
-
-        # Create our nickname_history list, either from the query or blank if no results
-        if query_result[0] is not None:
-            # Extract just the first row, as there is only one
-            nickname_history = json.loads(query_result[0])
-        else:
-            # Create an empty list
+        # Create our nickname_history list, either from the database or blank if there isn't one
+        nickname_history = await Users.get_nickname_history_async(self, before.guild.id, before.id)
+        if nickname_history is None:
             nickname_history = list()
 
         # Save for comparison later
@@ -384,10 +713,7 @@ class Levels(commands.Cog):
 
         if nickname_original != nickname_history:
             # Write back to the database if any changes were made
-            new_history = json.dumps(nickname_history)
-            query = "UPDATE users SET nickname_history = ? WHERE user_id = ?"
-            values = (new_history, before.id)
-            Database.dbExecute(self, cursor, before.guild.id, query, values)
+            await Users.set_nickname_history_async(self, before.guild.id, before.id, nickname_history)
 
     def countWords(self, message):
         """
@@ -442,11 +768,17 @@ class Levels(commands.Cog):
         return (exp, level)
 
     @setlevel.error
+    @importlevels.error
     @level.error
+    @leaderboard.error
+    @stats.error
     async def _error(self, ctx, error):
         await Utils.errors(self, ctx, error)
 
     def cog_unload(self):
+        self.flush_loop.cancel()  # pylint: disable=no-member
+        self.flush()
+        atexit.unregister(self.flush)
         logger.info(f"{__name__} unloaded...")
 
 
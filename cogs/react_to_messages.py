@@ -4,16 +4,16 @@ Discord Bot for HardwareFlare and others
 @author: Tisboyo
 """
 import datetime
-import json
 import logging
 import random
-import sqlite3
 
 import discord
 from discord.ext import commands
 
 from util.database import Database
 from util.permissions import Permissions
+from util.repositories import ReactToMessageUser
+from util.repositories import ReactToMessageUsers
 from util.utils import dotdict
 from util.utils import Utils
 
@@ -40,38 +40,29 @@ class ReactToMessages(commands.Cog):
         self.client = client
         self.name = "react_to_message"
 
+        Database.migrations.register(
+            self.name,
+            1,
+            f"""CREATE TABLE IF NOT EXISTS {self.name}_users(
+                user_id INTEGER, emojis TEXT, frequency INTEGER,
+                PRIMARY KEY("user_id") )""",
+        )
+        Database.dbMigrate(self)
+
         Database.readSettings(self)
 
         for guild_id in Database.Main:
-            # Storage for user data
-            Database.Cogs[self.name][guild_id]["users"] = dict()
-
-            self.setup_database(guild_id)
-
-    def setup_database(self, guild_id):
-
-        cursor = Database.cursor[guild_id]
+            self.setup_guild(guild_id)
 
-        # Check if users table exists, if not create it.
-        try:
-            query = f"SELECT * FROM {self.name}_users LIMIT 1"
-            Database.dbExecute(self, cursor, guild_id, query)
-        except sqlite3.OperationalError as e:
-            # The table doesn't exist, so we're going to create it and re-run the query.
-            if "no such table" in e.args[0]:
-                insert_query = f"""CREATE TABLE IF NOT EXISTS {self.name}_users(
-									user_id INTEGER, emojis TEXT, frequency INTEGER,
-									PRIMARY KEY("user_id") )"""
-                Database.dbExecute(self, cursor, guild_id, insert_query)
-                logger.info(f"{self.name}_users table created for {guild_id}.")
-
-                Database.dbExecute(self, cursor, guild_id, query)
+    def setup_guild(self, guild_id):
+        # Storage for user data
+        Database.Cogs[self.name][guild_id]["users"] = dict()
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         # Have to reload Database.Cogs when joining a new guild to prevent errors.
         Database.readSettingsGuild(self, guild.id)
-        self.setup_database(guild.id)
+        self.setup_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
@@ -161,16 +152,13 @@ class ReactToMessages(commands.Cog):
         if now - last_query > ReactToMessages.user_query_frequency:
 
             # Query the database for the users settings
-            cursor = Database.cursor[member.guild.id]
 
-            query = f"SELECT user_id, emojis, frequency FROM {self.name}_users WHERE user_id = ?"
-            values = (member.id,)
-            result = Database.dbExecute(self, cursor, member.guild.id, query, values)
+            result = ReactToMessageUsers.get(self, member.guild.id, member.id)
 
             if result is not None:
                 # Store the results
-                Database.Cogs[self.name][member.guild.id]["users"][member.id]["emojis"] = json.loads(result[1])
-                Database.Cogs[self.name][member.guild.id]["users"][member.id]["frequency"] = int(result[2])
+                Database.Cogs[self.name][member.guild.id]["users"][member.id]["emojis"] = result.emojis
+                Database.Cogs[self.name][member.guild.id]["users"][member.id]["frequency"] = result.frequency
                 Database.Cogs[self.name][member.guild.id]["users"][member.id]["lastquery"] = datetime.datetime.utcnow()
                 logger.debug(f"Member {member.id}-{member} retrieved from {self.name}_users")
 
@@ -194,24 +182,16 @@ class ReactToMessages(commands.Cog):
             logger.error("ReactToMessages.write_user_data called before a user was read.")
             return
 
-        # Shorter names to use in queries
-        emojis = json.dumps(
+        user = ReactToMessageUser(
+            member.id,
             Database.Cogs[self.name][member.guild.id]["users"][member.id]["emojis"],
-            ensure_ascii=False,
+            Database.Cogs[self.name][member.guild.id]["users"][member.id].get("frequency", 10),
         )
-        frequency = Database.Cogs[self.name][member.guild.id]["users"][member.id].get("frequency", 10)
-
-        cursor = Database.cursor[member.guild.id]
 
-        query = f"UPDATE {self.name}_users SET emojis = ?, frequency = ? WHERE user_id = ?"
-        values = (emojis, frequency, member.id)
-        _, rows = Database.dbExecute(self, cursor, member.guild.id, query, values, False, True)
-        logger.debug(f"Member {member.id}-{member} updated in {self.name}_users")
-
-        if rows == 0:
-            # User wasn't in the database, we need to insert them.
-            query = f"INSERT INTO {self.name}_users (emojis, frequency, user_id) VALUES (?, ?, ?) "
-            Database.dbExecute(self, cursor, member.guild.id, query, values)
+        # Inserts the user if they weren't in the database
+        if ReactToMessageUsers.set(self, member.guild.id, user):
+            logger.debug(f"Member {member.id}-{member} updated in {self.name}_users")
+        else:
             logger.debug(f"Member {member.id}-{member} inserted into {self.name}_users")
 
     @react_to_messages.command()
@@ -5,7 +5,6 @@ Discord Bot for HardwareFlare and others
 """
 import asyncio
 import logging
-import sqlite3
 import time
 
 import discord
@@ -13,6 +12,8 @@ from discord.ext import commands
 
 from util.database import Database
 from util.permissions import Permissions
+from util.repositories import ReactionRole
+from util.repositories import ReactionRolesValues
 from util.utils import Utils
 
 logger = logging.getLogger(__name__)
@@ -23,48 +24,42 @@ class ReactionRoles(commands.Cog):
         self.client = client
         self.name = "reaction_roles"
 
+        Database.migrations.register(
+            self.name,
+            1,
+            f"""CREATE TABLE IF NOT EXISTS {self.name}_values(
+                emoji TEXT, role TEXT, description TEXT,
+                PRIMARY KEY(role) )""",
+        )
+        Database.dbMigrate(self)
+
         Database.readSettings(self)
 
         for guild_id in Database.Main:
+            self.setup_guild(guild_id)
+
+    def setup_guild(self, guild_id):
 
-            Database.Cogs[self.name][guild_id]["list"] = dict()
+        Database.Cogs[self.name][guild_id]["list"] = dict()
 
-            # Used for tracking when the user last clicked on a reaction, and
-            # the last time a DM was sent to the user asking them to slow down.
-            Database.Cogs[self.name][guild_id]["anti_spam"] = dict()
-            Database.Cogs[self.name][guild_id]["anti_spam_message"] = dict()
+        # Used for tracking when the user last clicked on a reaction, and
+        # the last time a DM was sent to the user asking them to slow down.
+        Database.Cogs[self.name][guild_id]["anti_spam"] = dict()
+        Database.Cogs[self.name][guild_id]["anti_spam_message"] = dict()
 
-            self.setup_database(guild_id)
+        self.setup_database(guild_id)
 
     def setup_database(self, guild_id):
 
-        cursor = Database.cursor[guild_id]
         handle = Database.Cogs[self.name][guild_id]
 
         # Read the lists
-        query = "SELECT emoji, role, description FROM reaction_roles_values"
-
-        try:
-            result = Database.dbExecute(self, cursor, guild_id, query, list(), True, hide_error=True)
-            settingNum = 0
-            for each_result in result:
-                handle["list"][each_result[0]] = [
-                    each_result[1],
-                    each_result[2],
-                ]
-                settingNum += 1
-            logger.debug("Reaction role values loaded.")
-
-        except sqlite3.OperationalError as e:
-            # The table doesn't exist, so we're going to create it and re-run the query.
-            if "no such table" in e.args[0]:
-                insert_query = f"""CREATE TABLE IF NOT EXISTS {self.name}_values(
-                                    emoji TEXT, role TEXT, description TEXT,
-                                    PRIMARY KEY(role) )"""
-                Database.dbExecute(self, cursor, guild_id, insert_query)
-                logger.info(f"{self.name}_values table created for {guild_id}.")
-
-                Database.dbExecute(self, cursor, guild_id, query)
+        for each_result in ReactionRolesValues.all(self, guild_id):
+            handle["list"][each_result.emoji] = [
+                each_result.role,
+                each_result.description,
+            ]
+        logger.debug("Reaction role values loaded.")
 
         if not handle["settings"].get("role_channel", False):
             handle["settings"]["role_channel"] = None
@@ -78,7 +73,7 @@ class ReactionRoles(commands.Cog):
     async def on_guild_join(self, guild):
         # Have to reload Database.Cogs when joining a new guild to prevent errors.
         Database.readSettingsGuild(self, guild.id)
-        self.setup_database(guild.id)
+        self.setup_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
@@ -226,10 +221,7 @@ class ReactionRoles(commands.Cog):
             ]
 
             # Add to database
-            cursor = Database.cursor[ctx.guild.id]
-            query = "INSERT INTO reaction_roles_values (emoji, role, description) VALUES (?, ?, ?)"
-            values = emoji, str(role.id), str(message)
-            Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+            ReactionRolesValues.add(self, ctx.guild.id, ReactionRole(emoji, str(role.id), str(message)))
 
             await Utils.send_confirmation(self, ctx.message)
 
@@ -272,12 +264,9 @@ class ReactionRoles(commands.Cog):
 
         # Check to make sure the role and emoji match
         if Database.Cogs[self.name][ctx.guild.id]["list"][emoji][0] == str(role.id):
-            cursor = Database.cursor[ctx.guild.id]
             # Normally would limit this to 1, however if there is more then
             # one entry matching the emoji, they all need removed.
-            query = "DELETE FROM reaction_roles_values WHERE emoji = ?"
-            values = (emoji,)
-            Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+            ReactionRolesValues.remove(self, ctx.guild.id, emoji)
 
             # Remove the emoji from the dictionary
             del Database.Cogs[self.name][ctx.guild.id]["list"][emoji]
@@ -24,10 +24,8 @@ from util.utils import Utils
 
 logger = logging.getLogger(__name__)
 
-# TODO Add ability for individuals to be marked as owner of a channel, so they can set other parameters
+# TODO Let the owner of a channel, kept in the global database's twitch_owners table, set other parameters
 # such as image, notification text (stripping out mentions if guild owner disables)
-# needs to be done once a global database is established instead of individual databases for each guild
-# so the settings can be global.
 
 
 class Twitch(commands.Cog):
@@ -51,39 +49,59 @@ class Twitch(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         for guild_id in Database.Main:
-            settings = Database.Cogs[self.name][guild_id]["settings"].get("streamers", None)
+            self.setup_guild(guild_id)
 
-            Database.Cogs[self.name][guild_id]["streamers"] = dict()
-            streamers = Database.Cogs[self.name][guild_id]["streamers"]
+        # Let the rest of the bot know we're ready.
+        Twitch.ready = True
 
-            if settings:
-                streamers = json.loads(settings)
+    def setup_guild(self, guild_id):
+        settings = Database.Cogs[self.name][guild_id]["settings"].get("streamers", None)
 
-                for streamer, channel_id in streamers.items():
-                    if not Twitch.streamers.get(streamer, False):
-                        Twitch.streamers[streamer] = dict()
-                        Twitch.streamers[streamer]["started_at"] = None
-                        Twitch.streamers[streamer]["channels"] = set()
+        Database.Cogs[self.name][guild_id]["streamers"] = dict()
+        streamers = Database.Cogs[self.name][guild_id]["streamers"]
 
-                    # Get a discord.TextChannel object
-                    # Considered adding a delay, but this isn't an API call so it shouldn't matter
-                    channel = self.client.get_channel(channel_id)
+        if settings:
+            streamers = json.loads(settings)
 
-                    # Add to the global streamers notification
-                    # Stores discord.TextChannel objects
-                    Twitch.streamers[streamer]["channels"].add(channel)
+            for streamer, channel_id in streamers.items():
+                if not Twitch.streamers.get(streamer, False):
+                    Twitch.streamers[streamer] = dict()
+                    Twitch.streamers[streamer]["started_at"] = None
+                    Twitch.streamers[streamer]["channels"] = set()
 
-                    # Add to the guild list of streamers
-                    # Stores an integer of the TextChannel ID
-                    Database.Cogs[self.name][guild_id]["streamers"][streamer] = channel_id
+                # Get a discord.TextChannel object
+                # Considered adding a delay, but this isn't an API call so it shouldn't matter
+                channel = self.client.get_channel(channel_id)
 
-        # Let the rest of the bot know we're ready.
-        Twitch.ready = True
+                # Add to the global streamers notification
+                # Stores discord.TextChannel objects
+                Twitch.streamers[streamer]["channels"].add(channel)
+
+                # Add to the guild list of streamers
+                # Stores an integer of the TextChannel ID
+                Database.Cogs[self.name][guild_id]["streamers"][streamer] = channel_id
+
+    def reset_guild(self, guild_id):
+        """Stops posting the guild's streamers, setup_guild adds them back from its settings"""
+        streamers = Database.Cogs[self.name].get(guild_id, dict()).get("streamers", dict())
+
+        for streamer, channel_id in streamers.items():
+            if not Twitch.streamers.get(streamer, False):
+                continue
+
+            Twitch.streamers[streamer]["channels"].discard(self.client.get_channel(channel_id))
+
+            # If we aren't monitoring for any channels, delete the streamer completely
+            if len(Twitch.streamers[streamer]["channels"]) == 0:
+                del Twitch.streamers[streamer]
+
+        streamers.clear()
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         # Have to reload Database.Cogs when joining a new guild to prevent errors.
         Database.readSettingsGuild(self, guild.id)
+        self.setup_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
@@ -212,12 +230,20 @@ class Twitch(commands.Cog):
         await ctx.send(embed=embed)
 
     @twitch.command()
+    @commands.guild_only()
     @Permissions.check()
     async def owner(self, ctx, streamer: str, owner: discord.Member):
         """
-        Associates a discord member as owner of a twitch channel
+        Associates a discord member as owner of a twitch channel in this server
+
+                Default Permissions: Guild Administrator only
         """
-        pass
+        # Owners are kept per guild, so a guild can only change the owner it set
+        query = "INSERT OR REPLACE INTO twitch_owners(streamer, guild_id, user_id) VALUES (?, ?, ?)"
+        values = (streamer.lower(), ctx.guild.id, owner.id)
+        await Database.dbGlobalExecuteAsync(self, query, values)
+
+        await ctx.message.add_reaction(Dictionary.check_box)
 
     @twitch.error
     @add.error
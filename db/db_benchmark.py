@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Times the levels, karma and permissions hot paths against a storage backend.
+Runs in a temporary directory, the bot's ./db is never touched.
+
+The tables are created by the Levels, Karma and Permissions migrations and every query goes
+through util.repositories and Database, the same calls the cogs make, so the numbers follow
+changes to them.
+
+    python db/db_benchmark.py --storage memory --guilds 10 --users 1000 --queries 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Run from the repository root so util, cogs and keys can be imported
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+parser = argparse.ArgumentParser(description="Benchmark the database hot paths")
+parser.add_argument("--storage", default="memory", choices=["memory", "guild", "consolidated"])
+parser.add_argument("--guilds", type=int, default=10)
+parser.add_argument("--users", type=int, default=1000)
+parser.add_argument("--queries", type=int, default=20000)
+args = parser.parse_args()
+
+os.environ["database_storage"] = args.storage
+os.chdir(tempfile.mkdtemp(prefix="db_benchmark-"))
+os.makedirs("db/shards")
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+
+client = commands.Bot(command_prefix=".", intents=discord.Intents.default())
+client.load_extension("util.database")
+
+from util.database import Database  # noqa: E402
+from util.database import SettingsTable  # noqa: E402
+from util.repositories import UserActivity  # noqa: E402
+from util.repositories import UserKarma  # noqa: E402
+from util.repositories import Users  # noqa: E402
+
+database = client.get_cog("Database")
+guild_ids = [100000000000000000 + guild for guild in range(args.guilds)]
+user_ids = [200000000000000000 + user for user in range(args.users)]
+
+# The guilds are loaded first, so the cogs migrate them and read their settings when they load.
+# Levels creates the users table that Karma copies from, so it is loaded before it.
+for guild_id in guild_ids:
+    database.loadGuildDatabase(guild_id)
+
+for extension in ["cogs.leveling", "cogs.karma", "util.permissions"]:
+    client.load_extension(extension)
+
+levels_cog = client.get_cog("Levels")
+karma_cog = client.get_cog("Karma")
+permissions_cog = client.get_cog("Permissions")
+
+
+async def setup_guild(guild_id):
+    # Levels.first_run_setup
+    await Users.add_many_async(levels_cog, guild_id, user_ids)
+
+    # Permissions.save_permissions
+    Database.Cogs[permissions_cog.name][guild_id]["settings"]["permissions"] = "{}"
+    Database.writeSettings(permissions_cog, guild_id)
+
+
+async def levels(guild_id, user_id):
+    # Levels.load_activity, then the member's row written by Levels.flush_loop
+    exp, level, words, messages, _ = await Users.get_level_async(levels_cog, guild_id, user_id)
+    now = int(time.time())
+    row = UserActivity(exp + 10, level, words + 5, messages + 1, now, "url", now, user_id)
+    await Users.set_activity_many_async(levels_cog, guild_id, [row])
+
+
+async def karma(guild_id, user_id):
+    # Karma.get_current_karma and Karma.set_new_karma
+    upvotes, downvotes = await Users.get_karma_async(karma_cog, guild_id, user_id)
+    await Users.set_karma_async(karma_cog, guild_id, user_id, UserKarma(upvotes + 1, downvotes))
+
+
+async def permissions(guild_id, user_id):
+    # Permissions.load_permissions
+    SettingsTable.get(permissions_cog.name).read_one(permissions_cog, guild_id, "permissions")
+
+
+async def main():
+    for guild_id in guild_ids:
+        await setup_guild(guild_id)
+
+    print(f"{args.storage} storage, {args.guilds} guilds, {args.users} users, {args.queries} queries each")
+    for path in [levels, karma, permissions]:
+        start = time.perf_counter()
+        for _ in range(args.queries):
+            await path(random.choice(guild_ids), random.choice(user_ids))
+        elapsed = time.perf_counter() - start
+
+        print(f"{path.__name__:<12}{args.queries / elapsed:>12.0f}/s{elapsed / args.queries * 1000000:>10.1f} us each")
+
+    await database.dbFlushAsync(None)
+
+
+client.loop.run_until_complete(main())
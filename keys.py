@@ -44,6 +44,83 @@ backup = dict(
     user=os.getenv("backup_ftp_username"),
     # FTP Password
     passwd=os.getenv("backup_ftp_passwd"),
+    # Database pages copied per step of the online backup, the bot can write between steps
+    pages=int(os.getenv("backup_pages", "256")),
+    # Number of files uploaded at the same time, each uses its own ftp session
+    upload_workers=int(os.getenv("backup_upload_workers", "4")),
+)
+
+# Database
+database = dict(
+    # Number of worker threads used for running queries off of the event loop
+    workers=int(os.getenv("database_workers", 4)),
+    # Group commit, hold writes and commit them together instead of after every query
+    group_commit=os.getenv("database_group_commit", "false").lower() == "true",
+    # Longest time in seconds a write can wait to be committed
+    commit_interval=float(os.getenv("database_commit_interval", 1.0)),
+    # Commit right away once this many writes are waiting
+    commit_max_pending=int(os.getenv("database_commit_max_pending", 500)),
+    # guild for a db/{guild_id}.db3 file per guild, or consolidated for shard files in db/shards
+    # Run python -m util.storage migrate to import the guild files before switching to consolidated
+    storage=os.getenv("database_storage", "guild"),
+    # Number of shard files used by consolidated storage, don't change once guilds are stored
+    shards=int(os.getenv("database_shards", 1)),
+    # Number of threads used to load guild databases and settings at startup
+    load_workers=int(os.getenv("database_load_workers", 8)),
+    # Don't load a guild's database until the first event for that guild
+    lazy_load=os.getenv("database_lazy_load", "false").lower() == "true",
+    # Most guild database files kept open at once, the least recently used are closed first
+    max_open=int(os.getenv("database_max_open", 256)),
+    # Close a guild database file after it hasn't been used for this many seconds
+    idle_timeout=int(os.getenv("database_idle_timeout", 900)),
+    # Most (guild, table, key) query results kept in memory, 0 turns the query cache off
+    cache_size=int(os.getenv("database_cache_size", 10000)),
+    # Keep the guild files in WAL mode and archive the WAL for point in time recovery, guild storage only
+    wal_archive=os.getenv("database_wal_archive", "false").lower() == "true",
+    wal_archive_path=os.getenv("database_wal_archive_path", "db/wal_archive"),
+    # Minutes between WAL archives, this is how fine grained a restore can be
+    wal_archive_interval=float(os.getenv("database_wal_archive_interval", 5)),
+    # Hours between full base snapshots in the WAL archive
+    wal_base_interval=float(os.getenv("database_wal_base_interval", 24)),
+    # Vacuum, analyze and quick_check idle guild databases in the background, guild storage only
+    maintenance=os.getenv("database_maintenance", "false").lower() == "true",
+    # Longest time in seconds maintenance holds a guild's lock at once
+    maintenance_budget=float(os.getenv("database_maintenance_budget", 0.1)),
+    # Seconds between turns of maintenance, each turn works on one guild
+    maintenance_tick=float(os.getenv("database_maintenance_tick", 10)),
+    # Hours between maintenance runs for the same guild
+    maintenance_interval=float(os.getenv("database_maintenance_interval", 24)),
+    # Seconds a guild has to go unused before it is maintained
+    maintenance_idle=float(os.getenv("database_maintenance_idle", 300)),
+    # Move the files of guilds the bot leaves into departed_path, they are moved back if it rejoins
+    departed_archive=os.getenv("database_departed_archive", "false").lower() == "true",
+    departed_path=os.getenv("database_departed_path", "db/departed"),
+    # Where exportguild writes its files
+    export_path=os.getenv("database_export_path", "db/exports"),
+    # Most rows dbquery shows, and the longest it lets a query run in seconds
+    console_max_rows=int(os.getenv("database_console_max_rows", 50)),
+    console_time_limit=float(os.getenv("database_console_time_limit", 5)),
+    # Time every query, queries slower than slow_query_ms are logged with their query plan
+    query_log=os.getenv("database_query_log", "true").lower() == "true",
+    slow_query_ms=float(os.getenv("database_slow_query_ms", 100)),
+    # Seconds in each window of the dbslow histograms, the last two windows are shown
+    query_log_window=float(os.getenv("database_query_log_window", 3600)),
+    # The global database for user level data shared by every guild, see util.global_database
+    global_path=os.getenv("database_global_path", "db/global/global.db3"),
+)
+
+# Leveling
+levels = dict(
+    # Seconds between writes of the experience gained in memory to the database
+    flush_interval=float(os.getenv("levels_flush_interval", 30)),
+    # Members that haven't sent a message for this many seconds are dropped from memory
+    idle=float(os.getenv("levels_idle", 900)),
+    # Members inserted with each statement when a guild is first set up
+    setup_chunk=int(os.getenv("levels_setup_chunk", 1000)),
+    # Days the messages per hour are kept for the stats command, only the daily totals are kept after that
+    history_hourly_days=int(os.getenv("levels_history_hourly_days", 35)),
+    # Days of daily totals kept, older ones are deleted
+    history_days=int(os.getenv("levels_history_days", 400)),
 )
 
 # Twitch Keys
@@ -50,9 +50,8 @@ def get_prefix(client, message):
         if now - last_prefix_check > update_difference:
 
             # Query for the prefix of the guild
-            cursor = Database.cursor[message.guild.id]
             query = "SELECT setting_data FROM main WHERE setting_id = 'prefix' LIMIT 1"
-            result = Database.dbExecute(None, cursor, message.guild.id, query)
+            result = Database.dbExecute(None, None, message.guild.id, query, cache=("main", "prefix"))
 
             # If the database had a result, use it. Otherwise use the default
             if result is not None:
@@ -69,7 +68,22 @@ def get_prefix(client, message):
     return commands.when_mentioned_or(prefix)(client, message)
 
 
-client = commands.Bot(command_prefix=get_prefix, case_insensitive=True, intents=discord.Intents.all())
+class Bot(commands.Bot):
+    def dispatch(self, event_name, *args, **kwargs):
+        """Holds events for guilds that lazy loading hasn't loaded yet, until the guild is loaded."""
+        guild_id = Database.dbDeferredGuild(None, event_name, args)
+
+        if guild_id is None:
+            super().dispatch(event_name, *args, **kwargs)
+        else:
+            self.loop.create_task(self.dispatch_deferred(guild_id, event_name, *args, **kwargs))
+
+    async def dispatch_deferred(self, guild_id, event_name, *args, **kwargs):
+        await self.get_cog("Database").loadGuildDeferred(guild_id)
+        super().dispatch(event_name, *args, **kwargs)
+
+
+client = Bot(command_prefix=get_prefix, case_insensitive=True, intents=discord.Intents.all())
 
 
 @client.event
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Messages per hour and words per day for every member, used by Levels for the stats command.
+
+Each guild has a buffer for the current UTC day, {user_id: array}, with the messages sent
+in each of the 24 hours followed by the words for the day. Only the members seen today
+are in it, and it is emptied when the day changes, so memory stays bounded no matter how
+much history there is.
+
+The buffers are written to the activity table, one row per member and day with the hours
+packed into a 48 byte blob. Older rows are downsampled: after history_hourly_days the hours
+are dropped and only the day's totals are kept, and after history_days the row is deleted.
+
+The table is read and written with ActivityHistory in util.repositories.
+"""
+import sys
+from array import array
+
+
+# Index of the words in a buffer, after the 24 hours
+WORDS = 24
+
+# Messages in an hour are stored as unsigned 16 bit
+HOUR_MAX = 0xFFFF
+
+
+def day_of(timestamp: int):
+    """Days since the epoch, in UTC"""
+    return timestamp // 86400
+
+
+def encode_hours(hours):
+    """24 counts as a little endian blob of unsigned 16 bit"""
+    packed = array("H", (min(count, HOUR_MAX) for count in hours))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def decode_hours(blob: bytes):
+    hours = array("H")
+    hours.frombytes(blob)
+    if sys.byteorder == "big":
+        hours.byteswap()
+    return hours
+
+
+def sum_hours(blobs):
+    """Returns the messages per hour of every blob added together, downsampled rows are None and skipped"""
+    columns = zip(*(decode_hours(blob) for blob in blobs if blob is not None))
+    return [sum(column) for column in columns] or [0] * 24
+
+
+def daily(rows, first_day: int, days: int):
+    """Returns [messages] for days days from first_day, rows is [(day, messages)]"""
+    counts = [0] * days
+    for day, messages in rows:
+        if first_day <= day < first_day + days:
+            counts[day - first_day] += messages
+    return counts
+
+
+# Bars for sparkline, from the lowest to the highest
+BARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(counts: list):
+    """Returns the counts as a line of bars, scaled to the highest"""
+    highest = max(counts, default=0)
+    if not highest:
+        return BARS[0] * len(counts)
+
+    return "".join(BARS[count * (len(BARS) - 1) // highest] for count in counts)
+
+
+class ActivityStore:
+    def __init__(self):
+        # {guild_id: day the buffers are for}
+        self.day = dict()
+        # {guild_id: {user_id: array}}, 24 hours of messages then the words
+        self.buffers = dict()
+        # {guild_id: set of user_id} changed since they were written
+        self.dirty = dict()
+        # {guild_id: [rows]} from a day that ended before it was written
+        self.ended = dict()
+
+    def is_loaded(self, guild_id: int, day: int):
+        return self.day.get(guild_id) == day
+
+    def start_day(self, guild_id: int, day: int, rows):
+        """
+        Starts the guild's buffers for day, with the rows already written for it, [(user_id, hours, words)].
+        The previous day's changes are kept for the next write.
+        Returns True if the guild's day changed, False if another call already started it.
+        """
+        if self.day.get(guild_id) == day:
+            return False
+
+        if guild_id in self.day:
+            # dirty_rows includes anything already waiting in ended
+            self.ended[guild_id] = self.dirty_rows(guild_id)
+
+        buffers = dict()
+        for user_id, hours, words in rows:
+            buffer = array("L", decode_hours(hours) if hours is not None else [0] * 24)
+            buffer.append(words)
+            buffers[int(user_id)] = buffer
+
+        self.day[guild_id] = day
+        self.buffers[guild_id] = buffers
+        self.dirty[guild_id] = set()
+        return True
+
+    def record(self, guild_id: int, user_id: int, timestamp: int, words: int):
+        """Counts a message, call start_day first for the day of timestamp"""
+        buffer = self.buffers[guild_id].get(user_id)
+        if buffer is None:
+            buffer = self.buffers[guild_id][user_id] = array("L", [0] * (WORDS + 1))
+
+        buffer[timestamp % 86400 // 3600] += 1
+        buffer[WORDS] += words
+        self.dirty[guild_id].add(user_id)
+
+    def dirty_rows(self, guild_id: int):
+        """
+        Returns [(hours, messages, words, user_id, day)] for the guild's members that changed,
+        including a day that has ended, and marks them clean
+        """
+        rows = self.ended.pop(guild_id, list())
+        day = self.day.get(guild_id)
+        buffers = self.buffers.get(guild_id, dict())
+
+        for user_id in self.dirty.get(guild_id, set()):
+            buffer = buffers[user_id]
+            rows.append((encode_hours(buffer[:WORDS]), sum(buffer[:WORDS]), buffer[WORDS], user_id, day))
+
+        self.dirty[guild_id] = set()
+        return rows
+
+    def mark_dirty(self, guild_id: int, rows):
+        """Puts rows from dirty_rows back after a failed write"""
+        for row in rows:
+            if row[4] == self.day.get(guild_id):
+                self.dirty.setdefault(guild_id, set()).add(row[3])
+            else:
+                self.ended.setdefault(guild_id, list()).append(row)
+
+    def guilds(self):
+        """Guilds with changes waiting to be written"""
+        guild_ids = set(self.dirty) | set(self.ended)
+        return [guild_id for guild_id in guild_ids if self.dirty.get(guild_id) or self.ended.get(guild_id)]
+
+    def remove_guild(self, guild_id: int):
+        for each in (self.day, self.buffers, self.dirty, self.ended):
+            each.pop(guild_id, None)
@@ -5,30 +5,193 @@ Discord Bot for HardwareFlare and others
 """
 """
         #database query
-        cursor = Database.cursor[ctx.guild.id]
         query = "UPDATE table SET setting_data = ? WHERE setting_id = ? "
         values = (setting_data, setting_id)
-        Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+        Database.dbExecute(self, None, ctx.guild.id, query, values)
 
 """
+import asyncio
+import atexit
 import datetime
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import os
 import sqlite3
+import threading
+import time
 import traceback
-from shutil import copyfile
+import typing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import aioftp
+import discord
 from discord.ext import commands
 from discord.ext import tasks
 
 from keys import backup
+from keys import database as database_settings
+from util import export
+from util.global_database import GlobalDatabase
+from util.maintenance import Maintenance
+from util.migrations import Migrations
+from util.query_cache import QueryCache
+from util.query_log import format_plan
+from util.query_log import Histogram
+from util.query_log import QueryLog
+from util.storage import ConsolidatedStorage
+from util.storage import GuildFileStorage
+from util.storage import MemoryStorage
+from util.wal_archive import parse_time
+from util.wal_archive import WalArchive
 
 
 logger = logging.getLogger(__name__)
 
 
+class GuildHandles:
+    """
+    Database.connection[guild_id], Database.cursor[guild_id] and Database.lock[guild_id]
+    Looked up through Database.storage, which opens the guild's database if it isn't open.
+    """
+
+    def __init__(self, handle: str):
+        self.handle = handle
+
+    def __getitem__(self, guild_id):
+        return getattr(Database.storage, self.handle)(int(guild_id))
+
+
+class Settings(dict):
+    """
+    Database.Cogs[cog][guild_id]["settings"], the decoded settings for a cog in a guild.
+
+    Keeps track of the keys that have been set since the last save, so writeSettings
+    only writes the keys that changed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+        # {setting_id: setting_data} as it is stored in the database
+        self.saved = dict()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @staticmethod
+    def encode(value):
+        """Returns the value the way the TEXT setting_data column stores it"""
+        # Save the id of discord objects instead of the object.
+        if hasattr(value, "id"):
+            value = value.id
+
+        if value is None:
+            return None
+
+        if isinstance(value, bool):
+            value = int(value)
+
+        return str(value)
+
+    @staticmethod
+    def decode(value):
+        # If the setting is completely numeric, save it as an integer, otherwise leave it a string
+        if value is None:
+            # Check for None before allowing .isnumeric to run to prevent error
+            return None
+
+        if value.isnumeric():
+            return int(value)
+
+        return value
+
+    def load(self, rows):
+        """Loads the rows read from the database without marking them dirty"""
+        for setting_id, setting_data in rows:
+            super().__setitem__(setting_id, Settings.decode(setting_data))
+            self.saved[setting_id] = setting_data
+
+    def changes(self):
+        """Returns [(setting_id, setting_data)] for the dirty keys that differ from what is saved"""
+        changes = list()
+        for key in self.dirty:
+            if key not in self:
+                continue
+
+            setting_data = Settings.encode(self[key])
+            if key in self.saved and self.saved[key] == setting_data:
+                continue
+
+            changes.append((key, setting_data))
+
+        return changes
+
+    def mark_saved(self, changes):
+        self.saved.update(changes)
+        self.dirty.clear()
+
+
+class SettingsTable:
+    """
+    The {cog}_settings table of a cog, with its statements built once, see util.repositories.
+    SettingsTable.get(self.name) returns the same one every time.
+    """
+
+    tables = dict()
+
+    def __init__(self, name: str):
+        self.name = name
+        self.table = f"{name}_settings"
+
+        self.create = f"CREATE TABLE IF NOT EXISTS {self.table}(setting_id TEXT, setting_data TEXT)"
+        self.unique_index = f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table}_setting_id ON {self.table}(setting_id)"
+        self.select = f"SELECT setting_id, setting_data FROM {self.table}"
+        self.select_one = f"SELECT setting_data FROM {self.table} WHERE setting_id = ? LIMIT 1"
+        self.insert = f"INSERT INTO {self.table} (setting_id, setting_data) VALUES (?, ?)"
+        self.delete = f"DELETE FROM {self.table} WHERE setting_id = ?"
+        self.upsert = f"""INSERT INTO {self.table} (setting_id, setting_data) VALUES (?, ?)
+                          ON CONFLICT(setting_id) DO UPDATE SET setting_data = excluded.setting_data"""
+        # The consolidated tables are views, which can't be UPSERTed, the unique index
+        # on the table behind the view makes REPLACE do the same thing.
+        self.replace = f"INSERT OR REPLACE INTO {self.table} (setting_id, setting_data) VALUES (?, ?)"
+
+    @staticmethod
+    def get(name: str):
+        table = SettingsTable.tables.get(name)
+        if table is None:
+            table = SettingsTable.tables[name] = SettingsTable(name)
+
+        return table
+
+    def read(self, owner, guild_id: int):
+        """Returns [(setting_id, setting_data)]"""
+        return Database.dbExecute(owner, None, guild_id, self.select, (), True)
+
+    def read_one(self, owner, guild_id: int, setting_id: str):
+        """Returns the undecoded setting_data, or None if it isn't set"""
+        row = Database.dbExecute(owner, None, guild_id, self.select_one, (setting_id,))
+        return row[0] if row is not None else None
+
+    def write_many(self, owner, guild_id: int, changes: list):
+        """Saves [(setting_id, setting_data)], one statement for all of them, committed together"""
+        query = self.upsert if Database.storage.supports_upsert else self.replace
+        Database.dbExecute(owner, None, guild_id, query, changes, many=True)
+
+
 class Database(commands.Cog):
 
     # These need to be accessible from every instance.
@@ -39,177 +202,446 @@ class Database(commands.Cog):
     Cogs = dict()
 
     # Database
-    connection = dict()  # Database connection
-    cursor = dict()  # Dictionary to hold all of the database cursors
+    connection = GuildHandles("connect")  # Database connection
+    cursor = GuildHandles("cursor")  # A new cursor for the guild's connection
+    lock = GuildHandles("lock")  # Per guild lock, held while a query is running against the guild's database
+
+    # Worker threads for dbExecuteAsync, a guild is always serviced by the same worker
+    # so queries for a guild run in the order they were sent.
+    workers = list()
+
+    # Group commit, connections with writes that have not been committed yet.
+    # {connection: [guild_id, number of pending writes]}
+    pending = dict()
+
+    # GuildFileStorage for a db/{guild_id}.db3 file per guild,
+    # or ConsolidatedStorage when database_storage is set to consolidated
+    storage = None
+
+    # QueryCache of read results, None when database_cache_size is 0
+    cache = None
+
+    # Schema migrations, registered by Database and the cogs, see util.migrations
+    migrations = Migrations()
+
+    # Maintenance scheduler, None when database_maintenance is off
+    maintenance = None
+
+    # QueryLog of how long each statement takes, None when database_query_log is off
+    query_log = None
+
+    # GlobalDatabase for user level data shared by every guild, and the worker thread
+    # dbGlobalExecuteAsync runs its queries on, so they run in the order they were sent.
+    global_db = None
+    global_worker = None
+
+    # Startup loading
+    loader = None  # Thread pool used to load guilds in parallel
+    deferred = set()  # Guilds with lazy_load that haven't had an event yet
+    loading = dict()  # {guild_id: task} for deferred guilds being loaded
+    load_timings = dict()  # {phase: [count, total seconds]}
+    load_timings_lock = threading.Lock()
+    # Events discord.py sends for every guild as it connects, they don't load a deferred guild
+    lifecycle_events = ("guild_available", "guild_unavailable", "guild_update")
 
     def __init__(self, client):
         self.client = client
+
+        if Database.storage is None:
+            if database_settings["storage"] == "consolidated":
+                Database.storage = ConsolidatedStorage("db/shards", database_settings["shards"])
+            elif database_settings["storage"] == "memory":
+                Database.storage = MemoryStorage()
+            else:
+                Database.storage = GuildFileStorage("db", database_settings["max_open"])
+
+            # Writes waiting on group commit are committed by storage before it closes a connection
+            Database.storage.on_close = lambda connection: Database.pending.pop(connection, None)
+
+            if database_settings["wal_archive"]:
+                if isinstance(Database.storage, GuildFileStorage):
+                    Database.storage.archive = WalArchive(
+                        database_settings["wal_archive_path"], database_settings["wal_base_interval"]
+                    )
+                else:
+                    logger.warning("database_wal_archive is only supported with guild storage, not archiving.")
+
+            if database_settings["maintenance"]:
+                if isinstance(Database.storage, GuildFileStorage):
+                    Database.maintenance = Maintenance(
+                        database_settings["maintenance_budget"],
+                        database_settings["maintenance_interval"],
+                        database_settings["maintenance_idle"],
+                    )
+                else:
+                    logger.warning("database_maintenance is only supported with guild storage, not maintaining.")
+
+            if database_settings["departed_archive"]:
+                if isinstance(Database.storage, GuildFileStorage):
+                    # Keeps an archived guild from being opened as a new, empty file
+                    Database.storage.departed_path = database_settings["departed_path"]
+                else:
+                    logger.warning("database_departed_archive is only supported with guild storage, not archiving.")
+
+        # The main settings table, and the tables older versions created for the cogs
+        Database.migrations.register(
+            "main",
+            1,
+            """CREATE TABLE IF NOT EXISTS main(
+               setting_id TEXT, setting_data TEXT, PRIMARY KEY("setting_id"))""",
+            legacy=Migrations.setting_version("main", "schemaVersion"),
+        )
+        Database.migrations.register("main", 6, Database.dbSchemaServerName)
+        # Added change_prefix support.
+        Database.migrations.register("main", 12, "INSERT INTO main(setting_id, setting_data) VALUES ('prefix', '.')")
+        Database.migrations.register(
+            "main",
+            15,
+            "CREATE TABLE IF NOT EXISTS levels_settings(setting_id TEXT, setting_data TEXT)",
+            "INSERT INTO levels_settings(setting_id, setting_data) VALUES ('initialRun', 1)",
+        )
+        # Add reddit autolink
+        Database.migrations.register(
+            "main",
+            16,
+            "CREATE TABLE IF NOT EXISTS reddit_settings(setting_id TEXT, setting_data TEXT)",
+            "INSERT INTO reddit_settings(setting_id, setting_data) VALUES ('autolink', '1')",
+        )
+
+        if Database.query_log is None and database_settings["query_log"]:
+            Database.query_log = QueryLog(database_settings["slow_query_ms"], database_settings["query_log_window"])
+
+        if Database.cache is None and database_settings["cache_size"] > 0:
+            Database.cache = QueryCache(database_settings["cache_size"])
+
+        if not Database.workers:
+            for worker in range(database_settings["workers"]):
+                Database.workers.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"database-{worker}"))
+
+        if Database.loader is None:
+            Database.loader = ThreadPoolExecutor(
+                max_workers=database_settings["load_workers"], thread_name_prefix="database-load"
+            )
+
+        if Database.global_db is None:
+            # Nothing is written to disk with memory storage
+            path = ":memory:" if database_settings["storage"] == "memory" else database_settings["global_path"]
+            Database.global_db = GlobalDatabase(path)
+            Database.global_db.migrate()
+            Database.global_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database-global")
+
         self.loadDatabase()
 
+        # Close guild databases that haven't been used in a while
+        self.idle_loop.start()  # pylint: disable=no-member
+
+        if Database.storage.archive is not None:
+            self.wal_archive_loop.start()  # pylint: disable=no-member
+
+        if Database.maintenance is not None:
+            self.maintenance_loop.start()  # pylint: disable=no-member
+
+        if database_settings["group_commit"]:
+            # Writes are held for at most commit_interval seconds before they are committed
+            self.commit_loop.start()  # pylint: disable=no-member
+
+            # Don't lose the last window of writes when the bot shuts down
+            atexit.register(Database.dbFlush, None)
+
         # Ignoring pylint error about run_backup_loop not having a start member
         # the parent loop has the .start member
         # self.run_backup_loop.start()  # pylint: disable=no-member
 
     def loadDatabase(self):
         # Load all of the guild settings
-        for filename in os.listdir("./db"):
-            if filename.endswith(".db3"):
-                # Find the guild ID based on filename
-                guild_id = int(f"{filename[:-4]}")
-                self.loadGuildDatabase(guild_id)
+        start = time.perf_counter()
+
+        guild_ids = Database.storage.guild_ids()
+
+        if database_settings["lazy_load"]:
+            # Guilds are loaded by loadGuildDeferred when their first event comes in
+            Database.deferred.update(guild_ids)
+            logger.info(f"{len(guild_ids)} guild databases deferred until their first event.")
+            return
+
+        # Each guild has its own connection and lock, so they can be loaded side by side.
+        # list() makes sure any exception from loading a guild is raised here.
+        list(Database.loader.map(self.loadGuildDatabase, guild_ids))
+
+        Database.dbTiming(self, "startup", start)
+        logger.info(f"Loaded {len(guild_ids)} guild databases in {time.perf_counter() - start:.3f} seconds.")
 
     def loadGuildDatabase(self, guild_id):
         # Create the guild
         Database.Main[guild_id] = dict()
 
-        # Create a handle for the database
-        cursor = Database.cursor[guild_id] = Database.dbOpen(self, guild_id)
+        # Create the database if it doesn't exist
+        start = time.perf_counter()
+        Database.dbOpen(self, guild_id)
+        Database.dbTiming(self, "open", start)
+
+        # Bring the schema up to date now, instead of on the first query
+        start = time.perf_counter()
+        Database.dbMigrateGuild(self, guild_id)
+        Database.dbTiming(self, "schema", start)
 
+        start = time.perf_counter()
         query = "SELECT setting_id, setting_data FROM main"
 
         # Read the settings from the database
-        result = Database.dbExecute(self, cursor, guild_id, query, list(), True)
+        result = Database.dbExecute(self, None, guild_id, query, list(), True)
 
         # Read all of the settings, and store them in a dictionary
         for each_result in result:
             # Save all of the settings
             Database.Main[guild_id][each_result[0]] = each_result[1]
 
+        Database.dbTiming(self, "main", start)
+
+    def dbTiming(self, phase: str, start: float):
+        """
+        Adds the time since start, from time.perf_counter(), to a load phase.
+        """
+        elapsed = time.perf_counter() - start
+
+        with Database.load_timings_lock:
+            timing = Database.load_timings.setdefault(phase, [0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+
+    def dbDeferredGuild(self, event_name: str, args: tuple):
+        """
+        Returns the guild_id if the event is for a guild that lazy_load hasn't loaded yet, otherwise None.
+        """
+        if not Database.deferred and not Database.loading:
+            return None
+
+        guild_id = None
+        for arg in args:
+            if isinstance(arg, discord.Guild):
+                guild_id = arg.id
+            elif getattr(arg, "guild", None) is not None:
+                guild_id = arg.guild.id
+            else:
+                # Raw event payloads
+                guild_id = getattr(arg, "guild_id", None)
+
+            if guild_id is not None:
+                break
+
+        if event_name == "guild_join":
+            # on_guild_join opens the database for us
+            Database.deferred.discard(guild_id)
+            return None
+
+        if event_name in Database.lifecycle_events:
+            # Sent for every guild as the bot connects, they aren't activity in the guild
+            return None
+
+        if guild_id in Database.deferred or guild_id in Database.loading:
+            return guild_id
+
+        return None
+
+    async def loadGuildDeferred(self, guild_id: int):
+        """
+        Loads a guild that lazy_load deferred. Every event waiting on the guild waits for the same load.
+        """
+        task = Database.loading.get(guild_id)
+        if task is None:
+            Database.deferred.discard(guild_id)
+            task = Database.loading[guild_id] = asyncio.ensure_future(self.loadGuildDeferredWork(guild_id))
+
+        await task
+
+    async def loadGuildDeferredWork(self, guild_id: int):
+        start = time.perf_counter()
+
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(Database.loader, self.loadGuildDatabase, guild_id)
+
+            # Let the cogs set the guild up the same way they do for the guilds loaded at startup
+            Database.dbSetupGuild(self, guild_id)
+
+        finally:
+            del Database.loading[guild_id]
+
+        Database.dbTiming(self, "deferred", start)
+        logger.info(f"Deferred guild {guild_id} loaded in {time.perf_counter() - start:.3f} seconds.")
+
+    def dbSetupGuild(self, guild_id: int):
+        """
+        Sets a guild up in every cog that keeps settings, the same way as the guilds loaded at startup,
+        for a guild that was loaded later or had its database replaced.
+        The cog's settings are read, then a cog that keeps more than settings for a guild has
+        setup_guild(guild_id) to set the rest up.
+        """
+        for cog in list(self.client.cogs.values()):
+            if getattr(cog, "name", None) not in Database.Cogs:
+                continue
+
+            try:
+                Database.readSettingsGuild(cog, guild_id)
+                if hasattr(cog, "setup_guild"):
+                    cog.setup_guild(guild_id)
+            except Exception:
+                logger.exception(f"{type(cog).__name__} failed setting up guild {guild_id}")
+
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         # Check if we have been here before.
         if not Database.Main.get(guild.id, False):
+            # Bring back the file archived when we left. This doesn't await, so the file is
+            # back before the other cogs on_guild_join listeners read their settings.
+            if database_settings["departed_archive"] and isinstance(Database.storage, GuildFileStorage):
+                if Database.storage.rehydrate_guild(guild.id, database_settings["departed_path"]):
+                    logger.info(f"Guild {guild.id} rehydrated from {database_settings['departed_path']}.")
+
             # Create a new entry in the Main dictionary for the new guild
             Database.Main[guild.id] = dict()
 
             # Open then close a database file, to create it.
-            Database.cursor[guild.id] = self.dbOpen(guild.id)
+            self.dbOpen(guild.id)
             self.dbClose(guild.id)
 
             # Reload the databases
             self.loadGuildDatabase(guild.id)
 
-    def dbUpdateSchema(self, guild_id: int, cursor):
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
         """
-        dbUpdateSchema(self, guild_id as Integer, cursor as Database handle)
-        Updates the schema of the guild if it hasn't been updated since the bot rebooted.
-        Returns nothing.
+        Closes the guild's database and moves it into the departed archive.
         """
+        if not database_settings["departed_archive"] or not isinstance(Database.storage, GuildFileStorage):
+            return
 
-        # Read the current version, on new it shouldn't return anything.
-        try:
-            cursor.execute("SELECT setting_data FROM main WHERE setting_id = 'schemaVersion'")
-            schemaVersion = cursor.fetchone()
-            schemaVersion = int(schemaVersion[0])
-
-        except sqlite3.Error:
-            schemaVersion = 0
-
-        # Record the original version
-        originalSchemaVersion = schemaVersion
-
-        if schemaVersion < 1:  # Create main tables, for settings storage.
-            cursor.execute(
-                """
-                           CREATE TABLE IF NOT EXISTS main(
-                           setting_id TEXT,
-                           setting_data TEXT,
-                           PRIMARY KEY("setting_id")
-                           )
-                           """
-            )
+        # Everything the cogs hold for the guild is written first, whichever order the listeners run in.
+        # Their own on_guild_remove listeners then have nothing left to write, the guild can't be opened
+        # again once it is archived.
+        Database.dbGuildHooks(self, guild.id, True)
+        for cog in list(self.client.cogs.values()):
+            if guild.id in Database.Cogs.get(getattr(cog, "name", None), dict()):
+                Database.writeSettings(cog, guild.id)
 
-        if schemaVersion < 6:
-            # Add guild name to database
-            schemaVersion = 6
-            guildName = str(self.client.get_guild(guild_id))
-            cursor.execute(
-                "INSERT INTO main(setting_id, setting_data) VALUES(?,?)",
-                ("serverName", guildName),
-            )
+        await self.dbFlushAsync(guild.id)
 
-        if schemaVersion < 12:
-            # Added change_prefix support.
-            schemaVersion = 12
-            cursor.execute("INSERT INTO main(setting_id, setting_data) VALUES ('prefix', '.')")
-
-        if schemaVersion < 15:
-            # Add levels_settings table
-            schemaVersion = 15
-            cursor.execute(
-                f"""
-                            CREATE TABLE IF NOT EXISTS levels_settings(
-                            setting_id TEXT,
-                            setting_data TEXT
-                            )
-                           """
-            )
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(Database.loader, Database.dbArchiveGuild, self, guild.id)
 
-            cursor.execute(
-                f"""
-                            INSERT INTO levels_settings(setting_id, setting_data)
-                            VALUES ('initialRun', 1)
-                           """
-            )
+    def dbGuildHooks(self, guild_id: int, write: bool):
+        """
+        Calls the cogs that keep a guild's data in memory, before its database is archived or replaced.
+        With write, each cog's flush_guild(guild_id) writes what it holds first.
+        Then each cog's reset_guild(guild_id) forgets it, so nothing stale is written afterwards.
+        """
+        for cog in list(self.client.cogs.values()):
+            for hook in ("flush_guild", "reset_guild") if write else ("reset_guild",):
+                if not hasattr(cog, hook):
+                    continue
 
-        if schemaVersion < 16:
-            # Add reddit autolink
-            schemaVersion = 16
-            cursor.execute(
-                f"""
-                            CREATE TABLE IF NOT EXISTS reddit_settings(
-                            setting_id TEXT,
-                            setting_data TEXT
-                            )
-                           """
-            )
-            cursor.execute(
-                f"""
-                           INSERT INTO reddit_settings(setting_id, setting_data)
-                           VALUES ('autolink', '1')
-                           """
-            )
+                try:
+                    getattr(cog, hook)(guild_id)
+                except Exception:
+                    logger.exception(f"{type(cog).__name__}.{hook} failed for {guild_id}")
 
-        if originalSchemaVersion != schemaVersion:
-            # If this is a new database, we have to insert first.
-            if originalSchemaVersion == 0:
-                cursor.execute(
-                    "INSERT INTO main(setting_id, setting_data) VALUES(?,?)",
-                    ("schemaVersion", schemaVersion),
-                )
-            else:  # Otherwise update the database
-                cursor.execute(
-                    "UPDATE main SET setting_data = ? WHERE setting_id = ?",
-                    (schemaVersion, "schemaVersion"),
-                )
-
-            print(
-                f"Database updated from {originalSchemaVersion} to {schemaVersion} for {self.client.get_guild(guild_id)} - {guild_id}"
-            )
+    def dbArchiveGuild(self, guild_id: int):
+        """
+        Moves the guild's database into the departed archive and forgets about the guild.
+        on_guild_join brings it back.
+        """
+        archived = Database.storage.archive_guild(guild_id, database_settings["departed_path"])
+
+        Database.Main.pop(guild_id, None)
+        Database.deferred.discard(guild_id)
+        Database.migrations.forget(guild_id)
+        if Database.cache is not None:
+            Database.cache.invalidate(guild_id)
+
+        if archived is not None:
+            logger.info(f"Guild {guild_id} archived to {archived}.")
 
-        Database.Main[guild_id]["SchemaUpToDate"] = True
+    def dbMigrate(self):
+        """
+        dbMigrate(self)
+
+        Runs the pending migrations for every loaded guild, side by side on the loader threads.
+        Cogs call this after registering their migrations with Database.migrations.
+        """
+        start = time.perf_counter()
+
+        guild_ids = [guild_id for guild_id in list(Database.Main) if Database.migrations.pending(guild_id)]
+
+        # list() makes sure any exception from a guild is raised here.
+        list(Database.loader.map(functools.partial(Database.dbMigrateGuild, self), guild_ids))
+
+        Database.dbTiming(self, "migrate", start)
+
+    def dbMigrateGuild(self, guild_id: int):
+        """
+        Runs the guild's pending migrations in a single transaction.
+        Does nothing, without touching the database, when the guild is up to date.
+        """
+        if not Database.migrations.pending(guild_id):
+            return
+
+        with Database.lock[guild_id]:
+            connection = Database.connection[guild_id]
+
+            # Group commit writes go in first, so they aren't rolled back with a failed migration
+            if connection.in_transaction:
+                connection.commit()
+                Database.pending.pop(connection, None)
+
+            cursor = Database.cursor[guild_id]
+            try:
+                applied = Database.migrations.run(self, guild_id, connection, cursor)
+            except sqlite3.Error:
+                logger.exception(f"Migrating {guild_id} failed, nothing was changed.")
+                raise
+            finally:
+                cursor.close()
+
+        if applied:
+            if Database.cache is not None:
+                Database.cache.invalidate(guild_id)
+
+            versions = ", ".join(f"{namespace} {version}" for namespace, version in applied)
+            logger.info(f"Database migrated to {versions} for {guild_id}")
+
+    def dbSchemaServerName(self, cursor, guild_id: int):
+        # Add guild name to database
+        guildName = str(self.client.get_guild(guild_id))
+        cursor.execute(
+            "INSERT INTO main(setting_id, setting_data) VALUES(?,?)",
+            ("serverName", guildName),
+        )
 
     def dbOpen(self, guild_id: int):
         """
         Opens the database based on the guild_id
         guild_id - ctx.guild.id or message.guild.id
         """
-        db_file_name = f"db/{guild_id}.db3"
+        # Creates the file, or registers the guild in its shard
+        Database.storage.create(guild_id)
 
-        # Open database file
-        db = Database.connection[guild_id] = sqlite3.connect(db_file_name)
-        cursor = db.cursor()
+        return Database.cursor[guild_id]
 
-        return cursor
+    def dbFiles(self):
+        """
+        Returns a list of (name, path) for every database file.
+        name is the guild_id, shard-# for consolidated storage, or global for the global database.
+        """
+        files = Database.storage.files() + [("global", Database.global_db.path)]
+        return [(name, path) for name, path in files if os.path.exists(path)]
 
     def dbClose(self, guild_id):
         """
         Commits and closes the database
         """
         # Save and close the database
-        Database.connection[int(guild_id)].commit()
-        Database.cursor[int(guild_id)].close()
-        Database.connection[int(guild_id)].close()
+        # Shard connections are shared with the other guilds in the shard, those are only committed
+        Database.storage.close(int(guild_id))
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -233,6 +665,118 @@ class Database(commands.Cog):
             time.sleep(1)
         quit()
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def dbquery(self, ctx, guild_id: int, limit: typing.Optional[int] = 20, *, query: str):
+        """
+        Runs a read only query against a guild's database
+        Shows the query plan, how long the query took and up to limit rows.
+        With consolidated storage the query runs against the shard, use the guilds_ tables.
+        Usage: dbquery guild_id [limit] SELECT ...
+        """
+        path, _ = Database.dbGuildFile(self, guild_id)
+        if path is None or not os.path.exists(path):
+            await ctx.send(f"There is no database file for {guild_id}.")
+            return
+
+        query = query.strip().strip("`")
+        if query.lower().startswith("sql\n"):
+            query = query[4:]
+
+        limit = max(1, min(limit, database_settings["console_max_rows"]))
+
+        loop = asyncio.get_running_loop()
+        try:
+            plan, columns, rows, elapsed = await loop.run_in_executor(
+                Database.loader, Database.dbConsoleQuery, self, path, query, limit
+            )
+        except (ValueError, sqlite3.Error) as e:
+            await ctx.send(f"Query failed. {e}")
+            return
+
+        lines = ["Query plan"] + format_plan(plan)
+
+        more = len(rows) > limit
+        lines.append("")
+        lines.append(f"{min(len(rows), limit)}{'+' if more else ''} rows in {elapsed * 1000:.2f} ms")
+        lines.append("")
+
+        if columns:
+            lines.append(" | ".join(columns))
+            for row in rows[:limit]:
+                lines.append(" | ".join(str(value) for value in row))
+
+        await self.dbSendLines(ctx, lines)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def dbtables(self, ctx, guild_id: int):
+        """
+        Lists the tables and indexes in a guild's database
+        """
+        path, _ = Database.dbGuildFile(self, guild_id)
+        if path is None or not os.path.exists(path):
+            await ctx.send(f"There is no database file for {guild_id}.")
+            return
+
+        query = "SELECT type, name, tbl_name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY tbl_name, type DESC"
+
+        loop = asyncio.get_running_loop()
+        _, _, rows, _ = await loop.run_in_executor(Database.loader, Database.dbConsoleQuery, self, path, query, 1000)
+
+        lines = [f"{'type':<8}{'name':<40}table"]
+        for object_type, name, table in rows:
+            lines.append(f"{object_type:<8}{name:<40}{table}")
+
+        await self.dbSendLines(ctx, lines)
+
+    def dbGuildFile(self, guild_id: int):
+        """
+        Returns (path, guild_id) for the file the guild is stored in. guild_id is None for a
+        guild file, and the guild to filter on for a consolidated shard.
+        Returns (None, None) when the guild isn't stored in a file.
+        """
+        if isinstance(Database.storage, GuildFileStorage):
+            return Database.storage.guild_file(guild_id), None
+
+        if isinstance(Database.storage, ConsolidatedStorage):
+            return Database.storage.shard_file(Database.storage.shard(guild_id)), guild_id
+
+        return None, None
+
+    def dbConsoleQuery(self, path: str, query: str, limit: int):
+        """
+        Runs a query for dbquery on its own read only connection, so it can't change
+        anything and the guild's connection is free for the bot meanwhile.
+        Gives up after console_time_limit seconds.
+        Returns (query plan rows, column names, up to limit + 1 rows, seconds the query took)
+        """
+        db = export.connect(path)
+        deadline = time.perf_counter() + database_settings["console_time_limit"]
+        db.set_progress_handler(lambda: time.perf_counter() > deadline, 1000)
+
+        try:
+            plan = db.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+
+            start = time.perf_counter()
+            cursor = db.execute(query)
+            rows = cursor.fetchmany(limit + 1)
+            elapsed = time.perf_counter() - start
+
+            columns = [each[0] for each in cursor.description] if cursor.description else list()
+
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                raise ValueError(f"The query took longer than {database_settings['console_time_limit']} seconds.")
+            raise
+
+        finally:
+            db.close()
+
+        return plan, columns, rows, elapsed
+
     def dbExecute(
         self,
         cursor,
@@ -247,7 +791,7 @@ class Database(commands.Cog):
         dbExecute(self, guild_id as Integer, query as String, values as List, fetchAll as boolean)
 
         self - self
-        cursor - Database handle
+        cursor - Not used, pass None. Kept so older calls keep working, the query runs on the guilds connection.
         guild_id - ctx.guild.id or message.guild.id
         query - SQL formatted query
         values - Values for the sql query.
@@ -256,38 +800,571 @@ class Database(commands.Cog):
         Function will create database if one does not exist.
         Database filename will be  {guild_id}.db3
 
+        This runs on the calling thread, which blocks the event loop until the query is done.
+        Use dbExecuteAsync from coroutines instead.
+
         returns None if an error occours
         returns result of query if successful
         """
+        return Database.dbRunQuery(self, guild_id, query, values, fetchAll, returnRows, **kwargs)
+
+    async def dbExecuteAsync(
+        self,
+        guild_id: int,
+        query: str,
+        values: list = (),
+        fetchAll: bool = False,
+        returnRows: bool = False,
+        **kwargs,
+    ):
+        """
+        await dbExecuteAsync(self, guild_id as Integer, query as String, values as List, fetchAll as boolean)
+
+        Same as dbExecute, but the query is run on the guilds worker thread
+        so the event loop is free while SQLite is working.
+        """
+        loop = asyncio.get_running_loop()
+        worker = Database.workers[guild_id % len(Database.workers)]
+        query_call = functools.partial(Database.dbRunQuery, self, guild_id, query, values, fetchAll, returnRows, **kwargs)
 
-        # Run dbUpdateSchema if the file is new or hasn't been checked since bot startup.
-        if not Database.Main[guild_id].get("SchemaUpToDate", False):
-            Database.dbUpdateSchema(self, guild_id, cursor)
+        return await loop.run_in_executor(worker, query_call)
+
+    def dbRunQuery(
+        self,
+        guild_id: int,
+        query: str,
+        values: list = (),
+        fetchAll: bool = False,
+        returnRows: bool = False,
+        **kwargs,
+    ):
+        """
+        Runs the query for dbExecute and dbExecuteAsync while holding the guild lock.
+        """
+        # (table, key) the query reads or writes, see util.query_cache
+        cache = kwargs.get("cache") if Database.cache is not None else None
+        statement = (query, tuple(values), fetchAll) if cache is not None and QueryCache.is_read(query) else None
+
+        with Database.lock[guild_id]:
+            if statement is not None:
+                result = Database.cache.get(guild_id, *cache, statement)
+                if result is not QueryCache.miss:
+                    return (result, 0) if returnRows else result
+
+            connection = Database.connection[guild_id]
+            cursor = Database.cursor[guild_id]
+
+            # Rows changed through the consolidated views are made by triggers, which
+            # cursor.rowcount doesn't count, so count them from the connection total instead.
+            changes = connection.total_changes
+            many = kwargs.get("many", False)
+            start = time.perf_counter()
+
+            try:
+                # Run our query, pass many = True to run it once for every set of values
+                if many:
+                    cursor.executemany(query, values)
+                else:
+                    cursor.execute(query, values)
+
+            except sqlite3.Error as error:
+                # Pass hide_error = True in call to hide error output
+                if not kwargs.get("hide_error", False):
+                    # If there is an error, will print to console and return None
+                    logger.warning(f"SQL Error\nquery: {query} \nvalues: {values}\nerror: {error}")
+                raise  # re-raise exception.
+
+            executed = time.perf_counter()
+
+            # Return all rows, or just one.
+            if fetchAll:
+                result = cursor.fetchall()
+            else:
+                result = cursor.fetchone()
+
+            fetched = time.perf_counter()
+
+            if statement is not None:
+                Database.cache.put(guild_id, *cache, statement, result)
+            elif Database.cache is not None and cursor.description is None:
+                Database.cache.invalidate_query(guild_id, query, cache)
+
+            # Commit the database, or queue the commit when group commit is enabled.
+            # cursor.description is None for anything that isn't returning rows.
+            committing = time.perf_counter()
+            if not database_settings["group_commit"]:
+                connection.commit()
+
+            elif cursor.description is None and connection.in_transaction:
+                pending = Database.pending.setdefault(connection, [guild_id, 0])
+                pending[1] += 1
+
+                # Too many writes waiting, don't wait for the commit loop
+                if pending[1] >= database_settings["commit_max_pending"]:
+                    Database.dbCommit(self, guild_id)
+
+            if Database.query_log is not None:
+                timings = (executed - start, fetched - executed, time.perf_counter() - committing)
+                Database.query_log.record(guild_id, query, values, many, timings, connection)
+
+            rows = connection.total_changes - changes
+            cursor.close()
+
+        if returnRows:
+            return result, rows
 
+        return result
+
+    def dbTransaction(self, guild_id: int, steps: list):
+        """
+        dbTransaction(self, guild_id as Integer, steps as [(query, values, many)])
+
+        Runs every step in a single transaction while holding the guild lock, so no other
+        query on the guild can commit part of it. Pass many = True to run a step once for
+        every set of values. If a step fails everything is rolled back, and the error raised.
+        Blocks until it is done, use dbTransactionAsync from coroutines.
+
+        returns the number of rows changed
+        """
+        with Database.lock[guild_id]:
+            connection = Database.connection[guild_id]
+
+            # Group commit writes go in first, so they aren't rolled back with a failed transaction
+            if connection.in_transaction:
+                connection.commit()
+                Database.pending.pop(connection, None)
+
+            changes = connection.total_changes
+            cursor = Database.cursor[guild_id]
+            query = "BEGIN"
+            try:
+                cursor.execute(query)
+                for query, values, many in steps:
+                    start = time.perf_counter()
+                    if many:
+                        cursor.executemany(query, values)
+                    else:
+                        cursor.execute(query, values)
+
+                    if Database.query_log is not None:
+                        timings = (time.perf_counter() - start, 0.0, 0.0)
+                        Database.query_log.record(guild_id, query, values, many, timings, connection)
+
+                connection.commit()
+
+            except sqlite3.Error as error:
+                connection.rollback()
+                logger.warning(f"SQL Error, the transaction was rolled back\nquery: {query}\nerror: {error}")
+                raise
+
+            finally:
+                cursor.close()
+                if Database.cache is not None:
+                    for query, _, _ in steps:
+                        Database.cache.invalidate_query(guild_id, query)
+
+            return connection.total_changes - changes
+
+    async def dbTransactionAsync(self, guild_id: int, steps: list):
+        """
+        await dbTransactionAsync(self, guild_id as Integer, steps as [(query, values, many)])
+
+        Same as dbTransaction, but run on the guilds worker thread so the event loop is free meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        worker = Database.workers[guild_id % len(Database.workers)]
+
+        return await loop.run_in_executor(worker, Database.dbTransaction, self, guild_id, steps)
+
+    def dbGlobalExecute(self, query: str, values: list = (), fetchAll: bool = False, **kwargs):
+        """
+        dbGlobalExecute(self, query as String, values as List, fetchAll as boolean)
+
+        Runs a query against the global database, see util.global_database.
+        Pass many = True to run it once for every set of values.
+        Blocks until the query is done, use dbGlobalExecuteAsync from coroutines.
+        """
         try:
-            # Run our query
-            cursor.execute(query, values)
+            return Database.global_db.execute(query, values, fetchAll, kwargs.get("many", False))
 
         except sqlite3.Error as error:
-            # Pass hide_error = True in call to hide error output
             if not kwargs.get("hide_error", False):
-                # If there is an error, will print to console and return None
-                logger.warning(f"SQL Error\nquery: {query} \nvalues: {values}\nerror: {error}")
-            raise  # re-raise exception.
+                logger.warning(f"Global SQL Error\nquery: {query} \nvalues: {values}\nerror: {error}")
+            raise
+
+    async def dbGlobalExecuteAsync(self, query: str, values: list = (), fetchAll: bool = False, **kwargs):
+        """
+        await dbGlobalExecuteAsync(self, query as String, values as List, fetchAll as boolean)
+
+        Same as dbGlobalExecute, but the query is run on the global worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        query_call = functools.partial(Database.dbGlobalExecute, self, query, values, fetchAll, **kwargs)
+
+        return await loop.run_in_executor(Database.global_worker, query_call)
+
+    def dbCommit(self, guild_id: int):
+        """
+        Commits any pending writes for the guild.
+        """
+        with Database.lock[guild_id]:
+            connection = Database.connection[guild_id]
+            connection.commit()
+            Database.pending.pop(connection, None)
+
+    def dbFlush(self, guild_id: int = None):
+        """
+        dbFlush(self, guild_id as Integer)
 
-        # Return all rows, or just one.
-        if fetchAll:
-            result = cursor.fetchall()
+        Commits the pending group commit writes for a guild, or every guild if guild_id is None.
+        Blocks until the commits are done, use dbFlushAsync from coroutines.
+        """
+        if guild_id is not None:
+            Database.dbCommit(self, guild_id)
+            return
+
+        for pending_guild_id, _ in list(Database.pending.values()):
+            Database.dbCommit(self, pending_guild_id)
+
+    async def dbFlushAsync(self, guild_id: int = None):
+        """
+        await dbFlushAsync(self, guild_id as Integer)
+
+        Commits the pending group commit writes for a guild, or every guild if guild_id is None.
+        The commits are run on the guilds worker threads.
+        """
+        loop = asyncio.get_running_loop()
+
+        if guild_id is not None:
+            guild_ids = [guild_id]
         else:
-            result = cursor.fetchone()
+            guild_ids = [pending_guild_id for pending_guild_id, _ in list(Database.pending.values())]
 
-        # Commit the database
-        Database.connection[guild_id].commit()
+        commits = list()
+        for each in guild_ids:
+            worker = Database.workers[each % len(Database.workers)]
+            commits.append(loop.run_in_executor(worker, Database.dbCommit, self, each))
 
-        if returnRows:
-            return result, cursor.rowcount
+        await asyncio.gather(*commits)
 
-        return result
+    @tasks.loop(seconds=database_settings["commit_interval"])
+    async def commit_loop(self):
+        """
+        Commits the writes that group commit has been holding on to.
+        """
+        if not Database.pending:
+            return
+
+        start = time.monotonic()
+        pending_writes = sum(writes for _, writes in Database.pending.values())
+
+        try:
+            await self.dbFlushAsync()
+        except sqlite3.Error as error:
+            logger.warning(f"Group commit failed, will retry next loop. {error}")
+            return
+
+        logger.debug(f"Group commit of {pending_writes} writes took {time.monotonic() - start:.3f} seconds")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def dbstats(self, ctx):
+        """
+        Shows database statistics
+        """
+        lines = ["Load timings", f"{'phase':<30}{'count':>8}{'total s':>10}{'avg ms':>10}"]
+        for phase, (count, total) in sorted(Database.load_timings.items()):
+            lines.append(f"{phase:<30}{count:>8}{total:>10.3f}{total / count * 1000:>10.2f}")
+
+        lines.append(f"Guilds loaded: {len(Database.Main)}, deferred: {len(Database.deferred)}")
+
+        lines.append("")
+        lines.append(f"Connections ({type(Database.storage).__name__})")
+        for name, value in Database.storage.stats().items():
+            lines.append(f"{name:<30}{value:>8}")
+
+        if Database.cache is not None:
+            lines.append("")
+            lines.append("Query cache")
+            for name, value in Database.cache.stats().items():
+                lines.append(f"{name:<30}{value:>8}")
+
+        if Database.maintenance is not None:
+            lines.append("")
+            lines.append("Maintenance")
+            for name, value in Database.maintenance.stats().items():
+                lines.append(f"{name:<30}{value:>8}")
+
+        await self.dbSendLines(ctx, lines)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def dbslow(self, ctx, count: int = 10):
+        """
+        Shows the statements that took the most time in the last hour or two
+        Times are in ms, p50 and p95 are the upper bound of the histogram bucket they fall in.
+        Usage: dbslow [count]
+        """
+        if Database.query_log is None:
+            await ctx.send("The query log is off, set database_query_log to true to turn it on.")
+            return
+
+        histograms = Database.query_log.histograms()
+        lines = [
+            f"Slower than {Database.query_log.slow_ms} ms is logged, {len(histograms)} statements",
+            f"{'#':>3}{'count':>9}{'avg':>9}{'p50':>8}{'p95':>8}{'max':>9}{'slow':>6}  statement",
+        ]
+        for index, (statement, histogram) in enumerate(histograms[:count], 1):
+            lines.append(
+                f"{index:>3}{histogram.count:>9}{histogram.total / histogram.count:>9.2f}"
+                f"{histogram.percentile(50):>8g}{histogram.percentile(95):>8g}{histogram.max:>9.1f}"
+                f"{histogram.slow:>6}  {statement[:80]}"
+            )
+
+        await self.dbSendLines(ctx, lines)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def dbhistogram(self, ctx, index: int):
+        """
+        Shows the histogram of a statement from dbslow
+        Usage: dbhistogram index
+        """
+        if Database.query_log is None:
+            await ctx.send("The query log is off, set database_query_log to true to turn it on.")
+            return
+
+        histograms = Database.query_log.histograms()
+        if not 1 <= index <= len(histograms):
+            await ctx.send(f"There is no statement {index}, dbslow lists {len(histograms)}.")
+            return
+
+        statement, histogram = histograms[index - 1]
+        lines = [statement, "", f"{'ms':>8}{'count':>9}"]
+
+        widest = max(histogram.buckets)
+        for bucket, count in enumerate(histogram.buckets):
+            bound = f"<={Histogram.bounds[bucket]:g}" if bucket < len(Histogram.bounds) else f">{Histogram.bounds[-1]:g}"
+            lines.append(f"{bound:>8}{count:>9}  {'#' * round(count / widest * 40)}")
+
+        await self.dbSendLines(ctx, lines)
+
+    async def dbSendLines(self, ctx, lines: list):
+        """Sends the lines in code blocks, split to stay under the discord message limit"""
+        message = ""
+        for line in lines:
+            # A single line that is too long is cut short
+            line = line[:1900]
+            if len(message) + len(line) > 1900:
+                await ctx.send(f"```{message}```")
+                message = ""
+            message += f"{line}\n"
+
+        await ctx.send(f"```{message}```")
+
+    @tasks.loop(minutes=1)
+    async def idle_loop(self):
+        """
+        Checkpoints and closes guild databases that have been idle for idle_timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(Database.loader, Database.storage.close_idle, database_settings["idle_timeout"])
+
+    @tasks.loop(minutes=database_settings["wal_archive_interval"])
+    async def wal_archive_loop(self):
+        """
+        Archives the WAL of every open guild database for point in time recovery.
+        Closed guilds were archived when they were closed.
+        """
+        await self.dbFlushAsync()
+
+        loop = asyncio.get_running_loop()
+        archives = [
+            loop.run_in_executor(Database.loader, Database.storage.archive_wal, guild_id)
+            for guild_id in list(Database.storage.connections)
+        ]
+
+        for result in await asyncio.gather(*archives, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning(f"WAL archive failed. {result}")
+
+    @tasks.loop(seconds=database_settings["maintenance_tick"])
+    async def maintenance_loop(self):
+        """
+        Gives the next idle guild its turn of maintenance.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(Database.loader, Database.dbMaintain, self)
+
+    def dbMaintain(self):
+        """
+        Runs a turn of maintenance on the next guild that is due, see util.maintenance.
+        A guild that is in use is skipped until the next turn.
+        """
+        guild_id = Database.maintenance.next_guild(Database.storage.guild_ids(), Database.storage.last_used)
+        if guild_id is None:
+            return
+
+        lock = Database.lock[guild_id]
+        if not lock.acquire(blocking=False):
+            return
+
+        try:
+            # Closed since it was picked, don't open it again just to maintain it
+            connection = Database.storage.connections.get(guild_id)
+            if connection is None:
+                return
+
+            # VACUUM can't run with a transaction open
+            if connection.in_transaction:
+                connection.commit()
+                Database.pending.pop(connection, None)
+
+            Database.maintenance.run(guild_id, connection)
+
+        except sqlite3.Error as e:
+            logger.warning(f"Maintenance of {guild_id} failed. {e}")
+
+        finally:
+            lock.release()
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def restoreguild(self, ctx, guild_id: int, *, until: str):
+        """
+        Restores a guild's database to a time in UTC
+        Usage: restoreguild guild_id 2021-03-01 17:30
+        """
+        if Database.storage.archive is None:
+            await ctx.send("The WAL archive is not enabled, set database_wal_archive to true.")
+            return
+
+        try:
+            until = parse_time(until)
+        except ValueError:
+            await ctx.send(f"Unable to read the time {until}, use 2021-03-01 17:30")
+            return
+
+        archive = Database.storage.archive
+        target = f"{archive.guild_path(guild_id)}/restore.db3"
+        loop = asyncio.get_running_loop()
+
+        try:
+            # Rebuild and check the database off to the side, the guild keeps running meanwhile
+            restored_to = await loop.run_in_executor(Database.loader, archive.restore, guild_id, until, target)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            await ctx.send(f"Restore failed, nothing was changed. {e}")
+            return
+
+        # What the cogs hold in memory is from before the restore, don't let them write it over it
+        Database.dbGuildHooks(self, guild_id, False)
+
+        await self.dbFlushAsync(guild_id)
+        await loop.run_in_executor(Database.loader, Database.storage.replace, guild_id, target)
+        os.remove(target)
+
+        # Anything read from the old database while it was being replaced
+        Database.dbGuildHooks(self, guild_id, False)
+
+        if Database.cache is not None:
+            Database.cache.invalidate(guild_id)
+
+        # The restored database can be at older schema versions
+        Database.migrations.forget(guild_id)
+
+        # Read the restored settings back into memory, and set the cogs up again from them.
+        # A guild lazy_load hasn't loaded yet is read when it is loaded.
+        if guild_id in Database.Main:
+            await loop.run_in_executor(Database.loader, self.loadGuildDatabase, guild_id)
+            Database.dbSetupGuild(self, guild_id)
+
+        logger.warning(f"Guild {guild_id} restored to {restored_to} by {ctx.author}.")
+        await ctx.send(f"Guild {guild_id} restored to {restored_to} UTC.")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    @commands.dm_only()
+    async def exportguild(self, ctx, guild_id: int, table: str = "users", file_format: str = "csv"):
+        """
+        Exports a guild's table to compressed CSV or JSONL
+        Usage: exportguild guild_id [users|settings|table] [csv|jsonl]
+        """
+        if file_format not in export.formats:
+            await ctx.send(f"Unknown format {file_format}, use {' or '.join(export.formats)}.")
+            return
+
+        path, shard_guild_id = Database.dbGuildFile(self, guild_id)
+        if path is None:
+            await ctx.send("exportguild needs guild or consolidated storage.")
+            return
+
+        if not os.path.exists(path):
+            await ctx.send(f"There is no database for {guild_id}.")
+            return
+
+        if not os.path.exists(database_settings["export_path"]):
+            os.makedirs(database_settings["export_path"])
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        target = f"{database_settings['export_path']}/{guild_id}-{table}-{timestamp}.{file_format}.gz"
+        snapshot = f"{database_settings['export_path']}/{guild_id}-{timestamp}.db3"
+
+        message = await ctx.send(f"Exporting {table} for {guild_id}...")
+        loop = asyncio.get_running_loop()
+        last_update = [time.monotonic()]
+
+        def progress(written, total):
+            # Called from the loader thread, the message is edited at most every 2 seconds
+            if time.monotonic() - last_update[0] >= 2:
+                last_update[0] = time.monotonic()
+                edit = message.edit(content=f"Exporting {table} for {guild_id}... {written} of {total} rows")
+                asyncio.run_coroutine_threadsafe(edit, loop)
+
+        def run_export():
+            # Export from a snapshot, so the guild isn't locked while the rows are written
+            if not Database.dbSnapshot(self, path, snapshot):
+                raise ValueError("the snapshot failed its integrity check")
+
+            db = export.connect(snapshot)
+            try:
+                return export.export(db, table, target, file_format, shard_guild_id, progress)
+            finally:
+                db.close()
+
+        await self.dbFlushAsync(guild_id)
+        start = time.perf_counter()
+
+        try:
+            rows = await loop.run_in_executor(Database.loader, run_export)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            await message.edit(content=f"Export of {table} for {guild_id} failed. {e}")
+            return
+        finally:
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+        result = f"Exported {rows} {table} rows for {guild_id} in {time.perf_counter() - start:.1f}s."
+        await message.edit(content=result)
+        logger.info(f"{result} {target}")
+
+        # Discord's upload limit
+        if os.path.getsize(target) < 8 * 1024 * 1024:
+            await ctx.send(file=discord.File(target))
+        else:
+            await ctx.send(f"The file is too large to send, it is at {target}")
+
+    def cog_unload(self):
+        self.idle_loop.cancel()  # pylint: disable=no-member
+        self.wal_archive_loop.cancel()  # pylint: disable=no-member
+        self.maintenance_loop.cancel()  # pylint: disable=no-member
+
+        if database_settings["group_commit"]:
+            self.commit_loop.cancel()  # pylint: disable=no-member
+            Database.dbFlush(self)
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -313,38 +1390,91 @@ class Database(commands.Cog):
         # Make sure the bot is ready before starting
         await self.client.wait_until_ready()
 
+        # Get the pending group commit writes into the files before copying them
+        await self.dbFlushAsync()
+
         # Guard Clause
-        if backup["method"] == "none":
-            return
-        if not backup["method"] == "ftp" or backup["method"] == "copyonly":
+        if backup["method"] not in ["ftp", "copyonly"]:
             return
 
-        upload_files = list()
-        successful_upload = list()
+        start = time.perf_counter()
 
         # Check if backup directory exists, if not create it
         if not os.path.exists(backup["backup_path"]):
             os.mkdir(backup["backup_path"])
 
-        # Loop through the active databases
-        for filename in os.listdir("./db"):
-            if filename.endswith(".db3"):
-                # Find the guild ID based on filename
-                guild_id = int(f"{filename[:-4]}")
+        # What was backed up last time, {name: {"state", "sha256", "file", "time"}}
+        manifest = Database.dbReadManifest(self)
+
+        # Skip the files that haven't been written since their last successful backup
+        files = self.dbFiles()
+        changed = list()
+        for name, path in files:
+            if manifest.get(name, dict()).get("state") != Database.dbFileState(self, path):
+                changed.append((name, path))
+
+        logger.info(f"Backing up {len(changed)} of {len(files)} databases.")
+
+        # Snapshot and compress the changed files side by side on the worker threads
+        loop = asyncio.get_running_loop()
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        snapshots = await asyncio.gather(
+            *[
+                loop.run_in_executor(Database.loader, functools.partial(Database.dbBackupFile, self, name, path, timestamp))
+                for name, path in changed
+            ]
+        )
+
+        upload_files = dict()  # {filename: (name, manifest entry)}
+        for (name, path), snapshot in zip(changed, snapshots):
+            if snapshot is None:
+                continue
+
+            filename, entry = snapshot
+            if manifest.get(name, dict()).get("sha256") == entry["sha256"]:
+                # Written to, but the contents are the same as the last backup
+                manifest[name]["state"] = entry["state"]
+                os.remove(f"{backup['backup_path']}{filename}")
+                continue
+
+            upload_files[filename] = (name, entry)
+
+        if backup["method"] == "copyonly":
+            successful_upload = list(upload_files)
 
-                new_filename = f'{guild_id}-{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.db3'
+        else:
+            successful_upload = await self.backupUpload(list(upload_files))
 
-                try:
-                    # Make a copy of the file
-                    copyfile(f"./db/{filename}", f"{backup['backup_path']}{new_filename}")
-                    logger.info(f"File {guild_id}.db3 copied to {backup['backup_path']}.")
+            for each in successful_upload:
+                os.remove(f"{backup['backup_path']}{each}")
 
-                    upload_files.append(new_filename)
+        for each in successful_upload:
+            name, entry = upload_files[each]
+            manifest[name] = entry
 
-                except OSError:
-                    logger.warning(">>>>>>>>OS Error when copying to backup file.<<<<<<<<")
+        Database.dbWriteManifest(self, manifest)
 
         if backup["method"] == "ftp":
+            # Keep a copy of the manifest with the backups
+            await self.backupUpload(["manifest.json"])
+
+        size = sum(upload_files[each][1]["size"] for each in successful_upload)
+        logger.info(
+            f"Backup complete, {len(successful_upload)} files, {size / 1024:.1f} KiB "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+    async def backupUpload(self, upload_files: list):
+        """
+        Uploads the files from backup_path with upload_workers ftp sessions at a time.
+        Returns the files that were uploaded.
+        """
+        successful_upload = list()
+        queue = asyncio.Queue()
+        for each in upload_files:
+            queue.put_nowait(each)
+
+        async def upload_worker():
             try:
                 async with aioftp.ClientSession(
                     backup["upload_server"],
@@ -352,7 +1482,8 @@ class Database(commands.Cog):
                     backup["user"],
                     backup["passwd"],
                 ) as client:
-                    for each in upload_files:
+                    while not queue.empty():
+                        each = queue.get_nowait()
                         try:
                             logger.info(f"Uploading {each}...")
                             await client.upload(
@@ -363,50 +1494,131 @@ class Database(commands.Cog):
 
                             successful_upload.append(each)
                         except:
-                            logger.warning(">>>>>>>>Upload error.<<<<<<<<")
+                            logger.warning(f">>>>>>>>Upload error for {each}.<<<<<<<<")
             except:
                 logger.warning(">>>>>>>>FTP Connection error to backup server.<<<<<<<<")
-                return
 
-            for each in successful_upload:
-                os.remove(f"{backup['backup_path']}{each}")
+        workers = min(backup["upload_workers"], len(upload_files))
+        await asyncio.gather(*[upload_worker() for _ in range(workers)])
 
-        logger.info("Backup complete")
+        return successful_upload
 
-    def writeSettings(self, guild_id):
+    def dbFileState(self, path: str):
+        """Size and modified time of the database and its WAL file, these change on every commit"""
+        state = list()
+        for each in [path, f"{path}-wal"]:
+            if os.path.exists(each):
+                stat = os.stat(each)
+                state.extend([stat.st_size, stat.st_mtime_ns])
+
+        return state
+
+    def dbReadManifest(self):
+        try:
+            with open(f"{backup['backup_path']}manifest.json") as f:
+                return json.load(f)
+
+        except (OSError, ValueError):
+            return dict()
+
+    def dbWriteManifest(self, manifest: dict):
+        # Write to a temporary file first so a crash can't leave a half written manifest
+        filename = f"{backup['backup_path']}manifest.json"
+        with open(f"{filename}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{filename}.tmp", filename)
+
+    def dbBackupFile(self, name: str, path: str, timestamp: str):
         """
-        Write settings to the database.
+        Snapshots a database into backup_path as {name}-{timestamp}.db3.gz.
+        Returns (filename, manifest entry), or None if the snapshot failed.
         """
-        # Disable all the no-member violations in this function for references to self.name
-        # pylint: disable=no-member
+        filename = f"{name}-{timestamp}.db3.gz"
+        snapshot = f"{backup['backup_path']}{name}-{timestamp}.db3"
 
-        if hasattr(guild_id, "id"):
-            guild_id = guild_id.id
+        # Taken before the snapshot, so a write during the snapshot is picked up next time
+        state = Database.dbFileState(self, path)
 
-        cursor = Database.cursor[guild_id]
+        try:
+            if not Database.dbSnapshot(self, path, snapshot):
+                return None
 
-        values = list()
+            # Compress and hash the snapshot in one pass
+            sha256 = hashlib.sha256()
+            with open(snapshot, "rb") as source, gzip.open(f"{backup['backup_path']}{filename}", "wb") as destination:
+                for chunk in iter(functools.partial(source.read, 1024 * 1024), b""):
+                    sha256.update(chunk)
+                    destination.write(chunk)
 
-        for setting_key in Database.Cogs[self.name][guild_id]["settings"]:
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f">>>>>>>>Error when copying {path} to backup file: {e}<<<<<<<<")
+            return None
 
-            setting_data = Database.Cogs[self.name][guild_id]["settings"][setting_key]
+        finally:
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
 
-            # Check if the setting has an id attribute, if so save that instead of the object.
-            if hasattr(Database.Cogs[self.name][guild_id]["settings"][setting_key], "id"):
-                setting_data = setting_data.id
+        logger.info(f"File {path} copied to {backup['backup_path']}.")
 
-            query = f"UPDATE {self.name}_settings SET setting_data = ? WHERE setting_id = ? "
-            values = (setting_data, setting_key)
-            _, rows = Database.dbExecute(  # Not using the result, so not saving it.
-                self, cursor, guild_id, query, values, False, True
-            )
+        entry = {
+            "state": state,
+            "sha256": sha256.hexdigest(),
+            "file": filename,
+            "size": os.path.getsize(f"{backup['backup_path']}{filename}"),
+            "time": timestamp,
+        }
+
+        return filename, entry
 
-            # Setting has not been saved before
-            if rows == 0:
-                # Insert the row
-                query = f"INSERT INTO {self.name}_settings (setting_id, setting_data) VALUES (?, ?)"
-                values = (setting_key, setting_data)
-                Database.dbExecute(self, cursor, guild_id, query, values)
+    def dbSnapshot(self, path: str, target: str):
+        """
+        Copies the database at path to target with SQLite's online backup API.
+
+        Pages are copied backup["pages"] at a time with a short sleep in between so writes
+        from the bot can get through. If the file is written in the middle of the copy SQLite
+        starts over, so the snapshot is always a consistent copy.
+        Returns True if the snapshot passed an integrity check, otherwise removes it.
+        """
+        # A separate read only connection, so the guild's connection stays free for the bot.
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        destination = sqlite3.connect(target)
+
+        try:
+            source.backup(destination, pages=backup["pages"], sleep=0.005)
+            result = destination.execute("PRAGMA integrity_check").fetchall()
+
+        except sqlite3.DatabaseError as e:
+            # The source itself is unreadable
+            result = [(str(e),)]
+
+        finally:
+            destination.close()
+            source.close()
+
+        if result != [("ok",)]:
+            logger.warning(f">>>>>>>>Backup of {path} failed: {result[:5]}<<<<<<<<")
+            os.remove(target)
+            return False
+
+        return True
+
+    def writeSettings(self, guild_id):
+        """
+        Write the settings that changed since they were read or last written to the database.
+        """
+        # Disable all the no-member violations in this function for references to self.name
+        # pylint: disable=no-member
+
+        if hasattr(guild_id, "id"):
+            guild_id = guild_id.id
+
+        settings = Database.Cogs[self.name][guild_id]["settings"]
+        changes = settings.changes()
+        if not changes:
+            return
+
+        SettingsTable.get(self.name).write_many(self, guild_id, changes)
+        settings.mark_saved(changes)
 
     def readSettings(self):
         """Used to read all of the guilds settings."""
@@ -417,8 +1629,20 @@ class Database(commands.Cog):
         if not Database.Cogs.get(self.name, False):
             Database.Cogs[self.name] = dict()
 
-        for guild_id in Database.Main:
-            Database.readSettingsGuild(self, guild_id)
+        start = time.perf_counter()
+
+        # Guilds that are already in memory are kept, their decoded settings are up to date.
+        # Use readSettingsGuild to force a guild to be read again.
+        guild_ids = list()
+        for guild_id in list(Database.Main):
+            if not isinstance(Database.Cogs[self.name].get(guild_id, dict()).get("settings"), Settings):
+                guild_ids.append(guild_id)
+
+        # Read the guilds side by side, list() makes sure any exception is raised here.
+        read_guild = functools.partial(Database.readSettingsGuild, self)
+        list(Database.loader.map(read_guild, guild_ids))
+
+        Database.dbTiming(self, f"settings {self.name}", start)
 
     def readSettingsGuild(self, guild_id):
         """Used to read a specific guilds settings"""
@@ -426,44 +1650,43 @@ class Database(commands.Cog):
         # pylint: disable=no-member
 
         Database.Cogs[self.name][guild_id] = dict()
-        Database.Cogs[self.name][guild_id]["settings"] = dict()
-
-        # Set database handle
-        cursor = Database.cursor[guild_id]
+        Database.Cogs[self.name][guild_id]["settings"] = Settings()
 
-        # Query the database
-        query = f"SELECT setting_id, setting_data FROM {self.name}_settings"
+        table = SettingsTable.get(self.name)
 
         try:
-            result = Database.dbExecute(self, cursor, guild_id, query, list(), True)
+            result = table.read(self, guild_id)
 
         except sqlite3.OperationalError as e:
             # The table doesn't exist, so we're going to create it and re-run the query.
             if "no such table" in e.args[0]:
-                insert_query = f"""CREATE TABLE IF NOT EXISTS {self.name}_settings(
-                                    setting_id TEXT, setting_data TEXT)"""
-                Database.dbExecute(self, cursor, guild_id, insert_query)
-                logger.info(f"{self.name}_settings table created for {guild_id}.")
+                Database.dbExecute(self, None, guild_id, table.create)
+                logger.info(f"{table.table} table created for {guild_id}.")
 
-                result = Database.dbExecute(self, cursor, guild_id, query, list(), True)
+                result = table.read(self, guild_id)
 
-        # Handle to access guild
-        handle = Database.Cogs[self.name][guild_id]
+        # Older versions could save a setting more than once, the last row read is the one
+        # that was used. Keep only that one so the unique index can be created.
+        rows = dict(result)
+        if len(rows) != len(result):
+            counts = Counter(row[0] for row in result)
+            duplicates = [setting_id for setting_id, count in counts.items() if count > 1]
 
-        # Read all of the settings, and store them in a dictionary
-        for each_result in result:
-            # Save all of the settings
+            with Database.lock[guild_id]:
+                # Both statements go in one transaction
+                cursor = Database.cursor[guild_id]
+                cursor.executemany(table.delete, [(key,) for key in duplicates])
+                cursor.executemany(table.insert, [(key, rows[key]) for key in duplicates])
+                Database.connection[guild_id].commit()
+                cursor.close()
 
-            # If the setting is completely numeric, save it as an integer, otherwise leave it a string
-            if each_result[1] == None:
-                # Check for None before allowing .isnumeric to run to prevent error
-                handle["settings"][each_result[0]] = None
+            logger.info(f"Removed {len(result) - len(rows)} duplicate {table.table} rows for {guild_id}.")
 
-            elif each_result[1].isnumeric():
-                handle["settings"][each_result[0]] = int(each_result[1])
+        # writeSettings UPSERTs on setting_id
+        Database.dbExecute(self, None, guild_id, table.unique_index)
 
-            else:
-                handle["settings"][each_result[0]] = each_result[1]
+        # Decode the settings once and keep them in memory
+        Database.Cogs[self.name][guild_id]["settings"].load(rows.items())
 
         # If the cog does not have the enabled flag stored in memory, set it to True
         if not Database.Cogs[self.name][guild_id]["settings"].get("enabled", False):
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Streams a guild's tables out to gzip compressed CSV or JSONL, used by util.database.
+
+Rows are read with fetchmany a chunk at a time and written straight out, so memory
+use stays the same no matter how many rows the guild has. exportguild reads from a
+snapshot taken with the online backup API, so the bot's writes aren't held up while
+the rows are streamed out.
+
+settings exports main and every {cog}_settings table together, with the table name
+in the first column. Any other name is exported as the table with that name.
+
+From the bot owner command exportguild, or with:
+    python -m util.export {guild_id} users --format csv
+    python -m util.export {guild_id} settings --format jsonl --shards 4
+"""
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+formats = ["csv", "jsonl"]
+
+# Rows read with each fetchmany
+chunk_size = 1000
+
+
+def connect(path: str):
+    """Read only connection to a guild or shard file"""
+    if not os.path.exists(path):
+        raise ValueError(f"{path} doesn't exist.")
+
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def tables(db: sqlite3.Connection, guild_id: int = None):
+    """
+    Returns the tables in a guild file, or in a shard file when guild_id is given.
+    """
+    query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    names = [row[0] for row in db.execute(query)]
+
+    if guild_id is None:
+        return names
+
+    return [name[len("guilds_") :] for name in names if name.startswith("guilds_")]
+
+
+def select(db: sqlite3.Connection, table: str, guild_id: int = None):
+    """
+    Returns (query, values) that reads the table, for a guild file or a guild in a shard file.
+    """
+    if table not in tables(db, guild_id):
+        raise ValueError(f"There is no {table} table.")
+
+    if guild_id is None:
+        return f'SELECT * FROM "{table}"', ()
+
+    columns = [f'"{row[1]}"' for row in db.execute(f'PRAGMA table_info("guilds_{table}")') if row[1] != "guild_id"]
+    return f'SELECT {", ".join(columns)} FROM "guilds_{table}" WHERE guild_id = ?', (guild_id,)
+
+
+def select_settings(db: sqlite3.Connection, guild_id: int = None):
+    """Returns (query, values) that reads every settings table, with the table name in front"""
+    queries = list()
+    values = list()
+    for table in tables(db, guild_id):
+        if table != "main" and not table.endswith("_settings"):
+            continue
+
+        if guild_id is None:
+            source = f'"{table}"'
+        else:
+            source = f'"guilds_{table}" WHERE guild_id = ?'
+            values.append(guild_id)
+
+        name = f"'{table}'"
+        queries.append(f'SELECT {name} AS "table", setting_id, setting_data FROM {source}')
+
+    if not queries:
+        raise ValueError("There are no settings tables.")
+
+    return " UNION ALL ".join(queries), tuple(values)
+
+
+def export(db: sqlite3.Connection, table: str, target: str, file_format: str = "csv", guild_id: int = None, progress=None):
+    """
+    Writes the table to target, gzip compressed.
+    progress is called with (rows written, total rows) after every chunk.
+    Returns the number of rows written.
+    """
+    if file_format not in formats:
+        raise ValueError(f"Unknown format {file_format}, use {' or '.join(formats)}.")
+
+    if table == "settings":
+        query, values = select_settings(db, guild_id)
+    else:
+        query, values = select(db, table, guild_id)
+
+    total = db.execute(f"SELECT COUNT(*) FROM ({query})", values).fetchone()[0]
+
+    cursor = db.execute(query, values)
+    columns = [each[0] for each in cursor.description]
+    written = 0
+
+    # Written to a temporary file first so a failed export doesn't look like a finished one
+    with gzip.open(f"{target}.tmp", "wt", encoding="utf-8", newline="") as f:
+        if file_format == "csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            if file_format == "csv":
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    f.write("\n")
+
+            written += len(rows)
+            if progress is not None:
+                progress(written, total)
+
+    os.replace(f"{target}.tmp", target)
+    return written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(name)s: %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Export a guild's table to compressed CSV or JSONL")
+    parser.add_argument("guild_id", type=int)
+    parser.add_argument("table", help="users, settings, or any other table")
+    parser.add_argument("--format", default="csv", choices=formats)
+    parser.add_argument("--output", help="Defaults to {guild_id}-{table}.{format}.gz")
+    parser.add_argument("--db-path", default="db")
+    parser.add_argument("--shard-path", default="db/shards")
+    parser.add_argument("--shards", type=int, help="Read from consolidated storage with this many shards")
+
+    args = parser.parse_args()
+    output = args.output or f"{args.guild_id}-{args.table}.{args.format}.gz"
+
+    if args.shards:
+        db = connect(f"{args.shard_path}/{args.guild_id % args.shards}.db3")
+        guild_id = args.guild_id
+    else:
+        db = connect(f"{args.db_path}/{args.guild_id}.db3")
+        guild_id = None
+
+    def show_progress(written, total):
+        sys.stderr.write(f"\r{written} of {total} rows")
+        sys.stderr.flush()
+
+    try:
+        rows = export(db, args.table, output, args.format, guild_id, show_progress)
+    finally:
+        db.close()
+
+    sys.stderr.write("\n")
+    logger.info(f"Exported {rows} rows to {output}.")
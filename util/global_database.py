@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+The global database, used by util.database, for data that belongs to a user instead of a guild.
+
+It is a single file next to the guild databases, db/global/global.db3 by default, so a
+question across every guild is one indexed query instead of opening every guild file.
+
+    karma           upvotes and downvotes per guild and user, kept in step with the
+                    guilds users table by Karma. karma_user_id covers the totals.
+    twitch_owners   the discord user that owns a twitch channel, set by each guild watching it
+    bans            users banned from every guild the bot is in
+    guild_bans      every ban seen in a guild, guild_bans_user_id finds a user's bans
+
+Run queries with Database.dbGlobalExecute and Database.dbGlobalExecuteAsync.
+"""
+import os
+import sqlite3
+import threading
+
+from util.migrations import Migrations
+
+
+class GlobalDatabase:
+    def __init__(self, path: str = "db/global/global.db3"):
+        self.path = path
+
+        if path != ":memory:" and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # Shared by the event loop and the global worker thread, access is serialized with lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+        # The global database is versioned like a guild, as guild 0
+        self.migrations = Migrations()
+        self.migrations.register(
+            "global",
+            1,
+            """CREATE TABLE IF NOT EXISTS karma(
+               guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+               upvotes INTEGER NOT NULL DEFAULT 0, downvotes INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY(guild_id, user_id)) WITHOUT ROWID""",
+            "CREATE INDEX IF NOT EXISTS karma_user_id ON karma(user_id, upvotes, downvotes)",
+            """CREATE TABLE IF NOT EXISTS twitch_owners(
+               streamer TEXT NOT NULL, user_id INTEGER NOT NULL, guild_id INTEGER,
+               PRIMARY KEY(streamer))""",
+            "CREATE INDEX IF NOT EXISTS twitch_owners_user_id ON twitch_owners(user_id)",
+            """CREATE TABLE IF NOT EXISTS bans(
+               user_id INTEGER NOT NULL, reason TEXT, added_by INTEGER, added_at TEXT,
+               PRIMARY KEY(user_id))""",
+            # The naughty list BanHammer used to keep in the code
+            "INSERT OR IGNORE INTO bans(user_id, reason) VALUES (486042866901188628, 'Naughty-List')",
+            """CREATE TABLE IF NOT EXISTS guild_bans(
+               guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, banned_at TEXT,
+               PRIMARY KEY(guild_id, user_id)) WITHOUT ROWID""",
+            "CREATE INDEX IF NOT EXISTS guild_bans_user_id ON guild_bans(user_id)",
+        )
+        # Twitch owners were shared by every guild, so any guild could change them for the others.
+        # The owner each guild set is kept, rows without a guild are dropped.
+        self.migrations.register(
+            "global",
+            2,
+            """CREATE TABLE IF NOT EXISTS twitch_owners_v2(
+               streamer TEXT NOT NULL, guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+               PRIMARY KEY(streamer, guild_id)) WITHOUT ROWID""",
+            """INSERT OR REPLACE INTO twitch_owners_v2(streamer, guild_id, user_id)
+               SELECT streamer, guild_id, user_id FROM twitch_owners WHERE guild_id IS NOT NULL""",
+            "DROP TABLE twitch_owners",
+            "ALTER TABLE twitch_owners_v2 RENAME TO twitch_owners",
+            "CREATE INDEX IF NOT EXISTS twitch_owners_user_id ON twitch_owners(user_id)",
+        )
+
+    def migrate(self):
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                return self.migrations.run(None, 0, self.connection, cursor)
+            finally:
+                cursor.close()
+
+    def execute(self, query: str, values=(), fetchAll: bool = False, many: bool = False):
+        """Runs the query and commits, returns one row or all of them"""
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                if many:
+                    cursor.executemany(query, values)
+                else:
+                    cursor.execute(query, values)
+
+                result = cursor.fetchall() if fetchAll else cursor.fetchone()
+                self.connection.commit()
+
+            finally:
+                cursor.close()
+
+        return result
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
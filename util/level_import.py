@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Reads levels exported from another bot, used by the Levels command importlevels.
+
+MEE6 and most other bots export the total experience a member has, while Levels keeps the
+level and the experience gained since reaching it. thresholds is the total experience
+needed for every level, on the same 5 * (lvl ^ 2) + 50 * lvl + 100 curve as
+Levels.gainExperience, so each row is converted with one bisect and the whole file with
+one pass, instead of stepping through the levels of every member.
+
+Accepted files:
+    CSV with a header row, a user_id or id column and an xp or exp column
+    JSON, a list of {"id": ..., "xp": ...}, or MEE6's leaderboard {"players": [...]}
+"""
+import csv
+import io
+import json
+from bisect import bisect_right
+
+
+# Column names accepted for the user id and the total experience
+id_columns = ["user_id", "id", "userid"]
+exp_columns = ["xp", "exp", "experience", "total_xp"]
+
+
+def thresholds(max_exp: int):
+    """Returns [total experience needed to reach level n] up to the first level past max_exp"""
+    table = [0]
+    while table[-1] <= max_exp:
+        level = len(table) - 1
+        table.append(table[-1] + 5 * (level ** 2) + 50 * level + 100)
+
+    return table
+
+
+def levels(totals: list):
+    """Returns [(level, exp)] for a list of total experience"""
+    table = thresholds(max(totals, default=0))
+    found = [bisect_right(table, total) - 1 for total in totals]
+    return [(level, total - table[level]) for level, total in zip(found, totals)]
+
+
+def member(row: dict):
+    """Returns (user_id, total experience) from a row, raises AttributeError, TypeError or ValueError if it can't be"""
+    row = {str(key).strip().lower(): value for key, value in row.items()}
+    user_id = next((row[name] for name in id_columns if name in row), None)
+    exp = next((row[name] for name in exp_columns if name in row), None)
+
+    return int(user_id), max(int(float(exp)), 0)
+
+
+def read_csv(text: str):
+    """Returns a dict for each row, a row shorter than the header has None for the missing columns"""
+    reader = csv.DictReader(io.StringIO(text))
+    header = [str(name).strip().lower() for name in reader.fieldnames or list()]
+
+    for accepted in (id_columns, exp_columns):
+        if not any(name in header for name in accepted):
+            raise ValueError(f"There is no {' or '.join(accepted)} column.")
+
+    return reader
+
+
+def read_json(text: str):
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("players", list())
+
+    if not isinstance(data, list):
+        raise ValueError("Expected a list of members.")
+
+    return data
+
+
+def read(data: bytes, filename: str = ""):
+    """
+    Returns ({user_id: total experience}, number of rows skipped) for a CSV or JSON file.
+    A member that is in the file more than once keeps their last row.
+    Raises ValueError if the file can't be read.
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("The file isn't UTF-8 text.")
+
+    is_json = filename.lower().endswith(".json") or text.lstrip()[:1] in ("[", "{")
+
+    try:
+        rows = read_json(text) if is_json else read_csv(text)
+
+        members = dict()
+        skipped = 0
+        for row in rows:
+            try:
+                user_id, exp = member(row)
+                members[user_id] = exp
+            except (AttributeError, TypeError, ValueError):
+                # Not a dict, a short row, or values that aren't numbers
+                skipped += 1
+
+    except (json.JSONDecodeError, csv.Error) as e:
+        raise ValueError(str(e))
+
+    return members, skipped
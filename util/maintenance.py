@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Background maintenance for the guild databases, used by util.database.
+
+Every database_maintenance_tick seconds one open guild that hasn't been used for
+database_maintenance_idle seconds, and wasn't maintained in the last
+database_maintenance_interval hours, gets a turn. A turn runs as many of these as
+fit in database_maintenance_budget seconds while holding the guild's lock:
+
+    quick_check         PRAGMA quick_check, problems are logged
+    vacuum              PRAGMA incremental_vacuum, a few pages at a time
+    analyze             ANALYZE, with analysis_limit so large tables are sampled
+    optimize            PRAGMA optimize
+
+SQLite is interrupted when the budget runs out, anything interrupted is rolled back.
+A guild that isn't finished picks up where it left off on its next turn.
+
+Files created before auto_vacuum was turned on need a full VACUUM before
+incremental_vacuum does anything. That is tried once, and skipped from then on if
+the file is too large to VACUUM within the budget.
+"""
+import logging
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA auto_vacuum value
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Maintenance:
+
+    steps = ["quick_check", "vacuum", "analyze", "optimize"]
+
+    # Pages freed by each PRAGMA incremental_vacuum
+    vacuum_pages = 256
+
+    # Rows sampled per index by ANALYZE
+    analysis_limit = 1000
+
+    def __init__(self, budget: float = 0.1, interval: float = 24, idle: float = 300):
+        self.budget = budget
+        self.interval = interval * 60 * 60
+        self.idle = idle
+
+        self.last_run = dict()  # {guild_id: time.time() the last run finished}
+        self.running = dict()  # {guild_id: {"steps", "size", "elapsed"}} for runs that aren't finished
+        self.no_convert = set()  # guilds too large to VACUUM into auto_vacuum mode within the budget
+
+        self.guilds = 0
+        self.turns = 0
+        self.bytes_saved = 0
+        self.seconds = 0.0
+        self.interrupted = 0
+        self.problems = 0
+
+    def next_guild(self, guild_ids: list, last_used: dict):
+        """
+        Returns the guild to maintain next, or None if none are due.
+        Unfinished runs go first, then the guild that waited the longest.
+        Only guilds with an open connection are in last_used, the closed ones are skipped so
+        maintenance doesn't open them again.
+        """
+        now = time.monotonic()
+        idle = [guild_id for guild_id in guild_ids if guild_id in last_used and now - last_used[guild_id] >= self.idle]
+
+        for guild_id in idle:
+            if guild_id in self.running:
+                return guild_id
+
+        cutoff = time.time() - self.interval
+        due = [guild_id for guild_id in idle if self.last_run.get(guild_id, 0) < cutoff]
+        if not due:
+            return None
+
+        return min(due, key=lambda guild_id: self.last_run.get(guild_id, 0))
+
+    @staticmethod
+    def size(db: sqlite3.Connection):
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        return db.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+    def run(self, guild_id: int, db: sqlite3.Connection):
+        """
+        Runs the guild's next steps until they are done or the budget is used up.
+        Call while holding the guild's lock, with nothing left to commit.
+        Returns True when the guild's run is finished.
+        """
+        start = time.perf_counter()
+        deadline = start + self.budget
+
+        run = self.running.get(guild_id)
+        if run is None:
+            run = self.running[guild_id] = {"steps": list(Maintenance.steps), "size": Maintenance.size(db), "elapsed": 0.0}
+
+        # Returning True from the progress handler interrupts SQLite
+        db.set_progress_handler(lambda: time.perf_counter() > deadline, 1000)
+
+        try:
+            while run["steps"] and time.perf_counter() < deadline:
+                step = run["steps"][0]
+
+                try:
+                    finished = getattr(self, step)(guild_id, db)
+                except sqlite3.OperationalError as e:
+                    if "interrupted" not in str(e):
+                        raise
+
+                    db.rollback()
+                    self.interrupted += 1
+
+                    if step == "vacuum" and guild_id not in self.no_convert:
+                        # incremental_vacuum picks up where it was on the next turn
+                        continue
+
+                    logger.debug(f"Maintenance {step} for {guild_id} was interrupted, skipping it this run.")
+                    finished = True
+
+                if finished:
+                    run["steps"].pop(0)
+
+        finally:
+            db.set_progress_handler(None, 0)
+
+            elapsed = time.perf_counter() - start
+            run["elapsed"] += elapsed
+            self.seconds += elapsed
+            self.turns += 1
+
+        if run["steps"]:
+            return False
+
+        del self.running[guild_id]
+        self.last_run[guild_id] = time.time()
+
+        saved = run["size"] - Maintenance.size(db)
+        self.bytes_saved += saved
+        self.guilds += 1
+
+        logger.info(f"Maintenance of {guild_id} freed {saved / 1024:.1f} KiB in {run['elapsed']:.3f}s.")
+        return True
+
+    def quick_check(self, guild_id: int, db: sqlite3.Connection):
+        result = db.execute("PRAGMA quick_check").fetchall()
+        if result != [("ok",)]:
+            self.problems += 1
+            logger.warning(f"quick_check of {guild_id} found problems: {result[:5]}")
+
+        return True
+
+    def vacuum(self, guild_id: int, db: sqlite3.Connection):
+        """Frees vacuum_pages pages, returns True once the free list is empty"""
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            if guild_id in self.no_convert:
+                return True
+
+            # Only takes effect with the VACUUM, which rebuilds the whole file.
+            # If the budget interrupts it, the file is left as it was.
+            self.no_convert.add(guild_id)
+            db.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+            db.execute("VACUUM")
+            self.no_convert.discard(guild_id)
+            return True
+
+        if db.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+            return True
+
+        # The pragma frees a page each time it is stepped, execute() only steps it once
+        db.executescript(f"PRAGMA incremental_vacuum({Maintenance.vacuum_pages})")
+        return False
+
+    def analyze(self, guild_id: int, db: sqlite3.Connection):
+        db.execute(f"PRAGMA analysis_limit = {Maintenance.analysis_limit}")
+        db.execute("ANALYZE")
+        db.commit()
+        return True
+
+    def optimize(self, guild_id: int, db: sqlite3.Connection):
+        db.execute("PRAGMA optimize")
+        db.commit()
+        return True
+
+    def stats(self):
+        return {
+            "guilds done": self.guilds,
+            "in progress": len(self.running),
+            "turns": self.turns,
+            "KiB freed": f"{self.bytes_saved / 1024:.1f}",
+            "seconds": f"{self.seconds:.3f}",
+            "interrupted": self.interrupted,
+            "problems": self.problems,
+            "not converted": len(self.no_convert),
+        }
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Versioned schema migrations for the guild databases, used by util.database.
+
+Every cog registers its schema changes under its own namespace with a version number:
+
+    Database.migrations.register(self.name, 1, "CREATE TABLE IF NOT EXISTS ...")
+    Database.migrations.register(self.name, 2, "ALTER TABLE ...", function)
+
+A step is a query, or a function called with (self, cursor, guild_id) for anything
+that needs more than a query. Registering the same version again replaces it.
+
+A version that uses another cog's tables names the version of that namespace it needs,
+and stays pending until it is there, whichever order the cogs are loaded in:
+
+    Database.migrations.register(self.name, 1, function, requires=("levels", 2))
+
+The version each guild is at is kept in its schema_migrations table, and in memory once
+it has been read, so checking a guild that is up to date doesn't touch the database.
+Every pending step for a guild runs in a single transaction, if one fails none are kept.
+"""
+import sqlite3
+import threading
+
+
+class Migrations:
+    def __init__(self):
+        # {namespace: {version: [steps]}}
+        self.steps = dict()
+        # {namespace: function(cursor) returning the version}, for databases
+        # that were set up before schema_migrations existed
+        self.legacy = dict()
+        # {(namespace, version): (namespace, version)} that has to be applied first
+        self.requires = dict()
+        # {guild_id: {namespace: version}}, as committed to the guild's database
+        self.versions = dict()
+        self.lock = threading.Lock()
+
+    def register(self, namespace: str, version: int, *steps, legacy=None, requires=None):
+        """Adds the steps that bring namespace up to version"""
+        with self.lock:
+            self.steps.setdefault(namespace, dict())[version] = list(steps)
+
+            if legacy is not None:
+                self.legacy[namespace] = legacy
+
+            if requires is not None:
+                self.requires[(namespace, version)] = requires
+
+    def latest(self, namespace: str):
+        return max(self.steps.get(namespace, {0: None}))
+
+    def pending(self, guild_id: int):
+        """True if the guild has steps to run, or hasn't been checked yet"""
+        versions = self.versions.get(guild_id)
+        if versions is None:
+            return True
+
+        return any(versions.get(namespace, 0) < self.latest(namespace) for namespace in list(self.steps))
+
+    def forget(self, guild_id: int):
+        """Reads the guild's versions from its database again the next time it is checked"""
+        self.versions.pop(guild_id, None)
+
+    def read_versions(self, cursor):
+        """Returns {namespace: version} from the guild's schema_migrations table"""
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations(
+               namespace TEXT, version INTEGER, PRIMARY KEY("namespace"))"""
+        )
+        cursor.execute("SELECT namespace, version FROM schema_migrations")
+        return dict(cursor.fetchall())
+
+    def run(self, owner, guild_id: int, connection, cursor):
+        """
+        Runs every pending step for the guild in one transaction.
+        Call while holding the guild's lock, with nothing waiting to be committed.
+        Returns [(namespace, version)] for the versions that were applied.
+        """
+        applied = list()
+
+        cursor.execute("BEGIN")
+        try:
+            saved = self.versions.get(guild_id)
+            if saved is None:
+                saved = self.read_versions(cursor)
+            versions = dict(saved)
+
+            for namespace, legacy in list(self.legacy.items()):
+                if namespace not in versions:
+                    versions[namespace] = legacy(cursor)
+
+            # Another pass after any progress, for versions waiting on a namespace that came after them
+            progress = True
+            while progress:
+                progress = False
+
+                for namespace, steps in list(self.steps.items()):
+                    for version in sorted(steps):
+                        if version <= versions.get(namespace, 0):
+                            continue
+
+                        required = self.requires.get((namespace, version))
+                        if required is not None and versions.get(required[0], 0) < required[1]:
+                            # Later versions wait too, run() tries again once the cog is loaded
+                            break
+
+                        for step in steps[version]:
+                            if callable(step):
+                                step(owner, cursor, guild_id)
+                            else:
+                                cursor.execute(step)
+
+                        versions[namespace] = version
+                        applied.append((namespace, version))
+                        progress = True
+
+            # Also saves the versions read by the legacy functions, so they only run once.
+            # REPLACE instead of UPSERT, so it also works through the consolidated views.
+            cursor.executemany(
+                "INSERT OR REPLACE INTO schema_migrations(namespace, version) VALUES (?, ?)",
+                [(namespace, version) for namespace, version in versions.items() if saved.get(namespace) != version],
+            )
+            connection.commit()
+
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+
+        self.versions[guild_id] = versions
+        return applied
+
+    @staticmethod
+    def setting_version(table: str, setting_id: str):
+        """
+        Returns a legacy function that reads the version from a setting in a _settings or main table
+        """
+
+        def legacy(cursor):
+            try:
+                cursor.execute(f"SELECT setting_data FROM {table} WHERE setting_id = ?", (setting_id,))
+                row = cursor.fetchone()
+            except sqlite3.OperationalError:
+                # The table was never created, so nothing has been set up
+                return 0
+
+            return int(row[0]) if row is not None and row[0] is not None else 0
+
+        return legacy
@@ -10,6 +10,7 @@ import discord
 from discord.ext import commands
 
 from util.database import Database
+from util.database import SettingsTable
 from util.utils import dotdict
 from util.utils import Utils
 
@@ -90,11 +91,12 @@ class Permissions(commands.Cog):
         Database.readSettings(self)
 
         for guild_id in Database.Main:
-            self.load_permissions(guild_id)
+            self.setup_guild(guild_id)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        self.load_permissions(guild.id)
+        Database.readSettingsGuild(self, guild.id)
+        self.setup_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
@@ -102,12 +104,13 @@ class Permissions(commands.Cog):
         if Database.Cogs[self.name].get(guild.id, False):
             del Database.Cogs[self.name][guild.id]
 
+    def setup_guild(self, guild_id):
+        self.load_permissions(guild_id)
+
     def load_permissions(self, guild_id):
-        cursor = Database.cursor[guild_id]
-        query = f"SELECT setting_data FROM {self.name}_settings WHERE setting_id = 'permissions' LIMIT 1"
-        result = Database.dbExecute(self, cursor, guild_id, query)
+        result = SettingsTable.get(self.name).read_one(self, guild_id, "permissions")
         if result is not None:
-            permissions_load = json.loads(result[0])
+            permissions_load = json.loads(result)
         else:
             permissions_load = {}
 
@@ -674,18 +677,8 @@ class Permissions(commands.Cog):
         save = json.dumps(Database.Cogs[self.name][ctx.guild.id]["permissions"])
         Database.Cogs[self.name][ctx.guild.id]["settings"]["permissions"] = save
 
-        # Set database handle
-        cursor = Database.cursor[ctx.guild.id]
-
-        query = f"UPDATE {self.name}_settings SET setting_data = ? WHERE setting_id = ? "
-        values = (save, "permissions")
-        _, rows = Database.dbExecute(self, cursor, ctx.guild.id, query, values, False, True)
-
-        # Entry was not in the database, insert it.
-        if rows == 0:
-            query = f"INSERT INTO {self.name}_settings (setting_id, setting_data) VALUES (?, ?)"
-            values = ("permissions", save)
-            Database.dbExecute(self, cursor, ctx.guild.id, query, values)
+        # Inserted if it isn't in the database yet
+        Database.writeSettings(self, ctx.guild.id)
 
     def perm_handle(self, ctx, command):
         """
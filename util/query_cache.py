@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Result cache for the guild databases, used by util.database.
+
+Reads opt in by passing cache=(table, key) to dbExecute or dbExecuteAsync, where key is
+the primary key of the row the query reads. Results are kept per guild, table and key,
+the least recently used key is dropped once there are max_entries of them.
+
+Every write that goes through the Database layer drops the cached results for the table
+it writes to. A write that also passes cache=(table, key) only drops that key.
+"""
+import functools
+import re
+import threading
+from collections import OrderedDict
+
+
+# Table written to by INSERT, REPLACE, UPDATE or DELETE
+write_re = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"'`\[]?(\w+)",
+    re.IGNORECASE,
+)
+select_re = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+
+class QueryCache:
+
+    # Returned by get when nothing is cached, None is a valid result
+    miss = object()
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+
+        # {(guild_id, table, key): {(query, values, fetchAll): result}}, least recently used first
+        self.entries = OrderedDict()
+        # {(guild_id, table): set of keys}, to drop a whole table at once
+        self.keys = dict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # The statements are mostly constants, see util.repositories, so each one is only matched once
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def is_read(query: str):
+        return select_re.match(query) is not None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def written_table(query: str):
+        """The table a write query changes, or None if it isn't understood"""
+        match = write_re.match(query)
+        return match.group(1) if match is not None else None
+
+    def get(self, guild_id: int, table: str, key, statement: tuple):
+        with self.lock:
+            results = self.entries.get((guild_id, table, key))
+            if results is not None and statement in results:
+                self.entries.move_to_end((guild_id, table, key))
+                self.hits += 1
+                return QueryCache.copy(results[statement])
+
+            self.misses += 1
+            return QueryCache.miss
+
+    def put(self, guild_id: int, table: str, key, statement: tuple, result):
+        with self.lock:
+            entry = (guild_id, table, key)
+            if entry not in self.entries:
+                self.entries[entry] = dict()
+                self.keys.setdefault((guild_id, table), set()).add(key)
+
+            self.entries.move_to_end(entry)
+            self.entries[entry][statement] = QueryCache.copy(result)
+
+            while len(self.entries) > self.max_entries:
+                (old_guild_id, old_table, old_key), _ = self.entries.popitem(last=False)
+                self.keys[(old_guild_id, old_table)].discard(old_key)
+
+    def invalidate(self, guild_id: int, table: str = None, key=None):
+        """Drops the cached results for a key, a table, or the whole guild when table is None"""
+        with self.lock:
+            if table is None:
+                tables = [each for each in self.keys if each[0] == guild_id]
+            else:
+                tables = [(guild_id, table)]
+
+            for guild_table in tables:
+                keys = self.keys.get(guild_table, set())
+                for each in [key] if key is not None and table is not None else list(keys):
+                    if self.entries.pop((*guild_table, each), None) is not None:
+                        self.invalidations += 1
+                    keys.discard(each)
+
+    def invalidate_query(self, guild_id: int, query: str, cache: tuple = None):
+        """Drops whatever a write query could have changed"""
+        table = QueryCache.written_table(query)
+        if table is None:
+            # Schema changes and anything else that isn't understood
+            self.invalidate(guild_id)
+
+        elif cache is not None and cache[0] == table:
+            self.invalidate(guild_id, cache[0], cache[1])
+
+        else:
+            self.invalidate(guild_id, table)
+
+    @staticmethod
+    def copy(result):
+        # fetchall returns a list, don't let the caller change the cached one
+        return list(result) if isinstance(result, list) else result
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit rate": f"{self.hits / lookups * 100:.1f}%" if lookups else "-",
+            "invalidations": self.invalidations,
+        }
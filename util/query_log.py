@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Timing of every query run through dbExecute and dbExecuteAsync, used by util.database.
+
+Each statement gets a histogram of how long it took, execute, fetch and commit together,
+in buckets of milliseconds. The histograms cover the last one to two
+database_query_log_window seconds: the current window and the one before it are kept,
+and the older one is dropped every window.
+
+A query that takes longer than database_slow_query_ms is logged with its guild, values,
+the time spent in each phase and its EXPLAIN QUERY PLAN. The plan is only looked up the
+first time a statement is slow in a window, so a slow statement can't flood the log.
+
+Shown by the bot owner commands dbslow and dbhistogram.
+"""
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+space_re = re.compile(r"\s+")
+
+
+def format_plan(plan: list):
+    """Returns the rows of an EXPLAIN QUERY PLAN as indented lines"""
+    lines = list()
+    depth = dict()  # {id: indent}
+    for plan_id, parent, _, detail in plan:
+        depth[plan_id] = depth.get(parent, -1) + 1
+        lines.append(f"{'  ' * depth[plan_id]}{detail}")
+
+    return lines
+
+
+class Histogram:
+
+    # Upper bound of each bucket in milliseconds, the last bucket is everything slower
+    bounds = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+    def add(self, ms: float, slow: bool):
+        bucket = 0
+        while bucket < len(Histogram.bounds) and ms > Histogram.bounds[bucket]:
+            bucket += 1
+
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.slow += slow
+
+    def merge(self, other):
+        merged = Histogram()
+        merged.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        merged.count = self.count + other.count
+        merged.total = self.total + other.total
+        merged.max = max(self.max, other.max)
+        merged.slow = self.slow + other.slow
+        return merged
+
+    def percentile(self, percent: float):
+        """Upper bound of the bucket the percentile falls in, in milliseconds"""
+        target = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return Histogram.bounds[bucket] if bucket < len(Histogram.bounds) else self.max
+
+        return 0.0
+
+
+class QueryLog:
+    def __init__(self, slow_ms: float = 100, window: float = 3600):
+        self.slow_ms = slow_ms
+        self.window = window
+
+        # {statement: Histogram} for the current and the previous window
+        self.current = dict()
+        self.previous = dict()
+        self.window_start = time.monotonic()
+        # Statements whose plan was logged in the current window
+        self.explained = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def statement(query: str):
+        return space_re.sub(" ", query).strip()
+
+    def record(self, guild_id: int, query: str, values, many: bool, timings: tuple, connection=None):
+        """
+        Adds a query that took timings, (execute, fetch, commit) in seconds.
+        Call while holding the guild's lock, connection is used for the plan of a slow query.
+        """
+        ms = sum(timings) * 1000
+        slow = ms >= self.slow_ms
+        statement = QueryLog.statement(query)
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.window:
+                # Anything older than the previous window is dropped
+                self.previous = self.current if now - self.window_start < self.window * 2 else dict()
+                self.current = dict()
+                self.explained = set()
+                self.window_start = now
+
+            histogram = self.current.get(statement)
+            if histogram is None:
+                histogram = self.current[statement] = Histogram()
+            histogram.add(ms, slow)
+
+            explain = slow and statement not in self.explained
+            if explain:
+                self.explained.add(statement)
+
+        if not slow:
+            return
+
+        execute, fetch, commit = (each * 1000 for each in timings)
+        message = (
+            f"Slow query on {guild_id}, {ms:.1f} ms (execute {execute:.1f}, fetch {fetch:.1f}, commit {commit:.1f})\n"
+            f"query: {statement}\nvalues: {QueryLog.shorten(values, many)}"
+        )
+
+        if explain and connection is not None:
+            message += "\n" + "\n".join(QueryLog.explain(connection, query, values, many))
+
+        logger.warning(message)
+
+    @staticmethod
+    def shorten(values, many: bool):
+        if many:
+            values = list(values)
+            return f"{values[:3]}{' ...' if len(values) > 3 else ''} ({len(values)} sets)"
+
+        return values
+
+    @staticmethod
+    def explain(connection, query: str, values, many: bool):
+        """Returns the query plan as lines, with the first set of values for executemany"""
+        if many:
+            values = next(iter(values), ())
+
+        try:
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {query}", values).fetchall()
+        except (sqlite3.Error, ValueError) as e:
+            return [f"plan: {e}"]
+
+        return ["plan:"] + format_plan(plan) if plan else ["plan: none"]
+
+    def histograms(self):
+        """Returns [(statement, Histogram)] for both windows, most total time first"""
+        with self.lock:
+            statements = set(self.current) | set(self.previous)
+            merged = [
+                (statement, self.current.get(statement, Histogram()).merge(self.previous.get(statement, Histogram())))
+                for statement in statements
+            ]
+
+        return sorted(merged, key=lambda each: each[1].total, reverse=True)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Ranks the members of a guild by level and experience, used by Levels for leaderboard and level.
+
+The members are kept in order in buckets of at most 2 * load, with a Fenwick tree over the
+bucket sizes. Moving a member, finding a member's rank and finding the member at a rank
+are O(log n) plus the work inside a single bucket, so nothing is sorted again when a member
+gains experience. The tree is rebuilt when a bucket is split or emptied, which is rare.
+
+Equal levels and experience are ranked by user id, so every member has their own rank.
+"""
+from bisect import bisect_left
+from bisect import insort
+
+
+class RankIndex:
+
+    # Members per bucket when it is built, a bucket is split once it has twice as many
+    load = 256
+
+    def __init__(self, scores=()):
+        """scores is [(user_id, level, exp)]"""
+        # {user_id: key}, key is (-level, -exp, user_id) so the highest is first
+        self.keys = {user_id: (-level, -exp, user_id) for user_id, level, exp in scores}
+
+        ordered = sorted(self.keys.values())
+        self.buckets = [ordered[start : start + RankIndex.load] for start in range(0, len(ordered), RankIndex.load)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.build_tree()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def build_tree(self):
+        """Fenwick tree over the bucket sizes"""
+        self.tree = [0] + [len(bucket) for bucket in self.buckets]
+        for index in range(1, len(self.tree)):
+            parent = index + (index & -index)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[index]
+
+    def tree_add(self, bucket: int, count: int):
+        index = bucket + 1
+        while index < len(self.tree):
+            self.tree[index] += count
+            index += index & -index
+
+    def members_before(self, bucket: int):
+        """Number of members in the buckets before bucket"""
+        total = 0
+        index = bucket
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def find_bucket(self, position: int):
+        """Returns (bucket, position in the bucket) for a 0 based position in the ranking"""
+        bucket = 0
+        step = 1 << (len(self.tree).bit_length())
+        while step:
+            if bucket + step < len(self.tree) and self.tree[bucket + step] <= position:
+                bucket += step
+                position -= self.tree[bucket]
+            step >>= 1
+        return bucket, position
+
+    def update(self, user_id: int, level: int, exp: int):
+        """Adds the member, or moves them to their new place"""
+        key = (-level, -exp, user_id)
+        old = self.keys.get(user_id)
+        if old == key:
+            return
+
+        if old is not None:
+            self.remove(user_id)
+
+        self.keys[user_id] = key
+
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.build_tree()
+            return
+
+        bucket = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        insort(self.buckets[bucket], key)
+        self.maxes[bucket] = self.buckets[bucket][-1]
+
+        if len(self.buckets[bucket]) > RankIndex.load * 2:
+            half = self.buckets[bucket][RankIndex.load :]
+            del self.buckets[bucket][RankIndex.load :]
+            self.buckets.insert(bucket + 1, half)
+            self.maxes[bucket] = self.buckets[bucket][-1]
+            self.maxes.insert(bucket + 1, half[-1])
+            self.build_tree()
+        else:
+            self.tree_add(bucket, 1)
+
+    def remove(self, user_id: int):
+        key = self.keys.pop(user_id, None)
+        if key is None:
+            return
+
+        bucket = bisect_left(self.maxes, key)
+        del self.buckets[bucket][bisect_left(self.buckets[bucket], key)]
+
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+            del self.maxes[bucket]
+            self.build_tree()
+        else:
+            self.maxes[bucket] = self.buckets[bucket][-1]
+            self.tree_add(bucket, -1)
+
+    def rank(self, user_id: int):
+        """Returns the member's rank, 1 is the highest, or None if they aren't ranked"""
+        key = self.keys.get(user_id)
+        if key is None:
+            return None
+
+        bucket = bisect_left(self.maxes, key)
+        return self.members_before(bucket) + bisect_left(self.buckets[bucket], key) + 1
+
+    def page(self, start: int, count: int):
+        """Returns [(rank, user_id, level, exp)] for count members from the 0 based position start"""
+        if start >= len(self.keys) or count <= 0:
+            return list()
+
+        bucket, position = self.find_bucket(start)
+        rank = start + 1
+        members = list()
+
+        while bucket < len(self.buckets) and len(members) < count:
+            for level, exp, user_id in self.buckets[bucket][position : position + count - len(members)]:
+                members.append((rank, user_id, -level, -exp))
+                rank += 1
+            bucket += 1
+            position = 0
+
+        return members
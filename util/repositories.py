@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Typed access to the guild tables the cogs share, instead of every cog building its own SQL.
+
+Every statement is a constant, so its text is the same on every call. sqlite3 keeps the
+prepared statements of a connection keyed on that text, and QueryCache remembers how it
+classified it, so neither is done again for a statement that was already seen. Rows are
+returned as NamedTuples with the columns converted to the types the cogs use, and the
+*_many methods write a whole batch with one executemany.
+
+    Users                   users, shared by Levels, Karma and JoinLeave
+    ActivityHistory         activity, the messages per hour kept by Levels
+    ReactToMessageUsers     react_to_message_users
+    ReactionRolesValues     reaction_roles_values
+    SettingsTable           {cog}_settings, in util.database next to Settings
+
+Called the same way as dbExecute, with the calling cog as self:
+
+    row = await Users.get_level_async(self, message.guild.id, message.author.id)
+"""
+import json
+import typing
+
+from util.database import Database
+
+
+def as_int(value):
+    """The users columns are TEXT before levels version 3, and in consolidated shards. NULL is read as 0"""
+    return int(value) if value is not None else 0
+
+
+class UserLevel(typing.NamedTuple):
+    exp: int
+    level: int
+    words: int
+    messages: int
+    lastexp: typing.Optional[int]
+
+    @classmethod
+    def from_row(cls, row):
+        lastexp = as_int(row[4]) if row[4] is not None else None
+        return cls(as_int(row[0]), as_int(row[1]), as_int(row[2]), as_int(row[3]), lastexp)
+
+
+class UserActivity(typing.NamedTuple):
+    """In the order Users.update_activity takes its values"""
+
+    exp: int
+    level: int
+    words: int
+    messages: int
+    lastseen: int
+    lastseenurl: typing.Optional[str]
+    lastexp: int
+    user_id: int
+
+
+class UserStats(typing.NamedTuple):
+    exp: int
+    level: int
+    words: int
+    messages: int
+    lastseen: int
+    lastseenurl: typing.Optional[str]
+    upvotes: int
+    downvotes: int
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(as_int(value) for value in row[:5]), row[5], as_int(row[6]), as_int(row[7]))
+
+
+class UserKarma(typing.NamedTuple):
+    upvotes: int
+    downvotes: int
+
+
+class Users:
+    """users, one row per member, created by Levels"""
+
+    select_ids = "SELECT user_id FROM users"
+    select_scores = "SELECT user_id, level, exp FROM users"
+    select_level = "SELECT exp, level, words, messages, lastexp FROM users WHERE user_id = ?"
+    select_stats = (
+        "SELECT exp, level, words, messages, lastseen, lastseenurl, upvotes, downvotes FROM users WHERE user_id = ?"
+    )
+    select_karma = "SELECT upvotes, downvotes FROM users WHERE user_id = ?"
+    select_nickname_history = "SELECT nickname_history FROM users WHERE user_id = ?"
+
+    insert = (
+        "INSERT OR IGNORE INTO users(user_id, exp, level, words, messages, lastseen, lastseenurl) "
+        "VALUES (?, 0, 0, 0, 0, 0, NULL)"
+    )
+    insert_karma = (
+        "INSERT INTO users(user_id, exp, level, words, messages, lastseen, lastseenurl, upvotes, downvotes) "
+        "VALUES (?, 0, 0, 0, 0, 0, NULL, ?, ?)"
+    )
+    update_activity = (
+        "UPDATE users SET exp = ?, level = ?, words = ?, messages = ?, "
+        "lastseen = ?, lastseenurl = ?, lastexp = ? WHERE user_id = ?"
+    )
+    update_level = "UPDATE users SET exp = ?, level = ? WHERE user_id = ?"
+    update_karma = "UPDATE users SET upvotes = ?, downvotes = ? WHERE user_id = ?"
+    update_nickname_history = "UPDATE users SET nickname_history = ? WHERE user_id = ?"
+
+    async def scores_async(self, guild_id: int):
+        """Returns [(user_id, level, exp)] for every user, read from the users_level_exp index"""
+        rows = await Database.dbExecuteAsync(self, guild_id, Users.select_scores, (), True)
+        return [(int(row[0]), as_int(row[1]), as_int(row[2])) for row in rows]
+
+    async def ids_async(self, guild_id: int):
+        """Returns the set of user ids in the table"""
+        rows = await Database.dbExecuteAsync(self, guild_id, Users.select_ids, (), True)
+        return {int(row[0]) for row in rows}
+
+    def add(self, guild_id: int, user_id: int):
+        Database.dbExecute(self, None, guild_id, Users.insert, (user_id,), cache=("users", user_id))
+
+    async def add_async(self, guild_id: int, user_id: int):
+        await Database.dbExecuteAsync(self, guild_id, Users.insert, (user_id,), cache=("users", user_id))
+
+    async def add_many_async(self, guild_id: int, user_ids, chunk: int = 1000):
+        """
+        Adds every user that isn't in the table yet, chunk users to a statement, in one transaction.
+        Returns the number of users added.
+        """
+        user_ids = list(user_ids)
+        steps = [
+            (Users.insert, [(user_id,) for user_id in user_ids[start : start + chunk]], True)
+            for start in range(0, len(user_ids), chunk)
+        ]
+        return await Database.dbTransactionAsync(self, guild_id, steps)
+
+    async def get_level_async(self, guild_id: int, user_id: int):
+        """Returns UserLevel, or None if the user isn't in the table"""
+        row = await Database.dbExecuteAsync(self, guild_id, Users.select_level, (user_id,))
+        return UserLevel.from_row(row) if row is not None else None
+
+    async def set_level_async(self, guild_id: int, user_id: int, exp: int, level: int):
+        values = (exp, level, user_id)
+        await Database.dbExecuteAsync(self, guild_id, Users.update_level, values, cache=("users", user_id))
+
+    async def set_levels_async(self, guild_id: int, levels: list):
+        """
+        Sets [(exp, level, user_id)], adding the users that aren't in the table yet.
+        Written as one transaction, nothing is changed if it fails.
+        """
+        steps = [
+            (Users.insert, [(user_id,) for _, _, user_id in levels], True),
+            (Users.update_level, levels, True),
+        ]
+        await Database.dbTransactionAsync(self, guild_id, steps)
+
+    def set_activity_many(self, guild_id: int, activity: list):
+        """Writes [UserActivity] with one statement"""
+        Database.dbExecute(self, None, guild_id, Users.update_activity, activity, many=True)
+
+    async def set_activity_many_async(self, guild_id: int, activity: list):
+        await Database.dbExecuteAsync(self, guild_id, Users.update_activity, activity, many=True)
+
+    async def get_stats_async(self, guild_id: int, user_id: int):
+        """Returns UserStats, or None if the user isn't in the table"""
+        row = await Database.dbExecuteAsync(self, guild_id, Users.select_stats, (user_id,), cache=("users", user_id))
+        return UserStats.from_row(row) if row is not None else None
+
+    async def get_karma_async(self, guild_id: int, user_id: int):
+        """Returns UserKarma, or None if the user isn't in the table"""
+        row = await Database.dbExecuteAsync(self, guild_id, Users.select_karma, (user_id,))
+        return UserKarma(as_int(row[0]), as_int(row[1])) if row is not None else None
+
+    async def set_karma_async(self, guild_id: int, user_id: int, karma: UserKarma):
+        """Returns False if the user isn't in the table"""
+        values = (karma.upvotes, karma.downvotes, user_id)
+        _, rows = await Database.dbExecuteAsync(
+            self, guild_id, Users.update_karma, values, False, True, cache=("users", user_id)
+        )
+        return rows > 0
+
+    async def add_karma_async(self, guild_id: int, user_id: int, karma: UserKarma):
+        values = (user_id, karma.upvotes, karma.downvotes)
+        await Database.dbExecuteAsync(self, guild_id, Users.insert_karma, values, cache=("users", user_id))
+
+    def get_nickname_history(self, guild_id: int, user_id: int):
+        """Returns the list of previous nicknames, or None if the user isn't in the table"""
+        row = Database.dbExecute(self, None, guild_id, Users.select_nickname_history, (user_id,), cache=("users", user_id))
+        return Users.decode_nickname_history(row)
+
+    async def get_nickname_history_async(self, guild_id: int, user_id: int):
+        row = await Database.dbExecuteAsync(
+            self, guild_id, Users.select_nickname_history, (user_id,), cache=("users", user_id)
+        )
+        return Users.decode_nickname_history(row)
+
+    async def set_nickname_history_async(self, guild_id: int, user_id: int, nickname_history: list):
+        values = (json.dumps(nickname_history), user_id)
+        await Database.dbExecuteAsync(self, guild_id, Users.update_nickname_history, values, cache=("users", user_id))
+
+    @staticmethod
+    def decode_nickname_history(row):
+        if row is None:
+            return None
+
+        return json.loads(row[0]) if row[0] is not None else list()
+
+
+class ActivityHistory:
+    """activity, one row per member and day, see util.activity_store"""
+
+    select_day = "SELECT user_id, hours, words FROM activity WHERE day = ?"
+    select_user = "SELECT day, messages, words, hours FROM activity WHERE user_id = ? AND day >= ?"
+    select_guild_days = "SELECT day, SUM(messages), SUM(words) FROM activity WHERE day >= ? GROUP BY day"
+    select_guild_hours = "SELECT hours FROM activity WHERE day >= ? AND hours IS NOT NULL"
+
+    insert = "INSERT OR IGNORE INTO activity(user_id, day, messages, words) VALUES (?, ?, 0, 0)"
+    update = "UPDATE activity SET hours = ?, messages = ?, words = ? WHERE user_id = ? AND day = ?"
+    downsample = "UPDATE activity SET hours = NULL WHERE day < ? AND hours IS NOT NULL"
+    prune = "DELETE FROM activity WHERE day < ?"
+
+    async def day_async(self, guild_id: int, day: int):
+        """Returns [(user_id, hours, words)] written for the day"""
+        return await Database.dbExecuteAsync(self, guild_id, ActivityHistory.select_day, (day,), True)
+
+    @staticmethod
+    def write_steps(rows: list):
+        """Steps for Database.dbTransaction that write [(hours, messages, words, user_id, day)]"""
+        keys = [(user_id, day) for _, _, _, user_id, day in rows]
+        return [(ActivityHistory.insert, keys, True), (ActivityHistory.update, rows, True)]
+
+    def write(self, guild_id: int, rows: list):
+        """Writes [(hours, messages, words, user_id, day)] in one transaction"""
+        Database.dbTransaction(self, guild_id, ActivityHistory.write_steps(rows))
+
+    async def write_async(self, guild_id: int, rows: list):
+        await Database.dbTransactionAsync(self, guild_id, ActivityHistory.write_steps(rows))
+
+    async def user_async(self, guild_id: int, user_id: int, first_day: int):
+        """Returns [(day, messages, words, hours)] from first_day on, hours is None once downsampled"""
+        values = (user_id, first_day)
+        return await Database.dbExecuteAsync(self, guild_id, ActivityHistory.select_user, values, True)
+
+    async def guild_async(self, guild_id: int, first_day: int):
+        """Returns ([(day, messages, words)], [hours]) for the whole guild from first_day on"""
+        days = await Database.dbExecuteAsync(self, guild_id, ActivityHistory.select_guild_days, (first_day,), True)
+        hours = await Database.dbExecuteAsync(self, guild_id, ActivityHistory.select_guild_hours, (first_day,), True)
+        return days, [row[0] for row in hours]
+
+    async def downsample_async(self, guild_id: int, rows: list, hourly_from: int, keep_from: int):
+        """
+        Writes rows, then drops the hours of the days before hourly_from and the days before keep_from.
+        All in one transaction, nothing is changed if it fails.
+        """
+        steps = ActivityHistory.write_steps(rows) + [
+            (ActivityHistory.downsample, (hourly_from,), False),
+            (ActivityHistory.prune, (keep_from,), False),
+        ]
+        await Database.dbTransactionAsync(self, guild_id, steps)
+
+
+class ReactToMessageUser(typing.NamedTuple):
+    user_id: int
+    emojis: list
+    frequency: int
+
+
+class ReactToMessageUsers:
+    """react_to_message_users, the emojis ReactToMessages reacts to a user's messages with"""
+
+    select = "SELECT user_id, emojis, frequency FROM react_to_message_users WHERE user_id = ?"
+    update = "UPDATE react_to_message_users SET emojis = ?, frequency = ? WHERE user_id = ?"
+    insert = "INSERT INTO react_to_message_users (emojis, frequency, user_id) VALUES (?, ?, ?)"
+
+    def get(self, guild_id: int, user_id: int):
+        """Returns ReactToMessageUser, or None if the user isn't in the table"""
+        row = Database.dbExecute(
+            self, None, guild_id, ReactToMessageUsers.select, (user_id,), cache=("react_to_message_users", user_id)
+        )
+        if row is None:
+            return None
+
+        return ReactToMessageUser(int(row[0]), json.loads(row[1]), int(row[2]))
+
+    def set(self, guild_id: int, user: ReactToMessageUser):
+        """Updates the user, or inserts them if they aren't in the table"""
+        values = (json.dumps(user.emojis, ensure_ascii=False), user.frequency, user.user_id)
+        cache = ("react_to_message_users", user.user_id)
+
+        _, rows = Database.dbExecute(self, None, guild_id, ReactToMessageUsers.update, values, False, True, cache=cache)
+        if rows == 0:
+            Database.dbExecute(self, None, guild_id, ReactToMessageUsers.insert, values, cache=cache)
+
+        return rows > 0
+
+
+class ReactionRole(typing.NamedTuple):
+    emoji: str
+    role: str
+    description: str
+
+
+class ReactionRolesValues:
+    """reaction_roles_values, the emoji and role pairs on the ReactionRoles message"""
+
+    select = "SELECT emoji, role, description FROM reaction_roles_values"
+    insert = "INSERT INTO reaction_roles_values (emoji, role, description) VALUES (?, ?, ?)"
+    delete = "DELETE FROM reaction_roles_values WHERE emoji = ?"
+
+    def all(self, guild_id: int):
+        """Returns [ReactionRole]"""
+        rows = Database.dbExecute(self, None, guild_id, ReactionRolesValues.select, (), True)
+        return [ReactionRole(*row) for row in rows]
+
+    def add(self, guild_id: int, role: ReactionRole):
+        Database.dbExecute(self, None, guild_id, ReactionRolesValues.insert, role)
+
+    def add_many(self, guild_id: int, roles):
+        Database.dbExecute(self, None, guild_id, ReactionRolesValues.insert, list(roles), many=True)
+
+    def remove(self, guild_id: int, emoji: str):
+        """Removes every role using the emoji"""
+        Database.dbExecute(self, None, guild_id, ReactionRolesValues.delete, (emoji,))
@@ -0,0 +1,830 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Storage for the guild databases, used by util.database.
+
+Every storage implements the Storage interface. Database only talks to the storage,
+so another engine can be added by subclassing Storage and adding it to Database.__init__.
+
+GuildFileStorage keeps a db/{guild_id}.db3 file per guild, with a bounded pool of
+open connections.
+
+ConsolidatedStorage keeps every guild in a fixed number of shard files.
+Each cog table is stored once per shard as guilds_{table} with a guild_id column in
+front of the primary key. Every shard connection has a TEMP VIEW with the cogs table
+name that only shows the rows for the guild currently selected on the connection,
+plus INSTEAD OF triggers that write back to guilds_{table}. That lets the cogs keep
+running the same SQL they run against a per guild file.
+
+MemoryStorage keeps every guild in an in memory SQLite database, for tests and benchmarks.
+
+Migrate the existing per guild files with:
+    python -m util.storage migrate --shards 1
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+# Schema statements the cogs run, these are translated to the guilds_{table} tables.
+create_table_re = re.compile(r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[\"'`\[]?(\w+)", re.IGNORECASE)
+alter_rename_re = re.compile(r"^\s*ALTER\s+TABLE\s+[\"'`\[]?(\w+)[\"'`\]]?\s+RENAME\s+TO\s+[\"'`\[]?(\w+)", re.IGNORECASE)
+alter_add_re = re.compile(
+    r"^\s*ALTER\s+TABLE\s+[\"'`\[]?(\w+)[\"'`\]]?\s+ADD\s+(?:COLUMN\s+)?(.+)$", re.IGNORECASE | re.DOTALL
+)
+drop_table_re = re.compile(r"^\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?[\"'`\[]?(\w+)", re.IGNORECASE)
+create_index_re = re.compile(
+    r"^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?[\"'`\[]?(\w+)[\"'`\]]?"
+    r"\s+ON\s+[\"'`\[]?(\w+)[\"'`\]]?\s*\((.*)\)\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+without_rowid_re = re.compile(r"WITHOUT\s+ROWID\s*;?\s*$", re.IGNORECASE)
+
+
+class GuildArchived(sqlite3.OperationalError):
+    """The guild's file is in the departed archive, it is brought back by rehydrate_guild"""
+
+
+class Storage:
+    """
+    The interface Database uses to reach the guild databases.
+
+    connect and cursor return DB-API objects for the guild, lock returns the lock that
+    has to be held while they are in use.
+    """
+
+    # False when INSERT ... ON CONFLICT can't be used and INSERT OR REPLACE is used instead
+    supports_upsert = True
+
+    # util.wal_archive.WalArchive, for storages that support point in time recovery
+    archive = None
+
+    # Called with the connection right before it is closed
+    on_close = None
+
+    def files(self):
+        """Returns a list of (name, path) for every file that should be backed up"""
+        raise NotImplementedError
+
+    def guild_ids(self):
+        """Returns every guild that has a database"""
+        raise NotImplementedError
+
+    def lock(self, guild_id: int):
+        """The lock held while the guild's connection is in use"""
+        raise NotImplementedError
+
+    def create(self, guild_id: int):
+        """Creates the guild's database if it doesn't exist"""
+        raise NotImplementedError
+
+    def connect(self, guild_id: int):
+        """Returns the guild's connection"""
+        raise NotImplementedError
+
+    def cursor(self, guild_id: int):
+        """Returns a cursor for the guild"""
+        raise NotImplementedError
+
+    def close(self, guild_id: int = None, blocking: bool = True):
+        """
+        Commits and closes the guild's database, or every database if guild_id is None.
+        Returns False if blocking is False and the database is in use.
+        """
+        raise NotImplementedError
+
+    def close_idle(self, idle_seconds: float):
+        """Closes databases that haven't been used for idle_seconds, if the storage supports it"""
+        pass
+
+    def stats(self):
+        """Returns {name: value} for dbstats"""
+        return dict()
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps every guild in an in memory SQLite database, nothing is written to disk.
+    Closing a guild would lose it, so close only commits.
+    """
+
+    def __init__(self, guild_ids: list = ()):
+        self.connections = dict()  # {guild_id: connection}
+        self.locks = dict()  # {guild_id: threading.RLock}
+        self.pool_lock = threading.Lock()
+
+        for guild_id in guild_ids:
+            self.create(guild_id)
+
+    def files(self):
+        return list()
+
+    def guild_ids(self):
+        return list(self.connections)
+
+    def lock(self, guild_id: int):
+        lock = self.locks.get(guild_id)
+        if lock is None:
+            with self.pool_lock:
+                lock = self.locks.setdefault(guild_id, threading.RLock())
+
+        return lock
+
+    def create(self, guild_id: int):
+        self.connect(guild_id)
+
+    def connect(self, guild_id: int):
+        db = self.connections.get(guild_id)
+        if db is None:
+            with self.pool_lock:
+                if guild_id not in self.connections:
+                    self.connections[guild_id] = sqlite3.connect(":memory:", check_same_thread=False)
+                db = self.connections[guild_id]
+
+        return db
+
+    def cursor(self, guild_id: int):
+        return self.connect(guild_id).cursor()
+
+    def close(self, guild_id: int = None, blocking: bool = True):
+        for each in [guild_id] if guild_id is not None else list(self.connections):
+            lock = self.lock(each)
+            if not lock.acquire(blocking=blocking):
+                return False
+
+            try:
+                if each in self.connections:
+                    self.connections[each].commit()
+            finally:
+                lock.release()
+
+        return True
+
+    def stats(self):
+        return {"guilds": len(self.connections)}
+
+
+class GuildFileStorage(Storage):
+    """
+    Keeps every guild in its own file under path.
+
+    Only the max_open most recently used files are kept open, the least recently
+    used one is committed, checkpointed and closed when another has to be opened.
+    Closed files are opened again the next time they are used.
+    """
+
+    # Where archive_guild moves the files of departed guilds, they aren't opened while they are there
+    departed_path = None
+
+    def __init__(self, path: str = "db", max_open: int = 256):
+        self.path = path
+        self.max_open = max_open
+
+        self.connections = OrderedDict()  # {guild_id: connection}, least recently used first
+        self.last_used = dict()  # {guild_id: time.monotonic()}
+        self.locks = dict()  # {guild_id: threading.RLock}, kept when the connection is closed
+        self.pool_lock = threading.Lock()  # Protects connections, last_used and locks
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_closed = 0
+
+    def guild_file(self, guild_id: int):
+        return f"{self.path}/{guild_id}.db3"
+
+    def departed_file(self, guild_id: int):
+        return f"{self.departed_path}/{guild_id}.db3.gz"
+
+    def files(self):
+        """Returns a list of (name, path) for every guild file"""
+        return [
+            (filename[:-4], f"{self.path}/{filename}") for filename in os.listdir(self.path) if filename.endswith(".db3")
+        ]
+
+    def guild_ids(self):
+        """Returns every guild that has a file"""
+        return [int(name) for name, _ in self.files()]
+
+    def lock(self, guild_id: int):
+        """The lock held while the guild's connection is in use"""
+        lock = self.locks.get(guild_id)
+        if lock is None:
+            with self.pool_lock:
+                lock = self.locks.setdefault(guild_id, threading.RLock())
+
+        return lock
+
+    def create(self, guild_id: int):
+        """Creates the guild's file if it doesn't exist"""
+        self.connect(guild_id)
+
+    def connect(self, guild_id: int):
+        """
+        Returns the guild's connection, opening the file if it isn't open.
+        """
+        # Holding the guild's lock keeps evict() from closing the connection under us
+        with self.lock(guild_id):
+            with self.pool_lock:
+                db = self.connections.get(guild_id)
+                if db is not None:
+                    self.connections.move_to_end(guild_id)
+                    self.hits += 1
+
+                else:
+                    new_file = not os.path.exists(self.guild_file(guild_id))
+
+                    # Opening it would create an empty file, and rehydrate_guild would leave the archive behind
+                    if new_file and self.departed_path is not None and os.path.exists(self.departed_file(guild_id)):
+                        raise GuildArchived(f"Guild {guild_id} is archived in {self.departed_path}")
+
+                    # The connection is shared between the event loop and the worker threads,
+                    # access is serialized with the guild's lock.
+                    db = sqlite3.connect(self.guild_file(guild_id), check_same_thread=False)
+                    if new_file:
+                        # Has to be set before any tables are created, see util.maintenance
+                        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+                    if self.archive is not None:
+                        self.archive.setup(db)
+
+                    self.connections[guild_id] = db
+                    self.misses += 1
+
+                self.last_used[guild_id] = time.monotonic()
+
+            # Also catches up on evictions that were skipped because the connections were busy
+            if len(self.connections) > self.max_open:
+                self.evict()
+
+        return db
+
+    def cursor(self, guild_id: int):
+        with self.lock(guild_id):
+            return self.connect(guild_id).cursor()
+
+    def evict(self):
+        """Closes the least recently used connections until there are max_open left"""
+        while len(self.connections) > self.max_open:
+            # Skip anything that is in use, if they are all busy we go over max_open for now
+            for guild_id in list(self.connections)[:-1]:
+                if self.close(guild_id, blocking=False):
+                    self.evictions += 1
+                    break
+            else:
+                return
+
+    def close_idle(self, idle_seconds: float):
+        """Closes connections that haven't been used for idle_seconds"""
+        cutoff = time.monotonic() - idle_seconds
+        for guild_id, last_used in list(self.last_used.items()):
+            if last_used < cutoff and self.close(guild_id, blocking=False):
+                self.idle_closed += 1
+
+    def close(self, guild_id: int = None, blocking: bool = True):
+        """
+        Commits, checkpoints and closes the guild's connection, or every connection if guild_id is None.
+        Returns False if blocking is False and the connection is in use.
+        """
+        if guild_id is None:
+            for each in list(self.connections):
+                self.close(each)
+            return True
+
+        lock = self.lock(guild_id)
+        if not lock.acquire(blocking=blocking):
+            return False
+
+        try:
+            with self.pool_lock:
+                db = self.connections.pop(guild_id, None)
+                self.last_used.pop(guild_id, None)
+
+            if db is not None:
+                db.commit()
+                if self.archive is not None:
+                    # Keep the last writes before they are checkpointed into the file
+                    self.archive.archive(guild_id, db, self.guild_file(guild_id))
+
+                # Does nothing unless the file is in WAL mode
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+                if self.on_close is not None:
+                    self.on_close(db)
+                db.close()
+
+        finally:
+            lock.release()
+
+        return True
+
+    def archive_wal(self, guild_id: int):
+        """Archives and checkpoints the guild's WAL, if the guild is open"""
+        with self.lock(guild_id):
+            db = self.connections.get(guild_id)
+            if db is None or self.archive is None:
+                return
+
+            db.commit()
+            self.archive.archive(guild_id, db, self.guild_file(guild_id))
+
+    def archive_guild(self, guild_id: int, path: str):
+        """
+        Closes the guild's file and moves it into path as {guild_id}.db3.gz.
+        Returns the archived file, or None if the guild doesn't have a file.
+        """
+        target = f"{path}/{guild_id}.db3.gz"
+
+        # Held until the file is gone, so nothing opens it again half way through
+        with self.lock(guild_id):
+            self.close(guild_id)
+
+            if not os.path.exists(self.guild_file(guild_id)):
+                return None
+
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+            # Compress to a temporary file first so a crash can't leave a half written archive
+            with open(self.guild_file(guild_id), "rb") as source, gzip.open(f"{target}.tmp", "wb") as destination:
+                shutil.copyfileobj(source, destination)
+            os.replace(f"{target}.tmp", target)
+
+            for each in [self.guild_file(guild_id), f"{self.guild_file(guild_id)}-wal", f"{self.guild_file(guild_id)}-shm"]:
+                if os.path.exists(each):
+                    os.remove(each)
+
+        return target
+
+    def rehydrate_guild(self, guild_id: int, path: str):
+        """
+        Moves the guild's file back out of the archive in path.
+        Returns False if the guild wasn't archived, or already has a file.
+        """
+        source = f"{path}/{guild_id}.db3.gz"
+
+        with self.lock(guild_id):
+            if not os.path.exists(source) or os.path.exists(self.guild_file(guild_id)):
+                return False
+
+            with gzip.open(source, "rb") as archive, open(f"{self.guild_file(guild_id)}.tmp", "wb") as destination:
+                shutil.copyfileobj(archive, destination)
+            os.replace(f"{self.guild_file(guild_id)}.tmp", self.guild_file(guild_id))
+            os.remove(source)
+
+        return True
+
+    def replace(self, guild_id: int, path: str):
+        """
+        Replaces the contents of the guild's database with the database at path.
+        The bot's connection is kept, the pages are copied into it with the online backup API.
+        """
+        with self.lock(guild_id):
+            # The current contents stay in the archive, so the replace can be undone
+            self.archive_wal(guild_id)
+
+            source = sqlite3.connect(path)
+            try:
+                source.backup(self.connect(guild_id))
+            finally:
+                source.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "open": len(self.connections),
+            "max open": self.max_open,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit rate": f"{self.hits / lookups * 100:.1f}%" if lookups else "-",
+            "evictions": self.evictions,
+            "idle closed": self.idle_closed,
+        }
+
+
+class ConsolidatedStorage(Storage):
+    """
+    Keeps every guild in shard files under path, guild_id % shards picks the file.
+    Shards are shared by many guilds, so they are kept open.
+    """
+
+    # SQLite can't UPSERT into the views
+    supports_upsert = False
+
+    def __init__(self, path: str = "db/shards", shards: int = 1):
+        self.path = path
+        self.shards = shards
+
+        self.connections = dict()  # {shard: connection}
+        # {shard: threading.RLock}, all made up front so two threads can't each make their own
+        self.locks = {shard: threading.RLock() for shard in range(shards)}
+        self.current_guild = dict()  # {shard: guild_id the views are showing}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def shard(self, guild_id: int):
+        return guild_id % self.shards
+
+    def shard_file(self, shard: int):
+        return f"{self.path}/{shard}.db3"
+
+    def files(self):
+        """Returns a list of (name, path) for every shard file"""
+        return [(f"shard-{shard}", self.shard_file(shard)) for shard in range(self.shards)]
+
+    def lock(self, guild_id: int):
+        """The lock for the shard the guild is stored in, shared by every guild in the shard"""
+        return self.locks[self.shard(guild_id)]
+
+    def connect(self, guild_id: int):
+        """
+        Returns the connection for the shard the guild is stored in.
+        """
+        shard = self.shard(guild_id)
+
+        db = self.connections.get(shard)
+        if db is not None:
+            return db
+
+        with self.lock(guild_id):
+            if shard not in self.connections:
+                db = sqlite3.connect(self.shard_file(shard), check_same_thread=False)
+                db.create_function("current_guild", 0, lambda: self.current_guild.get(shard))
+                db.execute("CREATE TABLE IF NOT EXISTS guilds(guild_id INTEGER PRIMARY KEY)")
+                db.commit()
+
+                self.connections[shard] = db
+                self.refresh_views(shard)
+
+        return self.connections[shard]
+
+    def create(self, guild_id: int):
+        """Registers the guild in its shard"""
+        db = self.connect(guild_id)
+
+        with self.lock(guild_id):
+            db.execute("INSERT OR IGNORE INTO guilds(guild_id) VALUES (?)", (guild_id,))
+            db.commit()
+
+    def close(self, guild_id: int = None, blocking: bool = True):
+        """
+        Commits the guild's shard, or commits and closes every shard if guild_id is None.
+        The shard is shared with other guilds, so it is left open when closing a single guild.
+        """
+        if guild_id is not None:
+            lock = self.lock(guild_id)
+            if not lock.acquire(blocking=blocking):
+                return False
+
+            try:
+                self.connect(guild_id).commit()
+            finally:
+                lock.release()
+
+            return True
+
+        for shard, db in list(self.connections.items()):
+            with self.locks[shard]:
+                db.commit()
+                if self.on_close is not None:
+                    self.on_close(db)
+                db.close()
+                del self.connections[shard]
+
+        return True
+
+    def stats(self):
+        return {"shards": self.shards, "open": len(self.connections)}
+
+    def guild_ids(self):
+        """Returns every guild stored in the shard files"""
+        guild_ids = list()
+        for shard in range(self.shards):
+            if not os.path.exists(self.shard_file(shard)):
+                continue
+
+            db = sqlite3.connect(self.shard_file(shard))
+            try:
+                guild_ids.extend(row[0] for row in db.execute("SELECT guild_id FROM guilds"))
+            except sqlite3.OperationalError:
+                # Shard was created but never had a guild added
+                pass
+            db.close()
+
+        return guild_ids
+
+    def select_guild(self, guild_id: int):
+        """Points the views on the shard connection at the guild. Call while holding the shard lock."""
+        self.current_guild[self.shard(guild_id)] = guild_id
+
+    def cursor(self, guild_id: int):
+        """Returns a cursor for the guild, the guild must have been opened with connect first"""
+        return ConsolidatedCursor(self, guild_id, self.connections[self.shard(guild_id)].cursor())
+
+    def execute(self, cursor, guild_id: int, query: str, values=()):
+        """
+        Runs a query for the guild, schema statements are translated to the guilds_{table} tables.
+        """
+        shard = self.shard(guild_id)
+        self.select_guild(guild_id)
+
+        if create_table_re.match(query):
+            self.create_table(shard, query)
+
+        elif alter_rename_re.match(query):
+            old_name, new_name = alter_rename_re.match(query).groups()
+            self.rename_table(shard, guild_id, old_name, new_name)
+
+        elif alter_add_re.match(query):
+            table, column = alter_add_re.match(query).groups()
+            self.add_column(shard, table, column)
+
+        elif drop_table_re.match(query):
+            self.drop_table(shard, guild_id, drop_table_re.match(query).group(1))
+
+        elif create_index_re.match(query):
+            unique, index, table, columns = create_index_re.match(query).groups()
+            self.create_index(shard, index, table, columns, bool(unique))
+
+        else:
+            cursor.execute(query, values)
+
+    def tables(self, shard: int):
+        """Returns the names of the cog tables stored in the shard"""
+        db = self.connections[shard]
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'guilds\\_%' ESCAPE '\\'"
+        return [row[0][len("guilds_") :] for row in db.execute(query)]
+
+    def create_table(self, shard: int, query: str):
+        """
+        Creates guilds_{table} from the CREATE TABLE statement a cog would run against its own file.
+        """
+        table = create_table_re.match(query).group(1)
+        db = self.connections[shard]
+
+        # Let SQLite parse the statement, then read back the columns
+        scratch = sqlite3.connect(":memory:")
+        scratch.execute(query)
+        columns = scratch.execute(f'PRAGMA table_info("{table}")').fetchall()
+        scratch.close()
+
+        column_defs = ["guild_id INTEGER NOT NULL"]
+        primary_key = list()
+        for _, name, column_type, notnull, default, pk in columns:
+            column_def = f'"{name}" {column_type}'
+            if notnull:
+                column_def += " NOT NULL"
+            if default is not None:
+                column_def += f" DEFAULT {default}"
+            column_defs.append(column_def)
+
+            if pk:
+                primary_key.append((pk, f'"{name}"'))
+
+        if primary_key:
+            column_defs.append(f"PRIMARY KEY(guild_id, {', '.join(name for _, name in sorted(primary_key))})")
+
+        options = " WITHOUT ROWID" if primary_key and without_rowid_re.search(query) else ""
+
+        db.execute(f"CREATE TABLE IF NOT EXISTS guilds_{table}({', '.join(column_defs)}){options}")
+        if not primary_key:
+            db.execute(f"CREATE INDEX IF NOT EXISTS guilds_{table}_guild_id ON guilds_{table}(guild_id)")
+
+        self.create_view(shard, table)
+
+    def rename_table(self, shard: int, guild_id: int, old_name: str, new_name: str):
+        """
+        Renames a table for the guild. If another guild in the shard already has the
+        new table, the guilds rows are moved over instead.
+        """
+        db = self.connections[shard]
+
+        if new_name not in self.tables(shard):
+            db.execute(f"ALTER TABLE guilds_{old_name} RENAME TO guilds_{new_name}")
+            self.drop_view(shard, old_name)
+
+        else:
+            old_columns = [row[1] for row in db.execute(f"PRAGMA table_info(guilds_{old_name})")]
+            columns = ", ".join(
+                f'"{row[1]}"' for row in db.execute(f"PRAGMA table_info(guilds_{new_name})") if row[1] in old_columns
+            )
+            db.execute(
+                f"INSERT INTO guilds_{new_name}({columns}) SELECT {columns} FROM guilds_{old_name} WHERE guild_id = ?",
+                (guild_id,),
+            )
+            self.drop_table(shard, guild_id, old_name)
+
+        self.create_view(shard, new_name)
+
+    def add_column(self, shard: int, table: str, column: str):
+        db = self.connections[shard]
+        name = column.split()[0].strip("\"'`[]")
+
+        existing = [row[1] for row in db.execute(f"PRAGMA table_info(guilds_{table})")]
+        if name not in existing:
+            db.execute(f"ALTER TABLE guilds_{table} ADD COLUMN {column}")
+
+        self.create_view(shard, table)
+
+    def drop_table(self, shard: int, guild_id: int, table: str):
+        """Removes the guilds rows, the table is dropped once no guild has rows in it"""
+        db = self.connections[shard]
+
+        if table not in self.tables(shard):
+            return
+
+        db.execute(f"DELETE FROM guilds_{table} WHERE guild_id = ?", (guild_id,))
+        if db.execute(f"SELECT 1 FROM guilds_{table} LIMIT 1").fetchone() is None:
+            self.drop_view(shard, table)
+            db.execute(f"DROP TABLE guilds_{table}")
+
+    def create_index(self, shard: int, index: str, table: str, columns: str, unique: bool):
+        db = self.connections[shard]
+        query = (
+            f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS guilds_{index} ON guilds_{table}(guild_id, {columns})'
+        )
+
+        try:
+            db.execute(query)
+
+        except sqlite3.IntegrityError:
+            # Another guild in the shard has duplicate rows that it hasn't cleaned up yet,
+            # keep the last row saved for each, which is the one reading the table would use.
+            # WITHOUT ROWID tables have no rowid, the row with the highest primary key is kept.
+            sql = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (f"guilds_{table}",))
+            if without_rowid_re.search(sql.fetchone()[0]):
+                primary_key = sorted((row[5], row[1]) for row in db.execute(f"PRAGMA table_info(guilds_{table})") if row[5])
+                keys = ", ".join(f'"{name}"' for _, name in primary_key)
+            else:
+                keys = "rowid"
+
+            db.execute(
+                f"DELETE FROM guilds_{table} WHERE ({keys}) IN (SELECT {keys} FROM ("
+                f"SELECT {keys}, row_number() OVER (PARTITION BY guild_id, {columns} ORDER BY {keys} DESC) AS copy "
+                f"FROM guilds_{table}) WHERE copy > 1)"
+            )
+            db.execute(query)
+
+    def refresh_views(self, shard: int):
+        for table in self.tables(shard):
+            self.create_view(shard, table)
+
+    def drop_view(self, shard: int, table: str):
+        # Dropping the view drops its triggers as well
+        self.connections[shard].execute(f'DROP VIEW IF EXISTS temp."{table}"')
+
+    def create_view(self, shard: int, table: str):
+        """
+        Creates the TEMP VIEW and INSTEAD OF triggers that present guilds_{table} as {table}
+        """
+        db = self.connections[shard]
+        self.drop_view(shard, table)
+
+        columns = [row for row in db.execute(f"PRAGMA table_info(guilds_{table})") if row[1] != "guild_id"]
+        names = [f'"{row[1]}"' for row in columns]
+        primary_key = [f'"{row[1]}"' for row in columns if row[5]]
+
+        # Rows are matched on the primary key, or every column when the table doesn't have one
+        if primary_key:
+            match = " AND ".join(f"{name} = OLD.{name}" for name in primary_key)
+        else:
+            match = " AND ".join(f"{name} IS OLD.{name}" for name in names)
+
+        # Values left out of an INSERT come through the view as NULL, so apply the column defaults
+        insert_values = list()
+        for row in columns:
+            if row[4] is not None:
+                insert_values.append(f'coalesce(NEW."{row[1]}", {row[4]})')
+            else:
+                insert_values.append(f'NEW."{row[1]}"')
+
+        db.execute(
+            f'CREATE TEMP VIEW "{table}" AS SELECT {", ".join(names)} '
+            f"FROM guilds_{table} WHERE guild_id = current_guild()"
+        )
+        db.execute(
+            f'CREATE TEMP TRIGGER "{table}_insert" INSTEAD OF INSERT ON "{table}" BEGIN '
+            f"INSERT INTO guilds_{table}(guild_id, {', '.join(names)}) "
+            f"VALUES (current_guild(), {', '.join(insert_values)}); END"
+        )
+        db.execute(
+            f'CREATE TEMP TRIGGER "{table}_update" INSTEAD OF UPDATE ON "{table}" BEGIN '
+            f"UPDATE guilds_{table} SET {', '.join(f'{name} = NEW.{name}' for name in names)} "
+            f"WHERE guild_id = current_guild() AND {match}; END"
+        )
+        db.execute(
+            f'CREATE TEMP TRIGGER "{table}_delete" INSTEAD OF DELETE ON "{table}" BEGIN '
+            f"DELETE FROM guilds_{table} WHERE guild_id = current_guild() AND {match}; END"
+        )
+
+
+class ConsolidatedCursor:
+    """
+    Cursor for a guild on a shard connection, used where the cogs expect Database.cursor[guild_id].
+    """
+
+    def __init__(self, storage: ConsolidatedStorage, guild_id: int, cursor: sqlite3.Cursor):
+        self.storage = storage
+        self.guild_id = guild_id
+        self.cursor = cursor
+
+    def execute(self, query: str, values=()):
+        self.storage.execute(self.cursor, self.guild_id, query, values)
+        return self
+
+    def executemany(self, query: str, values):
+        self.storage.select_guild(self.guild_id)
+        self.cursor.executemany(query, values)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size: int = 1):
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+def migrate(db_path: str = "db", shard_path: str = "db/shards", shards: int = 1):
+    """
+    Imports every db/{guild_id}.db3 file into the shard files.
+    The per guild files are left in place.
+    """
+    storage = ConsolidatedStorage(shard_path, shards)
+
+    for filename in sorted(os.listdir(db_path)):
+        if not filename.endswith(".db3"):
+            continue
+
+        guild_id = int(filename[:-4])
+        shard = storage.shard(guild_id)
+        storage.create(guild_id)
+        db = storage.connect(guild_id)
+
+        with storage.lock(guild_id):
+            storage.select_guild(guild_id)
+            db.execute("ATTACH DATABASE ? AS guild_file", (f"{db_path}/{filename}",))
+
+            query = "SELECT name, sql FROM guild_file.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            tables = db.execute(query).fetchall()
+
+            for table, create_query in tables:
+                storage.create_table(shard, create_query)
+
+                # Clear anything left from an earlier run, then copy the rows in
+                db.execute(f"DELETE FROM guilds_{table} WHERE guild_id = ?", (guild_id,))
+                columns = ", ".join(f'"{row[1]}"' for row in db.execute(f'PRAGMA guild_file.table_info("{table}")'))
+                db.execute(
+                    f'INSERT INTO guilds_{table}(guild_id, {columns}) SELECT ?, {columns} FROM guild_file."{table}"',
+                    (guild_id,),
+                )
+
+            db.commit()
+            db.execute("DETACH DATABASE guild_file")
+
+        logger.info(f"Migrated {filename} to {storage.shard_file(shard)}, {len(tables)} tables.")
+
+    storage.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(name)s: %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Consolidated guild storage tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Import db/{guild_id}.db3 files into the shard files")
+    migrate_parser.add_argument("--db-path", default="db")
+    migrate_parser.add_argument("--shard-path", default="db/shards")
+    migrate_parser.add_argument("--shards", type=int, default=1)
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.db_path, args.shard_path, args.shards)
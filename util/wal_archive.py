@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Discord Bot for HardwareFlare and others
+@author: Tisboyo
+"""
+"""
+Point in time recovery for the guild databases, used by util.storage and util.database.
+
+With database_wal_archive enabled the guild files are kept in WAL mode and SQLite's
+automatic checkpoints are turned off. Every database_wal_archive_interval minutes, and
+whenever a guild's file is closed, the WAL is copied into the archive before it is
+checkpointed into the file. A full base snapshot is added once every
+database_wal_base_interval hours, right after a checkpoint.
+
+    {path}/{guild_id}/{timestamp}.base.db3.gz
+    {path}/{guild_id}/{timestamp}.wal.gz
+
+A guild is restored by decompressing the last base before the chosen time and replaying
+the WAL segments archived after it, up to the chosen time.
+
+Restore to a file with:
+    python -m util.wal_archive restore {guild_id} "2021-03-01 17:30" --output restored.db3
+or from a DM with the bot owner command restoreguild.
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+timestamp_format = "%Y%m%d%H%M%S%f"
+
+
+class WalArchive:
+    def __init__(self, path: str = "db/wal_archive", base_interval: float = 24):
+        self.path = path
+        self.base_interval = datetime.timedelta(hours=base_interval)
+
+        # {guild_id: datetime of the last base snapshot}
+        self.last_base = dict()
+
+    def guild_path(self, guild_id: int):
+        return f"{self.path}/{guild_id}"
+
+    def setup(self, db: sqlite3.Connection):
+        """Puts a newly opened connection in WAL mode, checkpoints are left to archive()"""
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA wal_autocheckpoint=0")
+
+    def archive(self, guild_id: int, db: sqlite3.Connection, db_file: str):
+        """
+        Copies the guild's WAL into the archive and checkpoints it into the file.
+        Call while holding the guild's lock, with nothing left to commit.
+        """
+        if not os.path.exists(self.guild_path(guild_id)):
+            os.makedirs(self.guild_path(guild_id))
+
+        wal_file = f"{db_file}-wal"
+        if os.path.exists(wal_file) and os.path.getsize(wal_file) > 0:
+            with open(wal_file, "rb") as source, gzip.open(self.new_file(guild_id, "wal.gz"), "wb") as destination:
+                shutil.copyfileobj(source, destination)
+
+        busy, _, _ = db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            # A reader kept part of the WAL from being checkpointed, the next segment
+            # repeats those frames, which replays the same pages again.
+            logger.warning(f"WAL checkpoint for {guild_id} was blocked by a reader.")
+            return
+
+        if datetime.datetime.utcnow() - self.base_time(guild_id) >= self.base_interval:
+            self.base(guild_id, db)
+
+    def base(self, guild_id: int, db: sqlite3.Connection):
+        """Adds a full snapshot of the guild, call right after a checkpoint"""
+        filename = self.new_file(guild_id, "base.db3.gz")
+        snapshot = f"{filename[:-3]}.tmp"
+
+        destination = sqlite3.connect(snapshot)
+        db.backup(destination)
+        destination.close()
+
+        with open(snapshot, "rb") as source, gzip.open(filename, "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        os.remove(snapshot)
+
+        self.last_base[guild_id] = datetime.datetime.utcnow()
+        logger.info(f"WAL archive base snapshot for {guild_id} saved.")
+
+    def base_time(self, guild_id: int):
+        """When the last base snapshot of the guild was taken"""
+        if guild_id not in self.last_base:
+            bases = [time for time, kind, _ in self.files(guild_id) if kind == "base"]
+            self.last_base[guild_id] = bases[-1] if bases else datetime.datetime.min
+
+        return self.last_base[guild_id]
+
+    def new_file(self, guild_id: int, extension: str):
+        return f"{self.guild_path(guild_id)}/{datetime.datetime.utcnow().strftime(timestamp_format)}.{extension}"
+
+    def files(self, guild_id: int):
+        """Returns [(datetime, "base" or "wal", path)] oldest first"""
+        if not os.path.exists(self.guild_path(guild_id)):
+            return list()
+
+        files = list()
+        for filename in sorted(os.listdir(self.guild_path(guild_id))):
+            stamp, _, extension = filename.partition(".")
+            if extension not in ["base.db3.gz", "wal.gz"]:
+                continue
+
+            time = datetime.datetime.strptime(stamp, timestamp_format)
+            files.append((time, extension.split(".")[0], f"{self.guild_path(guild_id)}/{filename}"))
+
+        return files
+
+    def restore(self, guild_id: int, until: datetime.datetime, target: str):
+        """
+        Rebuilds the guild's database as it was at until (UTC) into target.
+        Returns the time of the last segment replayed. Raises ValueError if there is nothing to restore from.
+        """
+        files = [each for each in self.files(guild_id) if each[0] <= until]
+        bases = [index for index, (_, kind, _) in enumerate(files) if kind == "base"]
+        if not bases:
+            raise ValueError(f"No base snapshot for {guild_id} before {until}.")
+
+        base_time, _, base_file = files[bases[-1]]
+        segments = [(time, path) for time, kind, path in files[bases[-1] :] if kind == "wal"]
+
+        for each in [target, f"{target}-wal", f"{target}-shm"]:
+            if os.path.exists(each):
+                os.remove(each)
+
+        with gzip.open(base_file, "rb") as source, open(target, "wb") as destination:
+            shutil.copyfileobj(source, destination)
+
+        db = sqlite3.connect(target)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.close()
+
+        restored_to = base_time
+        for time, path in segments:
+            # SQLite replays the WAL when it finds one next to the file
+            with gzip.open(path, "rb") as source, open(f"{target}-wal", "wb") as destination:
+                shutil.copyfileobj(source, destination)
+
+            db = sqlite3.connect(target)
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            db.close()
+
+            restored_to = time
+
+        db = sqlite3.connect(target)
+        try:
+            db.execute("PRAGMA journal_mode=DELETE")
+            result = db.execute("PRAGMA integrity_check").fetchall()
+        finally:
+            db.close()
+
+        if result != [("ok",)]:
+            os.remove(target)
+            raise ValueError(f"Restored database failed the integrity check: {result[:5]}")
+
+        logger.info(f"Restored {guild_id} to {restored_to} from {len(segments)} WAL segments.")
+
+        return restored_to
+
+
+def parse_time(value: str):
+    """Accepts 2021-03-01 17:30, 2021-03-01T17:30:00 or 20210301173000, in UTC"""
+    try:
+        return datetime.datetime.strptime(value, "%Y%m%d%H%M%S")
+    except ValueError:
+        return datetime.datetime.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(name)s: %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Guild database point in time recovery")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    restore_parser = subparsers.add_parser("restore", help="Rebuild a guild's database as it was at a time (UTC)")
+    restore_parser.add_argument("guild_id", type=int)
+    restore_parser.add_argument("time", type=parse_time)
+    restore_parser.add_argument("--output", help="Defaults to {guild_id}-restored.db3")
+    restore_parser.add_argument("--archive-path", default="db/wal_archive")
+
+    list_parser = subparsers.add_parser("list", help="Show the archived files for a guild")
+    list_parser.add_argument("guild_id", type=int)
+    list_parser.add_argument("--archive-path", default="db/wal_archive")
+
+    args = parser.parse_args()
+    archive = WalArchive(args.archive_path)
+
+    if args.command == "restore":
+        archive.restore(args.guild_id, args.time, args.output or f"{args.guild_id}-restored.db3")
+
+    elif args.command == "list":
+        for time, kind, path in archive.files(args.guild_id):
+            print(f"{time}  {kind:4}  {os.path.getsize(path):>10}  {path}")